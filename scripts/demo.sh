@@ -1,5 +1,7 @@
 #!/bin/bash
 # Settings used for the demo; open client/client.html in a browser for fancy output
+# Timing events of both processes are tagged with the same session; see `python -m src.log.analyze --last 1`
+export GEDANKENPOLIZEI_SESSION=${GEDANKENPOLIZEI_SESSION:-$(date +%Y%m%d-%H%M%S)}
 grab/websocket | \
 python -m src.fast.narrate \
     --config fast.novelty_threshold:10 \
@@ -54,10 +54,18 @@ def _parse_config():
             value = yaml.safe_load(value)
             _update_config(config, path, value)
 
-    return config, parser, other_args
+    return config, parser, config_args, other_args
 
 
-_CONFIG, _CONFIG_PARSER, _OTHER_ARGS = _parse_config()
+_CONFIG, _CONFIG_PARSER, _CONFIG_ARGS, _OTHER_ARGS = _parse_config()
+
+
+def config_argv():
+    """Return the command-line arguments that reproduce the current configuration, e.g. in a subprocess"""
+    argv = ["--config-file", _CONFIG_ARGS.config_file]
+    for conf_str in _CONFIG_ARGS.config or []:
+        argv += ["--config", conf_str]
+    return argv
 
 
 class ConfigArgumentParser(argparse.ArgumentParser):
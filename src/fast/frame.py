@@ -7,16 +7,20 @@ from io import BytesIO
 from time import time
 
 from PIL import Image
-from vertexai.generative_models import Image as GeminiImage
 
 from src.config import CONFIG
 from src.gemini import (
+    Image as GeminiImage,
     gemini,
     read_prompt_file,
 )
-from src.log import debug
+from src.gemini.budget import Budget
+from src.gemini.cache import context_cache
+from src.log import debug, info
+from src.metrics import record_request
 
 SYSTEM_PROMPT = read_prompt_file(CONFIG("fast.model.system_prompt_file"))
+MAX_PROMPT_TOKENS = CONFIG("fast.max_prompt_tokens")
 
 MODEL = gemini(
     CONFIG("fast.model.name"),
@@ -27,11 +31,15 @@ MODEL = gemini(
     system_instruction=SYSTEM_PROMPT,
 )
 
+CACHE = context_cache(MODEL)
+
 
 class Frame:  # Cannot subclass PIL.Image.Image directly, so wrap it awkwardly
-    def __init__(self, rawjpeg, max_size=None):
-        self.timestamp = time()
+    def __init__(self, rawjpeg, max_size=None, timestamp=None, id=None):
+        self.timestamp = timestamp or time()  # Capture time if known, else decode time
+        self.id = id  # Traces the frame through the FAST and RAW streams
         self.image = Image.open(BytesIO(rawjpeg))
+        self._jpeg = (None, None)  # (image, its JPEG bytes)
 
         if max_size:
             if self.image.size[0] > max_size[0] or self.image.size[1] > max_size[1]:
@@ -41,8 +49,10 @@ class Frame:  # Cannot subclass PIL.Image.Image directly, so wrap it awkwardly
         self.image.save(path)
 
     def thumbnail(self, size):
-        """Downscale to `size` in place"""
-        self.image.thumbnail(size, Image.Resampling.LANCZOS)
+        """Downscale to `size`, swapping in a new image so that a log writer thread never sees a half-resized one"""
+        image = self.image.copy()
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+        self.image = image
 
     def downsize(self, factor):
         """Downsize by `factor` in place"""
@@ -51,9 +61,15 @@ class Frame:  # Cannot subclass PIL.Image.Image directly, so wrap it awkwardly
         self.thumbnail(new_size)
 
     def jpeg(self):
-        with BytesIO() as f:
-            self.image.save(f, "JPEG")
-            return f.getvalue()
+        """Return the JPEG bytes of the current image, encoding it only once"""
+        image = self.image
+        cached, data = self._jpeg
+        if cached is not image:  # Keyed by identity, as thumbnail() swaps in a new image
+            with BytesIO() as f:
+                image.save(f, "JPEG")
+                data = f.getvalue()
+            self._jpeg = (image, data)
+        return data
 
     def encode64(self):
         return base64.b64encode(self.jpeg()).decode("utf-8")
@@ -69,6 +85,14 @@ class Frame:  # Cannot subclass PIL.Image.Image directly, so wrap it awkwardly
     def prompt(self, t=None):
         return [self.precaption(t), self.gemini_image()]
 
+    def prompt_after(self, previous=None):
+        """Prompt captioned relative to the `previous` frame, so it stays the same from request to request"""
+        if previous is None:
+            caption = "Earlier:"
+        else:
+            caption = f"{self.timestamp - previous.timestamp:.1f} sec later:"
+        return [caption, self.gemini_image()]
+
 
 def join(prompts, sep=None):
     def iter():
@@ -108,11 +132,22 @@ class Memory:
         for frame in self.frames:
             frame.downsize(self.scaling)
 
-    def prompts(self, t=None):
-        return [frame.prompt(t) for frame in self.frames]
+    def prompts(self, t=None, n=None):
+        """Prompts of the last `n` frames (all if None)"""
+        frames = self.frames if n is None else self.frames[len(self.frames) - n :]
+        return [frame.prompt(t) for frame in frames]
+
+    def stable_prompts(self, n=None):
+        """Like `prompts()`, but captioned relative to each other, so they can be cached until the memory changes"""
+        frames = self.frames if n is None else self.frames[len(self.frames) - n :]
+        previous = [None] + frames[:-1]
+        return [frame.prompt_after(p) for frame, p in zip(frames, previous)]
+
+    def last_frame(self):
+        return self.frames[-1] if self.frames else None
 
     def log(self, level=debug):
-        level("Memory contents", extra={"images": self.frames})
+        level("Memory contents", extra={"images": list(self.frames)})
 
 
 def parse_reply(reply):
@@ -133,11 +168,36 @@ def parse_reply(reply):
 
 
 def narrate(past, now):
-    """Narrate the `now` frame conditioned on the `past` outputs of this function"""
-    prompt = join(past.prompts() + [now.prompt()], sep="\n")
+    """Narrate the `now` frame conditioned on the `past` outputs of this function
+
+    The oldest memory frames are left out if the prompt would not fit MAX_PROMPT_TOKENS. With context caching, the
+    memory frames are sent once as a cached prefix until the memory changes.
+    """
+    budget = Budget(MAX_PROMPT_TOKENS)
+    budget.spend(SYSTEM_PROMPT)
+    budget.spend(now.prompt())
+    n = len(budget.take_newest("memory_frames", past.prompts(), lambda p: p + ["\n"]))
+    (info if budget.trimmed else debug)(budget.summary())
+
+    cached = None
+    if CACHE is None:
+        prompt = join(past.prompts(n=n) + [now.prompt()], sep="\n")
+    else:
+        prefix = join(past.stable_prompts(n), sep="\n") + ["\n"] if n else []
+        cached = CACHE.get(prefix)
+        prompt = now.prompt_after(past.last_frame())
+        if cached is None:
+            prompt = prefix + prompt
+
     debug(f"Sending message:\n{prompt}")
-    reply = MODEL.generate_content(prompt)
+    t = time()
+    try:
+        reply = MODEL.generate_content(prompt, cached=cached)
+    except Exception:
+        record_request(MODEL, prompt, "", time() - t, error=True, cached=cached)
+        raise
+    record_request(MODEL, prompt, reply.text, time() - t, cached=cached)
     debug(f"Reply:\n{reply}")
 
     output = parse_reply(reply)
-    return output
\ No newline at end of file
+    return output
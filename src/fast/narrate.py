@@ -4,16 +4,21 @@ import json
 import sys
 import threading
 from threading import Lock
-from time import sleep
+from time import monotonic, sleep, time
 
 from src.config import CONFIG, ConfigArgumentParser
 from src.fast.frame import Frame, Memory, narrate
 from src.log import debug, error, info, verbose
+from src.log.events import event
+from src.metrics import inc
+from src.metrics import start as start_metrics
 
 MAX_SIZE = CONFIG("fast.max_size")
 NOVELTY_THRESHOLD = CONFIG("fast.novelty_threshold")
+METRICS_PORT = CONFIG("fast.metrics_port")
 
-LASTJPEG = None
+LASTJPEG = None  # (jpeg, frame id, capture time, capture monotonic time)
+DROPPED = 0  # Frames overwritten by a newer one before they could be narrated
 EXITCODE = 1
 LOCK = Lock()
 
@@ -31,7 +36,8 @@ def stream():
     buffer = bytearray()
     chunksize = 4096
 
-    global LASTJPEG
+    global LASTJPEG, DROPPED
+    id = 0
 
     while True:
         data = sys.stdin.buffer.read(chunksize)
@@ -44,9 +50,12 @@ def stream():
             n = len(jpeg)
             buffer = buffer[n:]
             chunksize = (chunksize + n) // 2
+            id += 1
 
             with LOCK:
-                LASTJPEG = jpeg.copy()
+                if LASTJPEG is not None:
+                    DROPPED += 1
+                LASTJPEG = (jpeg.copy(), id, time(), monotonic())
 
 
 def valid_narration(past, output):
@@ -63,15 +72,15 @@ def valid_narration(past, output):
 
 def writeout(output, frame, args):
     if args.jsonl:
+        tags = {"frame_id": frame.id, "timestamp": frame.timestamp}
         if args.output_frames:
-            s = json.dumps(
-                {"frame": frame.encode64(), "timestamp": frame.timestamp, **output}
-            )
+            s = json.dumps({"frame": frame.encode64(), **tags, **output})
         else:
-            s = json.dumps(output)
+            s = json.dumps({**tags, **output})
     else:
         s = output["narration"]
     print(s, flush=True)
+    event("writeout", frame=frame.id)
 
 
 def main(args):
@@ -80,8 +89,9 @@ def main(args):
     streaming_thread.start()
 
     past = Memory(CONFIG)
+    start_metrics(METRICS_PORT)
 
-    global LASTJPEG
+    global LASTJPEG, DROPPED
 
     while streaming_thread.is_alive():
         if not LASTJPEG:
@@ -89,16 +99,27 @@ def main(args):
             continue
 
         with LOCK:
-            lastjpeg = LASTJPEG
+            lastjpeg, id, captured, captured_mono = LASTJPEG
             LASTJPEG = None
+            dropped, DROPPED = DROPPED, 0
+        inc("fast_dropped_frames_total", dropped)
 
         # Narrate the last JPEG frame (`now`)
-        now = Frame(lastjpeg, MAX_SIZE)
+        now = Frame(lastjpeg, MAX_SIZE, timestamp=captured, id=id)
 
+        t = time()
+        trace = {"frame": id, "captured": captured_mono, "started": monotonic()}
         try:
             output = narrate(past, now)
         except Exception as e:
             error(f"Exception during narrate: {e}", exc_info=True)
+            event(
+                "narration",
+                latency=time() - t,
+                dropped=dropped,
+                error=type(e).__name__,
+                **trace,
+            )
             continue
 
         # Write out if the narration is novel enough and log output
@@ -112,6 +133,19 @@ def main(args):
             valid_narration(past, output),
         ]
 
+        event(
+            "narration",
+            latency=time() - t,
+            dropped=dropped,
+            novelty=output["novelty"],
+            accepted=all(conditions),
+            chars=len(output["narration"] or ""),
+            error=None,
+            **trace,
+        )
+
+        inc("fast_narrations_total", accepted=str(all(conditions)).lower())
+
         if all(conditions):
             writeout(output, now, args)
             past.log(verbose)
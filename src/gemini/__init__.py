@@ -0,0 +1,145 @@
+"""Gemini API wrapper with pluggable backends: Vertex AI, a local fake or a replay (see `gemini.backend` in config.yaml)
+
+Models returned by `gemini()` all have the interface of Vertex AI's `GenerativeModel.generate_content()` as used here:
+a prompt is a string or a list of strings and `Image`s, `generation_config` is a dict, and replies (or, with
+`stream=True`, an iterator of chunks) have a `.text`.
+"""
+
+import re
+
+from src.config import CONFIG
+from src.metrics import billed_chars
+
+BACKEND = CONFIG("gemini.backend")
+RECORD = CONFIG("gemini.replay.record")
+PLACEHOLDER = re.compile(r"\{\{([A-Za-z0-9_]+)\}\}")
+
+
+class Image:
+    """A JPEG image prompt part, independent of the backend"""
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data)
+
+    def __repr__(self):
+        return f"<Image of {len(self.data)} bytes>"
+
+
+def gemini(model_shorthand, **kwargs):
+    model_name = CONFIG["gemini"]["model"][model_shorthand]["name"]
+
+    if BACKEND == "vertex":
+        from src.gemini.vertex import VertexModel as Model
+    elif BACKEND == "fake":
+        from src.gemini.fake import FakeModel as Model
+    elif BACKEND == "replay":
+        from src.gemini.replay import ReplayModel as Model
+    else:
+        raise ValueError(f"Unknown Gemini backend `{BACKEND}`")
+
+    model = Model(model_name, **kwargs)
+
+    if RECORD:
+        from src.gemini.replay import RecordingModel, model_key, recording_path
+
+        if BACKEND == "replay":
+            raise ValueError("Cannot record a replay")
+        key = model_key(
+            model_name, kwargs.get("generation_config"), kwargs.get("system_instruction")
+        )
+        model = RecordingModel(model, key, recording_path())
+    model.name = model_name
+    model.shorthand = model_shorthand  # Looks up its prices in `src.metrics`
+
+    system_instruction = kwargs.get("system_instruction")
+    model.system_chars = (  # Billed with every request
+        billed_chars(system_instruction) if isinstance(system_instruction, str) else 0
+    )
+    return model
+
+
+def read_prompt_file(filename):
+    """Note that for Gemini on Vertex AI whitespace is not billed"""
+    with open(filename, "r") as file:
+        lines = file.readlines()
+    text = ""
+    for line in lines:  # Remove comments
+        if not line.strip().startswith("#"):
+            text += line
+    return text
+
+
+class Template:
+    """A prompt with {{VARIABLE_NAME}} placeholders, parsed once into literal text and variable segments
+
+    Rendering fills all variables in one pass: strings are inlined and None is left out, while other objects
+    (such as `Image`s, or lists of parts) become parts of their own, in which case a list of parts is returned.
+    Missing and unknown variables raise a KeyError.
+    """
+
+    def __init__(self, text, segments=None):
+        if segments is None:
+            parts = PLACEHOLDER.split(text)  # Literal text at even indices, variable names at odd indices
+            segments = [(i % 2 == 1, part) for i, part in enumerate(parts)]
+
+        self.segments = []  # (isvariable, text or variable name), without empty or adjacent literals
+        for isvariable, segment in segments:
+            if not isvariable and not segment:
+                continue
+            if not isvariable and self.segments and not self.segments[-1][0]:
+                self.segments[-1] = (False, self.segments[-1][1] + segment)
+            else:
+                self.segments.append((isvariable, segment))
+        self.variables = {name for isvariable, name in self.segments if isvariable}
+
+    @property
+    def prefix(self):
+        """The literal text before the first variable, which is the same for every rendering"""
+        isvariable, text = self.segments[0] if self.segments else (True, "")
+        return "" if isvariable else text
+
+    def check(self, variables, partial=False):
+        unknown = variables.keys() - self.variables
+        if unknown:
+            raise KeyError(f"Unknown template variables: {sorted(unknown)}")
+        missing = self.variables - variables.keys()
+        if missing and not partial:
+            raise KeyError(f"Missing template variables: {sorted(missing)}")
+
+    def fill(self, **variables):
+        """Return a new template with some of the variables filled in by strings (or None)"""
+        self.check(variables, partial=True)
+        segments = [
+            (False, variables[segment] or "")
+            if isvariable and segment in variables
+            else (isvariable, segment)
+            for isvariable, segment in self.segments
+        ]
+        return Template(None, segments)  # Filled in text is not parsed for placeholders
+
+    def render(self, **variables):
+        self.check(variables)
+        parts = []
+        text = []
+        for isvariable, segment in self.segments:
+            value = variables[segment] if isvariable else segment
+            if value is None:
+                continue
+            if isinstance(value, str):
+                text.append(value)
+                continue
+
+            if text:
+                parts.append("".join(text))
+                text = []
+            parts.extend(value if isinstance(value, (list, tuple)) else [value])
+
+        if not parts:
+            return "".join(text)
+        if text:
+            parts.append("".join(text))
+        return parts
@@ -0,0 +1,75 @@
+"""Estimate prompt tokens locally and trim prompts to fit a token budget
+
+Text costs `gemini.budget.chars_per_token` chars per token and each image a fixed `gemini.budget.tokens_per_image`.
+A Budget is spent on the parts of a request in order of priority: what doesn't fit anymore is left out.
+"""
+
+from math import ceil
+
+from src.config import CONFIG
+
+CHARS_PER_TOKEN = CONFIG("gemini.budget.chars_per_token")
+TOKENS_PER_IMAGE = CONFIG("gemini.budget.tokens_per_image")
+
+
+def count_tokens(prompt):
+    """Estimate the tokens in `prompt`, which is None, a string, an image or a list of these"""
+    if prompt is None:
+        return 0
+    if isinstance(prompt, str):
+        return ceil(len(prompt) / CHARS_PER_TOKEN)
+    if isinstance(prompt, (list, tuple)):
+        return sum(count_tokens(part) for part in prompt)
+    return TOKENS_PER_IMAGE
+
+
+class Budget:
+    def __init__(self, tokens=None):
+        self.tokens = float("inf") if tokens is None else tokens
+        self.spent = 0
+        self.trimmed = {}  # Name => number of items or chars left out
+
+    def left(self):
+        return self.tokens - self.spent
+
+    def spend(self, prompt):
+        """Spend on `prompt` whether it fits or not"""
+        self.spent += count_tokens(prompt)
+
+    def take(self, name, prompt):
+        """Spend on `prompt` and return it if it fits, else return None"""
+        tokens = count_tokens(prompt)
+        if tokens > self.left():
+            if prompt is not None:
+                self.trimmed[name] = self.trimmed.get(name, 0) + 1
+            return None
+        self.spent += tokens
+        return prompt
+
+    def take_newest(self, name, items, prompt=lambda item: item):
+        """Return the newest (last) `items` whose prompts fit, in their original order"""
+        taken = []
+        for item in reversed(items):
+            if self.take(name, prompt(item)) is None:
+                self.trimmed[name] = len(items) - len(taken)
+                break
+            taken.append(item)
+        return taken[::-1]
+
+    def take_tail(self, name, text):
+        """Return the longest tail of `text` that fits"""
+        if text is None:
+            return None
+        left = self.left()
+        chars = left if left == float("inf") else max(0, int(left * CHARS_PER_TOKEN))
+        if len(text) > chars:
+            self.trimmed[name] = len(text) - chars
+            text = text[len(text) - chars :]
+        self.spend(text)
+        return text
+
+    def summary(self):
+        tokens = "unlimited" if self.tokens == float("inf") else self.tokens
+        trimmed = ", ".join(f"{k}: {v}" for k, v in self.trimmed.items()) or "nothing"
+        return f"Prompt budget: {self.spent}/{tokens} tokens, trimmed {trimmed}"
+
@@ -0,0 +1,104 @@
+"""Context caching: upload a stable prompt prefix (with the system instruction) once and reference it by handle
+
+A ContextCache holds the cached prefix of one kind of request. When the prefix changes (e.g. FAST memory frames
+rotate), the old cache is deleted and a new one is created. Prefixes too small for the provider are not cached.
+"""
+
+import hashlib
+import threading
+from time import monotonic
+
+from src.config import CONFIG
+from src.gemini.budget import CHARS_PER_TOKEN, count_tokens
+from src.log import debug, warning
+from src.metrics import inc
+
+TTL = CONFIG("gemini.cache.ttl")
+
+
+def parts_of(prompt):
+    return [prompt] if isinstance(prompt, str) else list(prompt)
+
+
+def digest(parts):
+    h = hashlib.sha256()
+    for part in parts:
+        data = part.encode() if isinstance(part, str) else part.data
+        h.update(b"T" if isinstance(part, str) else b"I")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def estimate_tokens(model, parts):
+    return model.system_chars / CHARS_PER_TOKEN + count_tokens(parts)
+
+
+def split_prefix(prompt, prefix):
+    """Return `prompt` without its leading string `prefix`"""
+    parts = parts_of(prompt)
+    if not prefix:
+        return parts
+    if not parts or not isinstance(parts[0], str) or not parts[0].startswith(prefix):
+        raise ValueError("Prompt does not start with the prefix")
+    rest = parts[0][len(prefix) :]
+    return ([rest] if rest else []) + parts[1:]
+
+
+class CachedPrefix:
+    """Handle to a prefix cached on the provider by `model.create_cache()`"""
+
+    def __init__(self, parts, provider=None):
+        self.parts = parts
+        self.provider = provider  # Whatever the backend needs to refer to it
+        self.expires = None
+
+
+class ContextCache:
+    def __init__(self, model, ttl=TTL):
+        self.model = model
+        self.ttl = ttl
+        self.key = None
+        self.handle = None
+        self.lock = threading.Lock()
+
+    def get(self, prefix):
+        """Return a handle to `prefix` cached on the provider, or None if it can't be cached"""
+        prefix = parts_of(prefix)
+        key = digest(prefix)
+        with self.lock:
+            handle = self.handle
+            if key == self.key and (handle is None or monotonic() < handle.expires):
+                return handle
+
+            self.invalidate()
+            self.key = key
+
+            if estimate_tokens(self.model, prefix) < self.model.min_cache_tokens:
+                return None  # Too small for the provider: send it along with every request
+
+            try:
+                handle = self.model.create_cache(prefix, self.ttl)
+            except Exception as e:
+                warning(f"Could not cache prompt prefix: {e}")
+                return None
+
+            handle.expires = monotonic() + 0.9 * self.ttl  # Renew a bit before the provider drops it
+            self.handle = handle
+            inc("gemini_caches_created_total", model=self.model.shorthand)
+            debug(f"Cached a prompt prefix of {len(prefix)} parts for {self.model.shorthand}")
+            return handle
+
+    def invalidate(self):
+        handle, self.handle = self.handle, None
+        self.key = None
+        if handle is not None:
+            try:
+                self.model.delete_cache(handle)
+            except Exception as e:
+                warning(f"Could not delete cached prompt prefix: {e}")
+
+
+def context_cache(model):
+    """Return a ContextCache for `model` if `gemini.cache.enabled`, else None"""
+    return ContextCache(model) if CONFIG("gemini.cache.enabled") else None
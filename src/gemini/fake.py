@@ -0,0 +1,132 @@
+"""A deterministic local stand-in for Gemini, to run and load-test the pipeline offline
+
+Replies are made of words drawn from the prompt and system instruction, streamed in chunks of `chunk_chars` at `chars_per_second` after a
+time to first token of `ttft` seconds (jittered by `jitter`), plus `ttft_per_kchar` and `ttft_per_image` for input that isn't in a
+context cache. With probability `failure_rate`, a request fails before its first chunk or halfway through streaming. JSON replies (`response_mime_type: application/json`) are FAST
+narrations, and prompts asking for GOOD or BAD (as in `src.slow.reddit.vet`) get verdicts, GOOD with probability
+`good_rate`, or a JSON array of verdicts for a batch of `Post {i}:`s. Everything is drawn from a generator seeded with `seed` and the number of requests made so far.
+"""
+
+import json
+import random
+import re
+import threading
+from math import exp
+from time import sleep
+
+from src.config import CONFIG
+from src.gemini.cache import CachedPrefix
+from src.metrics import billed_chars
+
+VERDICT_PROMPT = "GOOD or BAD"
+BATCH_POST = re.compile(r"^Post \d+:$", re.MULTILINE)
+LOREM = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+
+class FakeError(RuntimeError):
+    pass
+
+
+class FakeReply:
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return f"FakeReply({self.text!r})"
+
+
+class FakeModel:
+    min_cache_tokens = 0
+
+    def __init__(self, model_name, generation_config=None, system_instruction=None, **kwargs):
+        self.generation_config = generation_config or {}
+        self.system_words = (system_instruction or "").split()
+        self.ttft = CONFIG("gemini.fake.ttft")
+        self.ttft_per_kchar = CONFIG("gemini.fake.ttft_per_kchar")
+        self.ttft_per_image = CONFIG("gemini.fake.ttft_per_image")
+        self.jitter = CONFIG("gemini.fake.jitter")
+        self.chars_per_second = CONFIG("gemini.fake.chars_per_second")
+        self.chunk_chars = CONFIG("gemini.fake.chunk_chars")
+        self.reply_chars = CONFIG("gemini.fake.reply_chars")
+        self.failure_rate = CONFIG("gemini.fake.failure_rate")
+        self.good_rate = CONFIG("gemini.fake.good_rate")
+        self.seed = CONFIG("gemini.fake.seed")
+        self.numrequests = 0
+        self.lock = threading.Lock()
+
+    def rng(self):
+        with self.lock:
+            self.numrequests += 1
+            return random.Random(f"{self.seed}:{self.numrequests}")
+
+    def verdicts(self, rng, text, config):
+        def verdict():
+            return "GOOD" if rng.random() < self.good_rate else "BAD"
+
+        if config.get("response_mime_type") == "application/json":
+            return json.dumps([verdict() for _ in BATCH_POST.findall(text)])
+        return verdict()
+
+    def compose(self, rng, prompt, config):
+        parts = [prompt] if isinstance(prompt, str) else prompt
+        text = " ".join(p for p in parts if isinstance(p, str))
+        if VERDICT_PROMPT in text:
+            return self.verdicts(rng, text, config)
+
+        words = text.split()
+        words = words + self.system_words or LOREM
+
+        max_chars = self.reply_chars
+        if config.get("max_output_tokens"):
+            max_chars = 4 * config["max_output_tokens"]  # About 4 chars per token
+
+        text = ""
+        while len(text) < max_chars:
+            text += rng.choice(words) + " "
+        text = text[:max_chars]
+
+        if config.get("response_mime_type") == "application/json":
+            return json.dumps({"novelty": rng.randint(0, 100), "narration": text.strip()})
+        return text
+
+    def create_cache(self, parts, ttl):
+        return CachedPrefix(list(parts))
+
+    def delete_cache(self, handle):
+        pass
+
+    def generate_content(
+        self, prompt, generation_config=None, stream=False, cached=None
+    ):
+        config = {**self.generation_config, **(generation_config or {})}
+        rng = self.rng()
+
+        parts = [prompt] if isinstance(prompt, str) else list(prompt)
+        chars = sum(billed_chars(p) for p in parts if isinstance(p, str))
+        images = sum(1 for p in parts if not isinstance(p, str))
+        if cached is None:
+            chars += billed_chars(" ".join(self.system_words))
+        else:
+            parts = cached.parts + parts
+        text = self.compose(rng, parts, config)
+
+        fail_at = None
+        if rng.random() < self.failure_rate:
+            fail_at = rng.choice([0, len(text) // 2])
+
+        ttft = self.ttft * exp(rng.gauss(0, 1) * self.jitter)
+        ttft += self.ttft_per_kchar * chars / 1000 + self.ttft_per_image * images
+        chunks = self.stream(text, ttft, fail_at)
+        return chunks if stream else FakeReply("".join(c.text for c in chunks))
+
+    def stream(self, text, ttft, fail_at):
+        sleep(ttft)
+        for start in range(0, max(len(text), 1), self.chunk_chars):
+            if fail_at is not None and start >= fail_at:
+                raise FakeError(f"Injected failure after {start} chars")
+            chunk = text[start : start + self.chunk_chars]
+            if start:
+                sleep(len(chunk) / self.chars_per_second)
+            yield FakeReply(chunk)
+        if fail_at is not None:  # Replies of a single chunk fail after it
+            raise FakeError(f"Injected failure after {len(text)} chars")
@@ -0,0 +1,222 @@
+"""Record Gemini requests with their streamed replies and timings, and replay them to rerun a session offline
+
+With `gemini.replay.record`, every request of a script is appended to `{gemini.replay.dir}/{script}.jsonl` as its
+fingerprint, the text parts of its prompt, and its chunks timed from the start of the request. The `replay` backend
+serves these back with the original timing scaled by `1/gemini.replay.speed`.
+
+A request gets the recorded reply with the same fingerprint. As prompts include the clock ("3.1s ago") and RAW
+memory, which depend on timing, numbers don't count for fingerprints, and requests that still don't match get the
+next recorded reply of the same model in order.
+"""
+
+import hashlib
+import json
+import re
+import sys
+import threading
+from collections import defaultdict
+from time import monotonic, sleep, time
+
+from src.config import CONFIG
+from src.gemini.cache import CachedPrefix
+from src.log import get_log_file_path, info, warning
+from src.metrics import inc
+
+DIR = CONFIG("gemini.replay.dir")
+SPEED = CONFIG("gemini.replay.speed")
+MIN_CACHE_TOKENS = CONFIG("gemini.cache.min_tokens")
+NUMBER = re.compile(r"\d+(\.\d+)?")
+
+
+class ReplayError(RuntimeError):
+    pass
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return f"Reply({self.text!r})"
+
+
+def recording_path():
+    return get_log_file_path(sys.argv[0], DIR).with_suffix(".jsonl")
+
+
+def model_key(model_name, generation_config=None, system_instruction=None):
+    """Tells apart the models of a script, e.g. the primary and hedge model of RAW"""
+    config = json.dumps(generation_config or {}, sort_keys=True, default=str)
+    return hashlib.sha256(f"{model_name}\0{config}\0{system_instruction}".encode()).hexdigest()[:16]
+
+
+def prompt_parts(prompt, cached=None):
+    parts = [prompt] if isinstance(prompt, str) else list(prompt)
+    return (cached.parts if cached is not None else []) + parts
+
+
+def fingerprint(key, parts, generation_config=None):
+    h = hashlib.sha256(key.encode())
+    h.update(json.dumps(generation_config or {}, sort_keys=True, default=str).encode())
+    for part in parts:
+        if isinstance(part, str):
+            h.update(b"T" + NUMBER.sub("0", part).encode())
+        else:
+            h.update(b"I" + part.data)
+    return h.hexdigest()
+
+
+def describe(parts):
+    return [
+        p if isinstance(p, str) else f"<image {hashlib.sha256(p.data).hexdigest()[:16]}>"
+        for p in parts
+    ]
+
+
+class RecordingModel:
+    """Wrap a backend model to record its requests to `path`"""
+
+    def __init__(self, model, key, path):
+        self.model = model
+        self.key = key
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)  # Cache support and such of the backend
+
+    def write(self, record, start):
+        record["seconds"] = monotonic() - start
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def generate_content(
+        self, prompt, generation_config=None, stream=False, cached=None
+    ):
+        parts = prompt_parts(prompt, cached)
+        record = {
+            "model": self.key,
+            "fingerprint": fingerprint(self.key, parts, generation_config),
+            "time": time(),
+            "stream": stream,
+            "prompt": describe(parts),
+            "chunks": [],  # [seconds since the request was made, text]
+            "seconds": None,  # Until the request ended
+            "error": None,
+            "cancelled": False,
+        }
+        start = monotonic()
+
+        def chunks(reply):
+            try:
+                for chunk in reply:
+                    record["chunks"].append([monotonic() - start, chunk.text])
+                    yield chunk
+            except GeneratorExit:
+                record["cancelled"] = True
+                raise
+            except Exception as e:
+                record["error"] = repr(e)
+                raise
+            finally:
+                self.write(record, start)
+
+        try:
+            reply = self.model.generate_content(
+                prompt, generation_config=generation_config, stream=stream, cached=cached
+            )
+        except Exception as e:
+            record["error"] = repr(e)
+            self.write(record, start)
+            raise
+
+        if stream:
+            return chunks(reply)
+        record["chunks"].append([monotonic() - start, reply.text])
+        self.write(record, start)
+        return reply
+
+
+class Recording:
+    """The recorded replies of a script, each served once"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.fingerprints = defaultdict(list)  # Fingerprint => unserved records
+        self.queues = defaultdict(list)  # Model key => unserved records in order
+
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        for number, record in enumerate(records):
+            record["number"] = number
+            record["served"] = False
+            self.fingerprints[record["fingerprint"]].append(record)
+            self.queues[record["model"]].append(record)
+        info(f"Replaying {len(records)} recorded Gemini requests from {path}")
+
+    def take(self, key, fingerprint):
+        with self.lock:
+            matches = [r for r in self.fingerprints[fingerprint] if not r["served"]]
+            if matches:
+                record = matches[0]
+            else:
+                queue = [r for r in self.queues[key] if not r["served"]]
+                if not queue:
+                    raise ReplayError("No recorded replies left")
+                record = queue[0]
+                inc("gemini_replay_misses_total")
+                warning(f"No recorded reply for this prompt: serving request {record['number']} instead")
+            record["served"] = True
+            return record
+
+
+RECORDING = None
+
+
+def recording():
+    global RECORDING
+    if RECORDING is None:
+        RECORDING = Recording(recording_path())
+    return RECORDING
+
+
+class ReplayModel:
+    """Backend serving the replies recorded with `gemini.replay.record`"""
+
+    min_cache_tokens = MIN_CACHE_TOKENS
+
+    def __init__(self, model_name, generation_config=None, system_instruction=None, **kwargs):
+        self.generation_config = generation_config
+        self.key = model_key(model_name, generation_config, system_instruction)
+        self.recording = recording()
+
+    def create_cache(self, parts, ttl):
+        return CachedPrefix(list(parts))
+
+    def delete_cache(self, handle):
+        pass
+
+    def generate_content(
+        self, prompt, generation_config=None, stream=False, cached=None
+    ):
+        parts = prompt_parts(prompt, cached)
+        record = self.recording.take(
+            self.key, fingerprint(self.key, parts, generation_config)
+        )
+        chunks = self.replay(record, monotonic())
+        if stream:
+            return chunks
+        return Reply("".join(chunk.text for chunk in chunks))
+
+    def replay(self, record, start):
+        def wait(t):
+            if SPEED:
+                sleep(max(0.0, start + t / SPEED - monotonic()))
+
+        for t, text in record["chunks"]:
+            wait(t)
+            yield Reply(text)
+        if record["error"] is not None:
+            wait(record["seconds"])
+            raise ReplayError(f"Recorded error: {record['error']}")
@@ -0,0 +1,114 @@
+"""Gemini on Vertex AI, initialized on first use"""
+
+import os
+import threading
+from datetime import timedelta
+
+import dotenv
+import vertexai
+from vertexai.generative_models import (
+    Content,
+    GenerativeModel,
+    HarmBlockThreshold,
+    HarmCategory,
+    Part,
+)
+from vertexai.generative_models import Image as VertexImage
+from vertexai.preview import caching
+
+from src.config import CONFIG
+from src.gemini import Image
+from src.gemini.cache import CachedPrefix
+
+LOCATION = CONFIG("gemini.location")
+MIN_CACHE_TOKENS = CONFIG("gemini.cache.min_tokens")
+
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+_INITIALIZED = False
+_LOCK = threading.Lock()
+
+
+def init():
+    global _INITIALIZED
+    with _LOCK:
+        if _INITIALIZED:
+            return
+
+        dotenv.load_dotenv()
+
+        project_id = os.getenv("PROJECT_ID")
+        if not project_id:
+            raise ValueError("PROJECT_ID token is not set in the .env file")
+
+        vertexai.init(project=project_id, location=LOCATION)
+        _INITIALIZED = True
+
+
+def vertex_part(part):
+    if isinstance(part, Image):
+        return VertexImage.from_bytes(part.data)
+    return part
+
+
+class VertexModel:
+    min_cache_tokens = MIN_CACHE_TOKENS
+
+    def __init__(self, model_name, **kwargs):
+        init()
+        config = dict(
+            model_name=model_name,
+            safety_settings=SAFETY_SETTINGS,
+        )
+        config.update(kwargs)
+        self.model_name = model_name
+        self.system_instruction = config.pop("system_instruction", None)
+        self.generation_config = config.get("generation_config")
+        self.model = GenerativeModel(system_instruction=self.system_instruction, **config)
+
+    def create_cache(self, parts, ttl):
+        """Cache the system instruction and `parts` on Vertex AI for `ttl` seconds"""
+        contents = []
+        if parts:
+            contents = [
+                Content(
+                    role="user",
+                    parts=[
+                        Part.from_data(p.data, "image/jpeg")
+                        if isinstance(p, Image)
+                        else Part.from_text(p)
+                        for p in parts
+                    ],
+                )
+            ]
+        cached_content = caching.CachedContent.create(
+            model_name=self.model_name,
+            system_instruction=self.system_instruction,
+            contents=contents,
+            ttl=timedelta(seconds=ttl),
+        )
+        model = GenerativeModel.from_cached_content(
+            cached_content,
+            generation_config=self.generation_config,
+            safety_settings=SAFETY_SETTINGS,
+        )
+        return CachedPrefix(parts, (cached_content, model))
+
+    def delete_cache(self, handle):
+        cached_content, _ = handle.provider
+        cached_content.delete()
+
+    def generate_content(
+        self, prompt, generation_config=None, stream=False, cached=None
+    ):
+        if not isinstance(prompt, str):
+            prompt = [vertex_part(part) for part in prompt]
+        model = self.model if cached is None else cached.provider[1]
+        return model.generate_content(
+            prompt, generation_config=generation_config, stream=stream
+        )
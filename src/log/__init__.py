@@ -1,8 +1,12 @@
 
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 import traceback
+from collections import Counter
 from pathlib import Path
 from time import ctime, time
 
@@ -12,6 +16,7 @@ from src.log.format import MarkdownFormatter, epoch_url, markdown_link
 
 LOG_LEVEL = CONFIG("log.level")
 LOG_DIR = CONFIG("log.dir")
+LOG_QUEUE_SIZE = CONFIG("log.queue_size")
 
 def setup_verbose():
     VERBOSE = 15
@@ -37,6 +42,72 @@ def get_log_file_path(module_path, log_dir):
     return Path(new_path)
 
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records as they are, leaving formatting (and image encoding) to the writer thread
+
+    If the bounded queue is full, the record is dropped and counted per level rather than blocking the caller.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = Counter()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped[record.levelname] += 1
+
+
+class Writer(logging.handlers.QueueListener):
+    """Background thread that formats and writes queued records, and logs how many were dropped"""
+
+    def __init__(self, queue, handler, source):
+        super().__init__(queue, handler)
+        self.source = source
+        self.reported = 0
+
+    def handle(self, record):
+        self.report_dropped()
+        super().handle(record)
+
+    def report_dropped(self):
+        total = sum(self.source.dropped.values())
+        if total > self.reported:
+            record = logging.makeLogRecord(
+                {
+                    "levelname": "WARNING",
+                    "levelno": logging.WARNING,
+                    "msg": f"Dropped {total - self.reported} log records because the log queue was full (total by level: {dict(self.source.dropped)})",
+                }
+            )
+            self.reported = total
+            for handler in self.handlers:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Wait for room rather than fail on a full queue
+
+    def stop(self):
+        super().stop()  # Writes out what is still queued
+        self.report_dropped()
+
+
+def queued(handler):
+    """Return a handler that passes records to `handler` on a writer thread, or `handler` itself if the queue is disabled"""
+    if not LOG_QUEUE_SIZE:
+        return handler
+
+    q = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    writer = Writer(q.queue, handler, q)
+    writer.start()
+    atexit.register(writer.stop)
+    return q
+
+
 def setup_logger():
     logger = logging.getLogger(Path(sys.argv[0]).stem)
     logger.setLevel(LOG_LEVEL)
@@ -46,12 +117,13 @@ def setup_logger():
 
     h = logging.FileHandler(log_file_path, mode="a")
     h.setFormatter(MarkdownFormatter(STARTTIME))
-    logger.addHandler(h)
 
     # Write out current time and environment variables
     header = markdown_link(ctime(STARTTIME), epoch_url(STARTTIME))
     h.stream.write(f"# {header}\n")
 
+    logger.addHandler(queued(h))
+
     logger.debug(f"Configuration: {CONFIG}")
 
     return logger
@@ -0,0 +1,215 @@
+"""Print latency histograms and throughput per run from the JSONL event logs written by `src.log.events`"""
+
+from pathlib import Path
+from sys import exit
+
+import numpy as np
+import pandas as pd
+
+from src.config import ConfigArgumentParser
+from src.log import LOG_DIR
+
+BINS = 10
+WIDTH = 40
+
+# Stages of a frame's way from capture to the RAW output it conditioned
+SPANS = {
+    "wait": "Captured until narration started",
+    "narrate": "Narration",
+    "handoff": "FAST output until RAW input",
+    "prompt": "RAW input until the request whose text was output started",
+    "ttft": "Time to first token",
+    "output": "First token until its first char was output",
+    "total": "Captured until first char was output",
+}
+
+
+def read_events(files):
+    frames = [pd.read_json(file, lines=True) for file in files if Path(file).stat().st_size]
+    if not frames:
+        return pd.DataFrame(columns=["event", "session", "source", "pid", "time", "mono"])
+    events = pd.concat(frames, ignore_index=True)
+    # Monotonic clocks are only comparable within a session (one machine, one boot), so order sessions by wall clock
+    start = events.groupby("session")["time"].transform("min")
+    return (
+        events.assign(start=start)
+        .sort_values(["start", "session", "mono"], kind="stable")
+        .drop(columns="start")
+    )
+
+
+def print_histogram(name, values, unit=""):
+    values = pd.Series(values).dropna().astype(float)
+    if values.empty:
+        return
+
+    print(
+        f"  {name}: n={len(values)} mean={values.mean():.3g}{unit} "
+        f"p50={values.quantile(0.5):.3g}{unit} p90={values.quantile(0.9):.3g}{unit} "
+        f"p99={values.quantile(0.99):.3g}{unit} max={values.max():.3g}{unit}"
+    )
+    counts, edges = np.histogram(values, bins=min(BINS, values.nunique()) or 1)
+    top = counts.max()
+    for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+        bar = "#" * round(WIDTH * count / top)
+        print(f"    {lo:8.3g} - {hi:<8.3g}{unit:2} {count:6d} {bar}")
+
+
+def get(events, name, column):
+    selected = events[events["event"] == name]
+    if column not in selected:
+        return pd.Series(dtype=float)
+    return selected[column]
+
+
+def first(events, name, key):
+    """Return the monotonic time of the first `name` event per value of `key`"""
+    selected = events[(events["event"] == name) & events[key].notna()]
+    return selected.drop_duplicates(key).set_index(key)["mono"]
+
+
+def frame_spans(events):
+    """Return the duration of each span in SPANS per traced frame of a session"""
+    columns = ["frame", "request", "captured", "started"]
+    events = events.reindex(
+        columns=list(events.columns) + [c for c in columns if c not in events]
+    )
+
+    narrations = events[(events["event"] == "narration") & events["frame"].notna()]
+    narrations = narrations.drop_duplicates("frame").set_index("frame")
+    writeout = first(events, "writeout", "frame")
+    fast_input = first(events, "fast_input", "frame")
+
+    # Of the requests conditioned on a frame, the first whose text made it to the output
+    starts = events[(events["event"] == "request_start") & events["frame"].notna()]
+    starts = starts.assign(
+        token=starts["request"].map(first(events, "first_token", "request")),
+        char=starts["request"].map(first(events, "first_char", "request")),
+    )
+    starts = starts.dropna(subset=["char"]).drop_duplicates("frame").set_index("frame")
+
+    spans = pd.DataFrame(index=narrations.index.union(starts.index))
+    spans["wait"] = narrations["started"] - narrations["captured"]
+    spans["narrate"] = narrations["mono"] - narrations["started"]
+    spans["handoff"] = fast_input - writeout
+    spans["prompt"] = starts["mono"] - fast_input
+    spans["ttft"] = starts["token"] - starts["mono"]
+    spans["output"] = starts["char"] - starts["token"]
+    spans["total"] = starts["char"] - narrations["captured"]
+    return spans
+
+
+def print_trace(session, events):
+    spans = frame_spans(events)
+    traced = spans["total"].notna().sum()
+    if not traced:
+        return
+
+    print(f"# Frame to RAW output (session {session})")
+    print(f"  {traced} of {len(spans)} frames traced to the RAW output")
+    for span, description in SPANS.items():
+        print_histogram(description, spans[span], "s")
+    print()
+
+
+def print_run(session, source, events):
+    duration = events["mono"].max() - events["mono"].min()
+    print(f"# {source} (session {session}, pid {', '.join(map(str, events['pid'].unique()))})")
+    print(f"  {len(events)} events over {duration:.1f}s")
+
+    counts = events["event"].value_counts()
+    print("  " + ", ".join(f"{name}: {count}" for name, count in counts.items()))
+
+    # RAW
+    ends = events[events["event"] == "request_end"]
+    if len(ends):
+        chars = int(ends["chars"].sum())
+        interrupted = ends["interrupted"].fillna(False).astype(bool).mean()
+        errors = ends["error"].notna().sum() if "error" in ends else 0
+        print(
+            f"  Requests: {len(ends)} ({len(ends) / max(duration, 1e-9) * 60:.1f}/min), "
+            f"{interrupted:.0%} interrupted, {errors} failed"
+        )
+        print(f"  Generated {chars} chars ({chars / max(duration, 1e-9):.1f} chars/s)")
+        if "hedged" in ends:
+            tokens = events[events["event"] == "first_token"]
+            hedged = tokens[tokens["hedged"].fillna(False).astype(bool)]
+            if len(hedged):
+                wins = hedged["model"].value_counts()
+                print(
+                    f"  Hedged {len(hedged)} requests ({len(hedged) / len(ends):.0%}), won by "
+                    + ", ".join(f"{model}: {n / len(hedged):.0%}" for model, n in wins.items())
+                )
+        reasons = get(events, "interrupt", "reason").value_counts()
+        if len(reasons):
+            print("  Interrupted by " + ", ".join(f"{r}: {n}" for r, n in reasons.items()))
+
+    print_histogram("Time to first token", get(events, "first_token", "ttft"), "s")
+    print_histogram("Request duration", ends["duration"] if "duration" in ends else [], "s")
+    print_histogram("Chars per request", ends["chars"] if "chars" in ends else [])
+    print_histogram("Chars per chunk", get(events, "chunk", "chars"))
+    print_histogram("Buffered chars before request", get(events, "raw_buffer", "buffered"))
+    print_histogram("Wait after completion", get(events, "wait", "wait"), "s")
+
+    # SLOW
+    walks = events[events["event"] == "slow_walk"]
+    if len(walks):
+        found = walks["found"].fillna(False).astype(bool).mean()
+        print(f"  SLOW walks: {len(walks)}, {found:.0%} found a nearby thought")
+        print_histogram("SLOW steps", walks["steps"])
+
+    # FAST
+    narrations = events[events["event"] == "narration"]
+    if len(narrations):
+        accepted = narrations["accepted"].fillna(False).astype(bool)
+        dropped = int(narrations["dropped"].sum())
+        print(
+            f"  Narrations: {len(narrations)} ({len(narrations) / max(duration, 1e-9):.2f}/s), "
+            f"{accepted.mean():.0%} accepted, {dropped} frames dropped"
+        )
+        print_histogram("Narration latency", narrations["latency"], "s")
+        print_histogram("Narration novelty", narrations["novelty"])
+
+    print()
+
+
+def main(args):
+    files = args.files or sorted(Path(LOG_DIR).rglob("*.jsonl"))
+    events = read_events(files)
+
+    if args.session:
+        events = events[events["session"] == args.session]
+    if args.last:
+        sessions = events.groupby("session")["time"].min().sort_values()
+        events = events[events["session"].isin(sessions.index[-args.last :])]
+
+    if events.empty:
+        print("No events found")
+        return 1
+
+    for session, runs in events.groupby("session", sort=False):
+        for source, run in runs.groupby("source", sort=False):
+            print_run(session, source, run)
+        print_trace(session, runs)
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ConfigArgumentParser(description=__doc__)
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="JSONL event logs (default: all *.jsonl files in log.dir)",
+    )
+    parser.add_argument("--session", help="Only analyze this session")
+    parser.add_argument(
+        "--last",
+        type=int,
+        default=None,
+        help="Only analyze the last LAST sessions",
+    )
+
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,68 @@
+"""Structured trace of timing events, written as JSONL next to the Markdown log
+
+Each event carries its name, the session id (shared by all processes started with the same `GEDANKENPOLIZEI_SESSION`),
+the source script, wall clock `time` and system-wide `mono`tonic time, so events of different processes can be ordered.
+"""
+
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from time import monotonic, time
+from uuid import uuid4
+
+from src.config import CONFIG
+from src.log import LOG_DIR, get_log_file_path, queued
+
+LOG_EVENTS = CONFIG("log.events")
+
+SESSION = os.environ.setdefault("GEDANKENPOLIZEI_SESSION", uuid4().hex[:12])
+SOURCE = Path(sys.argv[0]).stem
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.event, default=str)
+
+
+def setup_events():
+    logger = logging.getLogger("events")
+    logger.propagate = False  # Keep out of the Markdown log
+    logger.setLevel(logging.INFO)
+
+    if not LOG_EVENTS:
+        logger.disabled = True
+        return logger
+
+    events_file_path = get_log_file_path(sys.argv[0], LOG_DIR).with_suffix(".jsonl")
+    events_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+    h = logging.FileHandler(events_file_path, mode="a")
+    h.setFormatter(JsonFormatter())
+    logger.addHandler(queued(h))
+
+    return logger
+
+
+EVENTS = setup_events()
+
+
+def event(name, **fields):
+    """Record event `name` with JSON-serializable `fields`"""
+    if EVENTS.disabled:
+        return
+    EVENTS.info(
+        name,
+        extra={
+            "event": {
+                "event": name,
+                "session": SESSION,
+                "source": SOURCE,
+                "pid": os.getpid(),
+                "time": time(),
+                "mono": monotonic(),
+                **fields,
+            }
+        },
+    )
@@ -1,8 +1,12 @@
+import hashlib
 import logging
+import os
+from io import BytesIO
 from pathlib import Path
 from time import time
 
 from dateutil.relativedelta import relativedelta
+from PIL import Image
 
 from src.config import CONFIG
 
@@ -12,15 +16,110 @@ LOG_IMAGES = CONFIG("log.images")
 IMAGE_LOG_PATH = Path(LOG_DIR) / "images"
 IMAGE_LOG_PATH.mkdir(parents=True, exist_ok=True)
 
+SWEEP_INTERVAL = 3600.0  # Seconds between sweeps for expired images
+LOW_WATER = 0.9  # Evict down to this fraction of the budget, so we don't sweep on every new image
+
+
+def image_bytes(image):
+    """Return the JPEG bytes of a Frame, a Gemini image or a PIL image"""
+    if hasattr(image, "jpeg"):
+        return image.jpeg()  # Encoded once per Frame
+    if isinstance(getattr(image, "data", None), bytes):
+        return image.data
+    with BytesIO() as f:
+        image.convert("RGB").save(f, "JPEG")
+        return f.getvalue()
+
+
+class ImageStore:
+    """Content-addressed store of logged images, written once as `{sha256}.jpg` no matter how often they are logged
+
+    Logging an image again touches its file, so when the store grows beyond `max_bytes` the least recently logged
+    images are evicted first. Images not logged for `max_age` seconds are evicted too. Both limits are shared by all
+    processes logging to the same directory, but each process only sweeps when it itself wrote enough to exceed them.
+    """
+
+    def __init__(self, path, thumbnail=None, max_bytes=None, max_age=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.thumbnail = thumbnail
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.total = None  # Bytes in the store as of the last sweep plus what we wrote since
+        self.last_sweep = 0.0
+
+    def encode(self, data):
+        if not self.thumbnail:
+            return data
+        image = Image.open(BytesIO(data))
+        image.thumbnail(self.thumbnail, Image.Resampling.LANCZOS)
+        with BytesIO() as f:
+            image.convert("RGB").save(f, "JPEG")
+            return f.getvalue()
+
+    def put(self, image):
+        """Store `image` if it isn't already and return its file"""
+        data = image_bytes(image)
+        file = self.path / f"{hashlib.sha256(data).hexdigest()[:32]}.jpg"
+
+        try:
+            os.utime(file)  # Mark as recently used
+        except FileNotFoundError:
+            data = self.encode(data)
+            temp = file.with_suffix(f".{os.getpid()}.tmp")
+            temp.write_bytes(data)
+            os.replace(temp, file)  # Other processes never see a partial file
+            if self.total is not None:
+                self.total += len(data)
+
+        if self.total is None or time() - self.last_sweep > SWEEP_INTERVAL:
+            self.sweep()
+        elif self.max_bytes and self.total > self.max_bytes:
+            self.sweep()
+
+        return file
+
+    def sweep(self):
+        """Evict expired images, then least recently logged images until we are below budget"""
+        files = []
+        for file in self.path.glob("*.jpg"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+
+        now = time()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, file in files:
+            expired = self.max_age and now - mtime > self.max_age
+            over = self.max_bytes and total > LOW_WATER * self.max_bytes
+            if not (expired or over):
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+
+        self.total = total
+        self.last_sweep = now
+
+
+def image_store():
+    max_size_mb = CONFIG("log.image_store.max_size_mb")
+    max_age_days = CONFIG("log.image_store.max_age_days")
+    return ImageStore(
+        IMAGE_LOG_PATH,
+        thumbnail=CONFIG("log.image_store.thumbnail"),
+        max_bytes=max_size_mb * 2**20 if max_size_mb else None,
+        max_age=max_age_days * 86400 if max_age_days else None,
+    )
+
 
-def dump_image(image, extension="jpg"):
-    file = IMAGE_LOG_PATH / (f"%.8f.{extension}" % time())
-    image.save(file)
-    return file
+IMAGE_STORE = image_store()
 
 
-def markdown_image(image, extension="jpg"):
-    file = dump_image(image, extension)
+def markdown_image(image):
+    file = IMAGE_STORE.put(image)
     relative_path = file.relative_to(Path("."))
     return f"![]({relative_path})"
 
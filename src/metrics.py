@@ -0,0 +1,221 @@
+"""Count Gemini requests, chars, images, latencies, interrupts and SLOW steps per model, and what they cost
+
+Exposed as Prometheus text on http://127.0.0.1:{port}/metrics and/or logged as a stats line every
+`metrics.interval` seconds. Each process (FAST, RAW) keeps its own metrics and serves them on its own port
+(`fast.metrics_port`, `raw.metrics_port`).
+"""
+
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+from src.config import CONFIG
+from src.log import info, warning
+
+INTERVAL = CONFIG("metrics.interval")
+CACHED_COST_FACTOR = CONFIG("gemini.cache.cost_factor")
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+
+
+def billed_chars(text):
+    """Vertex AI bills characters excluding whitespace"""
+    return len(text) - sum(c.isspace() for c in text)
+
+
+def prices(model):
+    """Return the configured cost per image, input char and output char of `model` (a shorthand like `flash`)"""
+    config = CONFIG["gemini"]["model"][model]
+    return (
+        config.get("cost_per_image") or 0.0,
+        config.get("cost_per_input_char") or 0.0,
+        config.get("cost_per_output_char") or 0.0,
+    )
+
+
+def labelstring(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # Cumulative, as in Prometheus
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time()
+        self.counters = defaultdict(float)  # (name, labels) => value
+        self.histograms = {}  # (name, labels) => Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def total(self, name, **match):
+        """Sum counter `name` over all label values that agree with `match`"""
+        with self.lock:
+            return sum(
+                value
+                for (n, labels), value in self.counters.items()
+                if n == name and match.items() <= dict(labels).items()
+            )
+
+    def cost_per_hour(self):
+        return self.total("gemini_cost_dollars_total") / (time() - self.start) * 3600.0
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{labelstring(labels)} {value:g}")
+
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(h.buckets, h.counts):
+                        le = labelstring(labels + (("le", f"{bound:g}"),))
+                        lines.append(f"{name}_bucket{le} {count}")
+                    le = labelstring(labels + (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{le} {h.count}")
+                    lines.append(f"{name}_sum{labelstring(labels)} {h.sum:g}")
+                    lines.append(f"{name}_count{labelstring(labels)} {h.count}")
+
+        lines.append("# TYPE gemini_cost_dollars_per_hour gauge")
+        lines.append(f"gemini_cost_dollars_per_hour {self.cost_per_hour():g}")
+        lines.append("# TYPE uptime_seconds gauge")
+        lines.append(f"uptime_seconds {time() - self.start:g}")
+        return "\n".join(lines) + "\n"
+
+    def stats(self):
+        requests = self.total("gemini_requests_total")
+        errors = self.total("gemini_requests_total", error="true")
+        return (
+            f"Gemini: {requests:.0f} requests ({errors:.0f} failed), "
+            f"{self.total('gemini_input_chars_total'):.0f} input chars, "
+            f"{self.total('gemini_images_total'):.0f} images "
+            f"(cached: {self.total('gemini_cached_input_chars_total'):.0f} chars, "
+            f"{self.total('gemini_cached_images_total'):.0f} images), "
+            f"{self.total('gemini_output_chars_total'):.0f} output chars, "
+            f"${self.total('gemini_cost_dollars_total'):.4f} (${self.cost_per_hour():.2f}/hour)"
+        )
+
+
+METRICS = Metrics()
+
+inc = METRICS.inc
+observe = METRICS.observe
+
+
+def input_size(parts):
+    """Return the billed chars and number of images in a list of prompt parts"""
+    chars = sum(billed_chars(p) for p in parts if isinstance(p, str))
+    images = sum(1 for p in parts if not isinstance(p, str))
+    return chars, images
+
+
+def record_request(
+    model, prompt, output, latency, ttft=None, error=False, cached=None
+):
+    """Count a Gemini request of `model` (a model returned by `src.gemini.gemini()`) and what it cost
+
+    `prompt` is a string or a list of strings and images, `output` is the generated text and `cached` the handle of
+    the cached prefix it was sent with (see `src.gemini.cache`), which includes the system instruction.
+    """
+    parts = [prompt] if isinstance(prompt, str) else prompt
+    input_chars, images = input_size(parts)
+    cached_chars, cached_images = 0, 0
+    if cached is None:
+        input_chars += model.system_chars
+    else:
+        cached_chars, cached_images = input_size(cached.parts)
+        cached_chars += model.system_chars
+    output_chars = billed_chars(output)
+
+    cost_per_image, cost_per_input_char, cost_per_output_char = prices(model.shorthand)
+    cost = (
+        (images + CACHED_COST_FACTOR * cached_images) * cost_per_image
+        + (input_chars + CACHED_COST_FACTOR * cached_chars) * cost_per_input_char
+        + output_chars * cost_per_output_char
+    )
+
+    labels = {"model": model.shorthand}
+    inc("gemini_requests_total", error=str(bool(error)).lower(), **labels)
+    inc("gemini_input_chars_total", input_chars, **labels)
+    inc("gemini_images_total", images, **labels)
+    inc("gemini_cached_input_chars_total", cached_chars, **labels)
+    inc("gemini_cached_images_total", cached_images, **labels)
+    inc("gemini_output_chars_total", output_chars, **labels)
+    inc("gemini_cost_dollars_total", cost, **labels)
+    observe("gemini_request_seconds", latency, **labels)
+    if ttft is not None:
+        observe("gemini_ttft_seconds", ttft, **labels)
+
+
+def handler(metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are too frequent to log
+
+    return Handler
+
+
+def log_stats(metrics, interval):
+    while True:
+        sleep(interval)
+        info(metrics.stats())
+
+
+def start(port=None, interval=INTERVAL):
+    """Serve the metrics on localhost if `port` is set and log a stats line every `interval` seconds if set"""
+    if port:
+        try:
+            server = ThreadingHTTPServer(("127.0.0.1", port), handler(METRICS))
+        except OSError as e:
+            warning(f"Not serving metrics: cannot bind to port {port} ({e})")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    if interval:
+        threading.Thread(target=log_stats, args=(METRICS, interval), daemon=True).start()
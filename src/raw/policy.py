@@ -0,0 +1,282 @@
+"""Request policy for RAW generation: hedged requests, failover, backoff and circuit breakers
+
+A request goes to the primary model. If its first token hasn't arrived by a deadline (a percentile of recent times to
+first token), the same prompt is sent to the hedge model too, and whichever streams first is used. A model whose
+circuit breaker is open after repeated errors is skipped, so requests fail over to the other model.
+"""
+
+import queue
+import threading
+from collections import deque
+from time import monotonic
+
+import numpy as np
+
+from src.gemini.cache import context_cache, split_prefix
+from src.log import info, warning
+from src.metrics import inc, record_request
+from src.retry import backoff
+
+
+class CircuitOpen(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """Open after `threshold` consecutive errors; let a single trial request through after `cooldown` seconds"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.errors = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if monotonic() - self.opened >= self.cooldown:
+                self.opened = monotonic()  # Half open: one trial, then wait another cooldown
+                return True
+            return False
+
+    def succeed(self):
+        with self.lock:
+            self.errors = 0
+            self.opened = None
+
+    def fail(self):
+        with self.lock:
+            self.errors += 1
+            if self.errors >= self.threshold:
+                self.opened = monotonic()
+
+
+class Deadline:
+    """Hedge after the `percentile` of the last `window` times to first token
+
+    Until there are `window // 2` of them, hedge after `initial` seconds.
+    """
+
+    def __init__(self, percentile, window, initial, minimum):
+        self.percentile = percentile
+        self.samples = deque(maxlen=window)
+        self.initial = initial
+        self.minimum = minimum
+
+    def add(self, ttft):
+        self.samples.append(ttft)
+
+    def __call__(self):
+        if len(self.samples) < self.samples.maxlen // 2:
+            return self.initial
+        return max(self.minimum, np.percentile(self.samples, self.percentile))
+
+
+class Attempt:
+    """Stream a request to `model` on a thread, passing chunks on to `inbox` as `(attempt, chunk, error)`
+
+    The stream ends with a `None` chunk or an error. If the model has a context cache, `prefix` is sent from there.
+    """
+
+    def __init__(self, model, prompt, prefix, inbox, policy):
+        self.model = model
+        self.prompt = prompt  # What is sent, without the cached prefix
+        self.prefix = prefix
+        self.cached = None
+        self.inbox = inbox
+        self.policy = policy
+        self.cancelled = threading.Event()
+        self.start = monotonic()
+        self.ttft = None
+        self.texts = []
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            cache = self.policy.caches.get(id(self.model))
+            if cache is not None:
+                self.cached = cache.get(self.prefix)
+                if self.cached is not None:
+                    self.prompt = split_prefix(self.prompt, self.prefix)
+
+            stream = self.model.generate_content(
+                self.prompt, stream=True, cached=self.cached
+            )
+            for chunk in stream:
+                if self.ttft is None:
+                    self.ttft = monotonic() - self.start
+                if self.cancelled.is_set():
+                    stream.close()
+                    break
+                self.texts.append(chunk.text)
+                self.inbox.put((self, chunk, None))
+        except Exception as e:
+            self.policy.finished(self, e)
+            self.inbox.put((self, None, e))
+        else:
+            self.policy.finished(self, None)
+            self.inbox.put((self, None, None))
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class HedgedRequest:
+    """Iterate over the chunks of whichever attempt streams first; `close()` cancels all attempts"""
+
+    def __init__(self, policy, prompt, prefix, models):
+        self.policy = policy
+        self.prompt = prompt
+        self.prefix = prefix
+        self.models = models  # Primary first
+        self.inbox = queue.Queue()
+        self.attempts = [Attempt(models[0], prompt, prefix, self.inbox, policy)]
+        self.model = None  # The winner
+        self.hedged = False
+
+    def hedge(self):
+        self.hedged = True
+        inc("raw_hedges_total")
+        primary, hedge = self.models
+        info(f"No first token from {primary.shorthand} yet: hedging with {hedge.shorthand}")
+        self.attempts.append(
+            Attempt(hedge, self.prompt, self.prefix, self.inbox, self.policy)
+        )
+
+    def first(self):
+        """Wait for the first chunk of any attempt, hedging if the deadline passes, and return it"""
+        deadline = self.attempts[0].start + self.policy.deadline()
+        ended = []
+        while True:
+            timeout = None
+            if len(self.models) > 1 and not self.hedged:
+                timeout = max(0.0, deadline - monotonic())
+            try:
+                attempt, chunk, error = self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                self.hedge()
+                continue
+
+            if chunk is not None:
+                self.model = attempt.model
+                for other in self.attempts:
+                    if other is not attempt:
+                        other.cancel()
+                if self.hedged:
+                    inc("raw_hedge_wins_total", model=attempt.model.shorthand)
+                return attempt, chunk
+
+            # The attempt failed or ended without a chunk
+            ended.append(error)
+            if error is not None and len(self.models) > 1 and not self.hedged:
+                self.hedge()  # Fail over right away
+                continue
+
+            if len(ended) == len(self.attempts):
+                self.model = attempt.model
+                errors = [e for e in ended if e is not None]
+                if len(errors) == len(ended):
+                    raise errors[0]
+                return attempt, None  # Empty reply
+
+    def __iter__(self):
+        try:
+            winner, chunk = self.first()
+            if chunk is None:
+                return
+            yield chunk
+
+            while True:
+                attempt, chunk, error = self.inbox.get()
+                if attempt is not winner:
+                    continue
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        for attempt in self.attempts:
+            attempt.cancel()
+
+
+class Policy:
+    def __init__(
+        self,
+        primary,
+        hedge=None,
+        percentile=90,
+        window=50,
+        initial=2.0,
+        minimum=0.5,
+        breaker_threshold=5,
+        breaker_cooldown=30.0,
+        backoff_base=0.5,
+        backoff_max=30.0,
+    ):
+        self.primary = primary
+        self.hedge = hedge
+        self.deadline = Deadline(percentile, window, initial, minimum)
+        self.breakers = {
+            id(model): CircuitBreaker(breaker_threshold, breaker_cooldown)
+            for model in (primary, hedge)
+            if model is not None
+        }
+        self.caches = {
+            id(model): cache
+            for model in (primary, hedge)
+            if model is not None and (cache := context_cache(model)) is not None
+        }
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = 0  # Consecutive failed requests
+
+    def generate_content(self, prompt, prefix=""):
+        """Stream `prompt`, which starts with the string `prefix`, to the available models, most preferred first"""
+        models = [
+            model
+            for model in (self.primary, self.hedge)
+            if model is not None and self.breakers[id(model)].allow()
+        ]
+        if not models:
+            raise CircuitOpen("All models have open circuit breakers")
+        return HedgedRequest(self, prompt, prefix, models)
+
+    def finished(self, attempt, error):
+        """Account for an attempt that ended, was cancelled or failed"""
+        output = "".join(attempt.texts)
+        record_request(
+            attempt.model,
+            attempt.prompt,
+            output,
+            monotonic() - attempt.start,
+            attempt.ttft,
+            error=error is not None,
+            cached=attempt.cached,
+        )
+
+        if attempt.model is self.primary and attempt.ttft is not None:
+            self.deadline.add(attempt.ttft)  # Also if it lost the race, else the deadline is biased low
+
+        breaker = self.breakers[id(attempt.model)]
+        if attempt.cancelled.is_set():
+            return  # Lost the race or was interrupted: says nothing about the model's health
+        if error is None:
+            breaker.succeed()
+        else:
+            breaker.fail()
+            if breaker.opened is not None:
+                warning(f"Circuit breaker for {attempt.model.shorthand} is open")
+
+    def succeed(self):
+        self.failures = 0
+
+    def fail(self):
+        """Return how long to back off after another failed request"""
+        self.failures += 1
+        return backoff(self.failures - 1, self.backoff_base, self.backoff_max)
@@ -16,23 +16,49 @@ import pandas as pd
 from src import STARTTIME
 from src.config import CONFIG, ConfigArgumentParser
 from src.fast.frame import Frame
-from src.gemini import gemini, read_prompt_file, replace_variables
+from src.gemini import Template, gemini, read_prompt_file
+from src.gemini.budget import Budget
 from src.log import debug, error, info, verbose
+from src.log.events import event
+from src.metrics import inc
+from src.metrics import start as start_metrics
+from src.raw.policy import Policy
 from src.raw.slot import BidirectionalSlot, Slot
 from src.raw.tape import Tape
 
 SYSTEM_PROMPT = read_prompt_file(CONFIG("raw.model.system_prompt_file"))
-PROMPT = read_prompt_file(CONFIG("raw.model.prompt_file"))
-
-MODEL = gemini(
-    CONFIG("raw.model.name"),
-    generation_config={
-        "stop_sequences": CONFIG("raw.model.stop_sequences"),
-        "top_p": CONFIG("raw.model.top_p"),
-        "top_k": CONFIG("raw.model.top_k"),
-        "temperature": CONFIG("raw.model.temperature"),
-    },
-    system_instruction=SYSTEM_PROMPT,
+PROMPT = Template(read_prompt_file(CONFIG("raw.model.prompt_file")))
+METRICS_PORT = CONFIG("raw.metrics_port")
+
+
+def raw_model(shorthand):
+    return gemini(
+        shorthand,
+        generation_config={
+            "stop_sequences": CONFIG("raw.model.stop_sequences"),
+            "top_p": CONFIG("raw.model.top_p"),
+            "top_k": CONFIG("raw.model.top_k"),
+            "temperature": CONFIG("raw.model.temperature"),
+        },
+        system_instruction=SYSTEM_PROMPT,
+    )
+
+
+MODEL = raw_model(CONFIG("raw.model.name"))
+HEDGE_MODEL_NAME = CONFIG("raw.policy.hedge_model")
+HEDGE_MODEL = raw_model(HEDGE_MODEL_NAME) if HEDGE_MODEL_NAME else None
+
+POLICY = Policy(
+    MODEL,
+    HEDGE_MODEL,
+    percentile=CONFIG("raw.policy.hedge_percentile"),
+    window=CONFIG("raw.policy.hedge_window"),
+    initial=CONFIG("raw.policy.hedge_after"),
+    minimum=CONFIG("raw.policy.hedge_min_after"),
+    breaker_threshold=CONFIG("raw.policy.breaker_threshold"),
+    breaker_cooldown=CONFIG("raw.policy.breaker_cooldown"),
+    backoff_base=CONFIG("raw.policy.backoff_base"),
+    backoff_max=CONFIG("raw.policy.backoff_max"),
 )
 
 MAX_FAST_INPUTS = CONFIG("raw.max_fast_inputs")
@@ -40,6 +66,7 @@ MAX_FAST_INPUTS = CONFIG("raw.max_fast_inputs")
 SLOW_PACE = CONFIG("slow.pace")
 
 RAW_MEMORY_SIZE = CONFIG("raw.memory_size")
+MAX_PROMPT_TOKENS = CONFIG("raw.max_prompt_tokens")
 RAW_PACE = CONFIG("raw.pace")
 RAW_JITTER = CONFIG("raw.jitter")
 
@@ -63,8 +90,12 @@ def print_rolling_tape(raw_tape):
 
 def raw_stream(args, raw_tape):
     last = time()
+    lasttag = None
     while True:
-        c = raw_tape.getchar()
+        c, tag = raw_tape.getchar(tagged=True)
+        if tag != lasttag:
+            event("first_char", request=tag)  # First char of a request is about to be output
+            lasttag = tag
 
         dt = time() - last
         target = 1.0 / RAW_PACE
@@ -84,22 +115,25 @@ def slow_stream(args, slowq):
     if args.no_slow_thoughts:
         return
 
-    # Cold start; takes a while to load
-    from src.slow.thought import (
-        sample_nearby_thought,
-        sample_random_thought,
-    )
+    from src.slow.thought import SLOW
+
+    # Cold start: random thoughts are available as soon as the dataset is; walking needs the embedding model too
+    SLOW.start()
 
-    walk = sample_random_thought()
+    walk = SLOW.sample_random_thought()
     slowq.put_downwards(walk.iloc[-1].text, block=False)
 
     while True:
         start, end = slowq.get_from_below(block=True)
 
         if args.random_slow_thoughts:
-            thought = sample_random_thought(walk)
+            thought = SLOW.sample_random_thought(walk)
+        elif not SLOW.isready("bias"):
+            info("SLOW walk not ready yet: sampling a random SLOW thought")
+            event("slow_walk", steps=0, found=False, reason="not ready")
+            thought = SLOW.sample_random_thought(walk)
         else:
-            thought = sample_nearby_thought(walk, start, end)
+            thought = SLOW.sample_nearby_thought(walk, start, end)
 
         slowq.put_downwards(thought.iloc[0].text, block=False)
         walk = pd.concat([walk, thought])
@@ -112,7 +146,7 @@ def fast_thoughts_from(inputs):
             narration = input["narration"]
             yield f"({dt:.1f}s ago) {narration}"
 
-    return "\n".join(gather())
+    return list(gather())
 
 
 def raw_thoughts_from(raw_tape, ttft=float("inf")):
@@ -128,6 +162,7 @@ def raw_thoughts_from(raw_tape, ttft=float("inf")):
         ncontinue = floor(min(nbuffered, nttft))
 
         info(f"RAW tape nbuffered: {nbuffered}, nttft: {nttft:.0f}")
+        event("raw_buffer", buffered=nbuffered, continued=ncontinue)
 
         raw_tape.cut(+ncontinue, keep="left")
         raw_tape.cut(-RAW_MEMORY_SIZE, keep="right")
@@ -164,13 +199,47 @@ def maybe_last_frame(inputs):
         return None
 
 
+def render(slow_thought, fast_thoughts, optional_frame, raw_thoughts):
+    """Render the prompt within MAX_PROMPT_TOKENS
+
+    The system prompt, the prompt itself and the SLOW thought are always sent. The rest of the budget goes to the
+    newest FAST narration, the RAW memory (trimmed from the left), the frame and older FAST narrations, in that order.
+    """
+    budget = Budget(MAX_PROMPT_TOKENS)
+    budget.spend(SYSTEM_PROMPT)
+    budget.spend([text for isvariable, text in PROMPT.segments if not isvariable])
+    budget.spend(slow_thought)
+
+    fast_thoughts = fast_thoughts or []
+    newest = budget.take_newest("fast_thoughts", fast_thoughts[-1:], lambda t: t + "\n")
+    raw_thoughts = budget.take_tail("raw_thoughts", raw_thoughts)
+    optional_frame = budget.take("frame", optional_frame)
+    if newest:
+        older = budget.take_newest("fast_thoughts", fast_thoughts[:-1], lambda t: t + "\n")
+    else:
+        older = []
+        if fast_thoughts:
+            budget.trimmed["fast_thoughts"] = len(fast_thoughts)
+
+    (info if budget.trimmed else debug)(budget.summary())
+
+    fast_thoughts = "\n".join(older + newest) or None
+    prompt = PROMPT.render(
+        SLOW_THOUGHT=slow_thought,
+        FAST_THOUGHTS=fast_thoughts,
+        OPTIONAL_FRAME=optional_frame,
+        RAW_THOUGHTS=raw_thoughts,
+    )
+    return prompt, budget, fast_thoughts, optional_frame
+
+
 def log(prompt, optional_frame, raw_tape, fast_thoughts):
     if optional_frame:
         prompt_text = "".join(str(p) for p in prompt)
         verbose(prompt_text)
         verbose(
-            fast_thoughts.split("\n")[-1] or "",
-            extra={"image": optional_frame._pil_image},
+            (fast_thoughts or "").split("\n")[-1],
+            extra={"image": optional_frame},
         )  # For demo purposes, put the image last
     else:
         verbose(prompt)
@@ -185,6 +254,8 @@ def generate(args, raw_tape, slowq, fastq):
     fast_thoughts = None
     optional_frame = None
     raw_thoughts = None
+    frame_id = None
+    request = 0
 
     while True:
         if new := maybe_new_slow_thought(slowq):
@@ -193,43 +264,65 @@ def generate(args, raw_tape, slowq, fastq):
         if new := maybe_new_fast_inputs(fastq):
             fast_thoughts = fast_thoughts_from(new)
             optional_frame = maybe_last_frame(new)
+            frame_id = new[-1].get("frame_id")  # The newest FAST input conditions this request
 
         raw_thoughts = raw_thoughts_from(raw_tape, ttft)
 
-        prompt = replace_variables(
-            PROMPT,
-            SLOW_THOUGHT=slow_thought,
-            FAST_THOUGHTS=fast_thoughts,
-            OPTIONAL_FRAME=optional_frame,
-            RAW_THOUGHTS=raw_thoughts,
+        prompt, budget, sent_fast_thoughts, sent_frame = render(
+            slow_thought, fast_thoughts, optional_frame, raw_thoughts
         )
 
-        log(prompt, optional_frame, raw_tape, fast_thoughts)
+        log(prompt, sent_frame, raw_tape, sent_fast_thoughts)
 
         interrupted = False
+        request += 1
+        texts = []
+        stream = None
+        event(
+            "request_start",
+            request=request,
+            prompt_chars=sum(len(p) for p in prompt if isinstance(p, str)),
+            image=sent_frame is not None,
+            frame=frame_id,
+            tokens=budget.spent,
+            trimmed=budget.trimmed,
+        )
 
         try:
             t = time()
 
-            stream = MODEL.generate_content(prompt, stream=True)
+            stream = POLICY.generate_content(prompt, prefix=PROMPT.prefix)
 
             for i, chunk in enumerate(stream):
                 if i == 0:
                     ttft = time() - t
-                    info(f"Time to first token: {ttft:.2f}s")
+                    info(f"Time to first token: {ttft:.2f}s ({stream.model.shorthand})")
+                    event(
+                        "first_token",
+                        request=request,
+                        ttft=ttft,
+                        model=stream.model.shorthand,
+                        hedged=stream.hedged,
+                    )
 
                 text = chunk.text
-                raw_tape.puts(text)
+                raw_tape.puts(text, tag=request)
+                texts.append(text)
 
                 debug(f"Chunk {i}: {repr(text)}")
+                event("chunk", request=request, chunk=i, chars=len(text))
 
                 if not fastq.empty():
                     interrupted = True
                     info("Stopping generation for reconditioning on FAST")
+                    event("interrupt", request=request, reason="fast")
+                    inc("raw_interrupts_total", reason="fast")
 
                 if not slowq.down.empty():
                     interrupted = True
                     info("Stopping generation for reconditioning on SLOW")
+                    event("interrupt", request=request, reason="slow")
+                    inc("raw_interrupts_total", reason="slow")
 
                 if interrupted:
                     # Stop streaming immediately to recondition on newly available information from FAST and/or SLOW
@@ -238,9 +331,33 @@ def generate(args, raw_tape, slowq, fastq):
 
         except Exception as e:
             error(f"Exception during generation or streaming: {e}", exc_info=True)
+            event(
+                "request_end",
+                request=request,
+                duration=time() - t,
+                chars=len("".join(texts)),
+                interrupted=interrupted,
+                hedged=stream is not None and stream.hedged,
+                error=type(e).__name__,
+            )
             ttft = float("inf")
+
+            wait = POLICY.fail()
+            info(f"Backing off for {wait:.1f}s")
+            fastq.slumber(wait)  # Wake up on new FAST inputs
             continue
 
+        POLICY.succeed()
+        event(
+            "request_end",
+            request=request,
+            duration=time() - t,
+            chars=len("".join(texts)),
+            interrupted=interrupted,
+            hedged=stream.hedged,
+            error=None,
+        )
+
         if interrupted:
             continue
         else:
@@ -256,6 +373,7 @@ def generate(args, raw_tape, slowq, fastq):
             wait = (nwait / RAW_PACE) * (1.0 - SLOW_PACE)
 
             info(f"Generation completed, waiting max {wait:.1f}s")
+            event("wait", request=request, buffered=nbuffered, wait=wait)
             fastq.slumber(wait)  # Wake up on new FAST inputs
             continue
 
@@ -286,6 +404,7 @@ def fast_stream(args, fastq):
 
         inputs.append(input)
         fastq.put(inputs, block=False)
+        event("fast_input", frame=input.get("frame_id"))
 
 
 def launch(stream, *args, **kwargs):
@@ -296,6 +415,8 @@ def launch(stream, *args, **kwargs):
 
 
 def main(args):
+    start_metrics(METRICS_PORT)
+
     raw_tape = Tape()
     raw = launch(raw_stream, args, raw_tape)
 
@@ -360,9 +481,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    PROMPT = replace_variables(
-        PROMPT, MAYBE_ASCII_ART="ASCII" + " " if args.ascii else None
-    )
+    PROMPT = PROMPT.fill(MAYBE_ASCII_ART="ASCII" + " " if args.ascii else None)
 
     try:
         exit(main(args))
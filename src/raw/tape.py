@@ -5,24 +5,30 @@ import time
 class Tape:
     def __init__(self):
         self.data = []
+        self.tags = []  # Parallel to `data`: where each char came from, e.g. a request id
         self.head = 0
 
         self.lock = threading.RLock()
         self.incoming = threading.Condition(self.lock)  # Note: this is also a Lock
 
-    def puts(self, string):
+    def puts(self, string, tag=None):
         with self.incoming:
             self.data.extend(string)
+            self.tags.extend([tag] * len(string))
             self.incoming.notify_all()
 
-    def getchar(self):
-        """Wait for the next character at the tape head, consume it, and advance the tape one char to the left"""
+    def getchar(self, tagged=False):
+        """Wait for the next character at the tape head, consume it, and advance the tape one char to the left
+
+        If `tagged`, return the character together with the tag it was put with.
+        """
         with self.incoming:
             while True:
                 try:
                     char = self.peek(0)
+                    tag = self.tags[self.head]
                     self.head += 1  # Move the tape head one char to the left
-                    return char
+                    return (char, tag) if tagged else char
                 except IndexError:
                     self.incoming.wait()
 
@@ -50,16 +56,19 @@ class Tape:
         with self.lock:
             if keep == "left":
                 self.data = self.data[: index + self.head]
+                self.tags = self.tags[: index + self.head]
                 if index < 0:
                     self.head = len(self.data)
             elif keep == "right":
                 if index > 0:
                     self.data = self.data[index + self.head :]
+                    self.tags = self.tags[index + self.head :]
                     self.head = 0
                 else:
                     # List indexing semantics depend on sign of index >:(
                     positive = max(index + self.head, 0)
                     self.data = self.data[positive:]
+                    self.tags = self.tags[positive:]
                     self.head = min(-index, self.head)
             else:
                 raise ValueError("`keep` must be 'left' or 'right'")
@@ -0,0 +1,8 @@
+"""Shared helpers for retrying failed requests"""
+
+import random
+
+
+def backoff(attempt, base, maximum):
+    """Exponential backoff with full jitter: a random wait of up to `base * 2**attempt`, capped at `maximum`"""
+    return random.uniform(0, min(maximum, base * 2**attempt))
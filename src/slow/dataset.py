@@ -0,0 +1,127 @@
+"""Read and write the SLOW thoughts dataset: texts with a fixed-size embedding column, their norms and optional search sidecars
+
+The dataset is an uncompressed Arrow IPC (.feather) file written as a single record batch, so the embedding column
+can be memory-mapped and viewed as an (n, d) matrix without copying. Next to it can live a prebuilt IVF index
+(`{file}.ivf.npz`) and k-nearest neighbor graph (`{file}.knn.npy`).
+"""
+
+from os.path import basename
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.config import CONFIG
+from src.slow.index import IVFIndex, dot_blocks
+
+IVF_SUFFIX = ".ivf.npz"
+KNN_SUFFIX = ".knn.npy"
+
+
+def slow_thoughts_file():
+    """Return the dataset's file name, which depends on the embedding model"""
+    embed_model_basename = basename(CONFIG("slow.embed.model.name"))  # E.g. "BAAI/bge-m3" => "bge-m3"
+
+    return CONFIG("slow.reddit.hf_slow_thoughts_file").replace(
+        "{{EMBED_MODEL_BASENAME}}", embed_model_basename
+    )
+
+
+def sidecar(path, suffix):
+    path = Path(path)
+    return path.with_name(path.name + suffix)
+
+
+def slow_table(texts, embeddings, dtype="float32"):
+    """Return an Arrow table with columns `text`, `embedding` (fixed-size list of `dtype`) and `norm`"""
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    n, d = embeddings.shape
+
+    norms = np.linalg.norm(embeddings.astype("float32"), axis=1)
+    values = pa.array(embeddings.reshape(-1), type=pa.from_numpy_dtype(embeddings.dtype))
+
+    return pa.table(
+        {
+            "text": pa.array(list(texts), type=pa.string()),
+            "embedding": pa.FixedSizeListArray.from_arrays(values, d),
+            "norm": pa.array(norms, type=pa.float32()),
+        }
+    )
+
+
+def write_slow_thoughts(table, path):
+    table = table.combine_chunks()
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(1, table.num_rows))
+
+
+def embedding_matrix(column):
+    """View an Arrow (fixed-size) list column as an (n, d) matrix, zero-copy if it is a single uncompressed chunk"""
+    array = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    if len(array) == 0:
+        return np.empty((0, 0), dtype="float32")
+    values = array.flatten().to_numpy(zero_copy_only=False)
+    return values.reshape(len(array), -1)
+
+
+def open_slow_thoughts(path):
+    """Memory-map the slow thoughts dataset at `path` as an Arrow table"""
+    return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+
+def slow_matrix(table):
+    """Return the float32 embedding matrix and norms of a slow thoughts table"""
+    embeddings = embedding_matrix(table["embedding"])
+    if embeddings.dtype != np.float32:
+        embeddings = embeddings.astype("float32")  # E.g. float16 on disk: BLAS wants float32
+
+    if "norm" in table.column_names:
+        norms = table["norm"].to_numpy()
+    else:
+        norms = np.linalg.norm(embeddings, axis=1)
+
+    return embeddings, norms
+
+
+def read_slow_thoughts(path):
+    """Return the slow thoughts as a DataFrame and their float32 embedding matrix
+
+    Also reads the old schema (zstd-compressed, an object column of per-row embedding arrays, no norms).
+    """
+    table = open_slow_thoughts(path)
+    embeddings, norms = slow_matrix(table)
+
+    df = pd.DataFrame({"text": table["text"].to_pandas()})
+    df["embedding"] = list(embeddings)  # Row views into the matrix, not copies
+    df["norm"] = norms
+    return df, embeddings
+
+
+def knn_graph(embeddings, k, blocksize=4096):
+    """Return the indices of the `k` most similar other embeddings of each embedding, most similar first"""
+    n = len(embeddings)
+    k = min(k, n - 1)
+    graph = np.empty((n, k), dtype="int32")
+
+    for start, scores in dot_blocks(embeddings, embeddings, blocksize):
+        rows = np.arange(len(scores))
+        scores[rows, start + rows] = -np.inf  # Not its own neighbor
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        graph[start : start + len(scores)] = np.take_along_axis(top, order, axis=1)
+
+    return graph
+
+
+def write_sidecars(path, embeddings, index=False, knn=0):
+    """Write the optional IVF index and/or k-NN graph next to the dataset at `path` and return their paths"""
+    written = []
+    if index:
+        IVFIndex.build(embeddings).save(sidecar(path, IVF_SUFFIX))
+        written.append(sidecar(path, IVF_SUFFIX))
+    if knn:
+        np.save(sidecar(path, KNN_SUFFIX), knn_graph(embeddings, knn))
+        written.append(sidecar(path, KNN_SUFFIX))
+    return written
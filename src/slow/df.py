@@ -1,77 +1,241 @@
-"""Download or upload slow thoughts dataframe from the HF hub"""
+"""Fetch the slow thoughts dataset from a source (the HF hub or a local directory), or upload it to the HF hub"""
 
+import hashlib
+import json
 import os
-from io import BytesIO
-from os.path import basename
+import shutil
+from pathlib import Path
 
-import pandas as pd
 from dotenv import load_dotenv
-from huggingface_hub import HfApi, hf_hub_download
 
 from src.config import CONFIG, ConfigArgumentParser
-from src.gemini import replace_variables
 from src.log import info
+from src.slow.dataset import IVF_SUFFIX, read_slow_thoughts, slow_thoughts_file
+from src.slow.index import IVFIndex
 
 load_dotenv()
 
 EMBED_MODEL_NAME = CONFIG("slow.embed.model.name")
 
+HF_REPO_ID = CONFIG("slow.reddit.hf_repo_id")
+HF_SLOW_THOUGHTS_FILE = slow_thoughts_file()
 
-def get_hf_slow_thoughts_file():
-    embed_model_basename = basename(EMBED_MODEL_NAME)  # E.g. "BAAI/bge-m3" => "bge-m3"
+SOURCE = CONFIG("slow.dataset.source")
+LOCAL_DIR = CONFIG("slow.dataset.local_dir")
+CACHE_DIR = CONFIG("slow.dataset.cache_dir")
+SHA256 = CONFIG("slow.dataset.sha256")
+OFFLINE = CONFIG("slow.dataset.offline")
 
-    return replace_variables(
-        CONFIG("slow.reddit.hf_slow_thoughts_file"),
-        EMBED_MODEL_BASENAME=embed_model_basename,
-    )
 
+def sha256sum(path, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(blocksize):
+            h.update(block)
+    return h.hexdigest()
 
-HF_API = HfApi()
-HF_REPO_ID = CONFIG("slow.reddit.hf_repo_id")
-HF_SLOW_THOUGHTS_FILE = get_hf_slow_thoughts_file()
 
+def check(path, digest):
+    if digest and sha256sum(path) != digest:
+        raise ValueError(f"{path} does not have SHA-256 digest {digest}")
+    return path
 
-def upload_slow_thoughts(sdf, verbose=False):
-    if verbose:
-        print(
-            f"Uploading {HF_SLOW_THOUGHTS_FILE} to Hugging Face using `HF_TOKEN_WRITE` from .env file"
-        )
 
-    buffer = BytesIO()
-    sdf.to_feather(buffer, compression="zstd")
+class HFSource:
+    """Files in the gated HF dataset repo, downloaded through the HF cache
+
+    Offline, only files already in the HF cache are found, without a metadata request to the hub.
+    """
+
+    def __init__(self, repo_id=HF_REPO_ID, offline=False):
+        self.repo_id = repo_id
+        self.offline = offline
+
+    def fetch(self, filename, digest=None):
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError, LocalEntryNotFoundError
+
+        HF_TOKEN_READ = os.getenv("HF_TOKEN_READ")
+        if not HF_TOKEN_READ and not self.offline:
+            raise ValueError("`HF_TOKEN_READ` token is not set in the .env file")
+
+        try:
+            path = hf_hub_download(
+                repo_id=self.repo_id,
+                filename=filename,
+                repo_type="dataset",
+                token=HF_TOKEN_READ,
+                local_files_only=self.offline,
+            )
+        except (EntryNotFoundError, LocalEntryNotFoundError) as e:
+            raise FileNotFoundError(f"{filename} not found in {self.repo_id}") from e
+
+        return check(Path(path), digest)
+
+
+class LocalSource:
+    """Files in a local directory, e.g. written by `python -m src.slow.reddit.make --local`"""
+
+    def __init__(self, directory=LOCAL_DIR):
+        self.directory = Path(directory)
+
+    def fetch(self, filename, digest=None):
+        path = self.directory / filename
+        if not path.exists():
+            raise FileNotFoundError(f"{filename} not found in {self.directory}")
+        return check(path, digest)
+
+
+class ContentAddressedCache:
+    """Files from an `upstream` source, stored as `blobs/{sha256}` and named by `refs/{filename}`
+
+    A file whose ref (or given digest) points to a blob that is present is returned without asking
+    upstream, so startup doesn't depend on the network. A blob is hashed in full once when stored; later
+    it is trusted as long as its size and mtime match those recorded then, unless verify(full=True).
+    """
+
+    def __init__(self, upstream, directory=CACHE_DIR):
+        self.upstream = upstream
+        self.directory = Path(directory).expanduser()
+
+    def blob(self, digest):
+        return self.directory / "blobs" / digest
+
+    def ref(self, filename):
+        return self.directory / "refs" / filename
+
+    def stamp(self, blob):
+        stat = blob.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def verify(self, digest, full=False):
+        blob = self.blob(digest)
+        stampfile = blob.with_name(blob.name + ".verified")
+        try:
+            if not full and json.loads(stampfile.read_text()) == self.stamp(blob):
+                return True
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        if not blob.exists() or sha256sum(blob) != digest:
+            return False
+        stampfile.write_text(json.dumps(self.stamp(blob)))
+        return True
+
+    def fetch(self, filename, digest=None, refresh=False):
+        """Return the blob of `filename`, asking upstream only if it is not cached (or if `refresh`)"""
+        ref = self.ref(filename)
+        if digest is None and ref.exists() and not refresh:
+            digest = ref.read_text().strip()
+            if not digest:
+                raise FileNotFoundError(f"{filename} is known to be absent upstream")
+
+        if refresh or not (digest and self.blob(digest).exists() and self.verify(digest)):
+            try:
+                digest = self.store(self.upstream.fetch(filename, digest))
+            except FileNotFoundError:
+                self.write_ref(filename, "")  # Don't ask again at every start
+                raise
+
+        self.write_ref(filename, digest)
+        return self.blob(digest)
+
+    def write_ref(self, filename, digest):
+        ref = self.ref(filename)
+        ref.parent.mkdir(parents=True, exist_ok=True)
+        tmp = ref.with_name(ref.name + ".tmp")
+        tmp.write_text(digest)
+        os.replace(tmp, ref)
+
+    def store(self, path):
+        digest = sha256sum(path)
+        blob = self.blob(digest)
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(blob.name + ".tmp")
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, blob)
+        self.verify(digest)
+        return digest
+
+    def refs(self):
+        """Return {filename: digest} of all cached files"""
+        refs = {}
+        for ref in sorted((self.directory / "refs").glob("*")):
+            digest = ref.read_text().strip()
+            if digest and not ref.name.endswith(".tmp"):
+                refs[ref.name] = digest
+        return refs
+
+
+def slow_thoughts_source(source=SOURCE, cache_dir=CACHE_DIR, offline=OFFLINE):
+    if source == "hf":
+        upstream = HFSource(HF_REPO_ID, offline)
+    elif source == "local":
+        upstream = LocalSource(LOCAL_DIR)
+    else:
+        raise ValueError(f"Unknown slow thoughts source `{source}`: use `hf` or `local`")
+
+    return ContentAddressedCache(upstream, cache_dir) if cache_dir else upstream
+
+
+def upload_slow_thoughts(files, verbose=False):
+    """Upload the slow thoughts dataset file followed by its sidecars (index, k-NN graph), if any"""
+    from huggingface_hub import HfApi
 
     HF_TOKEN_WRITE = os.getenv("HF_TOKEN_WRITE")
     if not HF_TOKEN_WRITE:
         raise ValueError("HF_TOKEN_WRITE not found in .env file")
 
-    commitinfo = HF_API.upload_file(
-        path_or_fileobj=buffer,
-        path_in_repo=HF_SLOW_THOUGHTS_FILE,
-        repo_id=HF_REPO_ID,
-        repo_type="dataset",
-        token=HF_TOKEN_WRITE,
-    )
+    dataset = files[0]
+    for file in files:
+        path_in_repo = HF_SLOW_THOUGHTS_FILE + str(file)[len(str(dataset)) :]
+        if verbose:
+            print(
+                f"Uploading {file} to Hugging Face as {path_in_repo} using `HF_TOKEN_WRITE` from .env file"
+            )
 
-    if verbose:
-        print(f"Uploaded {args.upload}. Additional commit information:")
-        print(commitinfo)
+        commitinfo = HfApi().upload_file(
+            path_or_fileobj=str(file),
+            path_in_repo=path_in_repo,
+            repo_id=HF_REPO_ID,
+            repo_type="dataset",
+            token=HF_TOKEN_WRITE,
+        )
 
+        if verbose:
+            print(f"Uploaded {file}. Additional commit information:")
+            print(commitinfo)
 
-def download_slow_thoughts():
-    HF_TOKEN_READ = os.getenv("HF_TOKEN_READ")
-    if not HF_TOKEN_READ:
-        raise ValueError("`HF_TOKEN_READ` token is not set in the .env file")
 
-    # Retrieve the file from HF or cache
-    downloaded_file_path = hf_hub_download(
-        repo_id=HF_REPO_ID,
-        filename=HF_SLOW_THOUGHTS_FILE,
-        repo_type="dataset",
-        use_auth_token=HF_TOKEN_READ,
-    )
+def fetch_index(source, embeddings):
+    """Return the IVF index published with the dataset, or None"""
+    try:
+        return IVFIndex.load(source.fetch(HF_SLOW_THOUGHTS_FILE + IVF_SUFFIX), embeddings)
+    except FileNotFoundError:
+        return None
+
+
+def download_slow_thoughts(source=None):
+    """Return the slow thoughts, their embedding matrix and IVF index (None if not published)"""
+    source = source or slow_thoughts_source()
+
+    path = source.fetch(HF_SLOW_THOUGHTS_FILE, SHA256)
+    slowdf, embeddings = read_slow_thoughts(path)
+
+    return slowdf, embeddings, fetch_index(source, embeddings)
+
+
+def __getattr__(name):
+    """Download and export SLOWDF, EMBEDDINGS and INDEX on first access (takes a while)"""
+    if name not in ("SLOWDF", "EMBEDDINGS", "INDEX"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    global SLOWDF, EMBEDDINGS, INDEX
+    SLOWDF, EMBEDDINGS, INDEX = download_slow_thoughts()
+    info(f"Loaded {len(SLOWDF)} slow thoughts")
+    return globals()[name]
 
-    slowdf = pd.read_feather(downloaded_file_path)
-    return slowdf
 
 def _embedding_model_exists():
     """Validate the embedding model specified in config"""
@@ -89,14 +253,46 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--upload",
-        help="Interactively upload a .feather file containing slow thoughts to the HF hub",
+        nargs="+",
+        help="Interactively upload a .feather file containing slow thoughts, followed by its sidecars if any, to the HF hub",
+    )
+    parser.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Fetch the dataset and its sidecars from `slow.dataset.source` into the cache, replacing cached versions",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the SHA-256 digests of all cached files in full",
     )
 
     args = parser.parse_args()
 
-    if args.upload:
-        df = pd.read_feather(args.upload)
+    if args.fetch or args.verify:
+        source = slow_thoughts_source()
+        if not isinstance(source, ContentAddressedCache):
+            print("No cache: set `slow.dataset.cache_dir`")
+            exit(1)
+
+    if args.fetch:
+        for filename in [HF_SLOW_THOUGHTS_FILE, HF_SLOW_THOUGHTS_FILE + IVF_SUFFIX]:
+            try:
+                blob = source.fetch(filename, refresh=True)
+                print(f"{filename}: {blob.name}")
+            except FileNotFoundError:
+                print(f"{filename}: not found upstream")
+
+    if args.verify:
+        ok = True
+        for filename, digest in source.refs().items():
+            verified = source.verify(digest, full=True)
+            ok &= verified
+            print(f"{filename}: {digest} {'OK' if verified else 'FAILED'}")
+        if not ok:
+            exit(1)
 
+    if args.upload:
         if not _embedding_model_exists():
             print(
                 f"Config specifies an embedding model {EMBED_MODEL_NAME} that cannot be loaded"
@@ -104,19 +300,16 @@ if __name__ == "__main__":
             exit(1)
 
         a = input(
-            f"Assuming {args.upload} used the following embedding model: {EMBED_MODEL_NAME}. Correct? (y/N)"
+            f"Assuming {args.upload[0]} used the following embedding model: {EMBED_MODEL_NAME}. Correct? (y/N)"
         )
         if a.lower() != "y":
             exit(1)
 
         a = input(
-            f"Upload {args.upload} to HF as file {HF_REPO_ID}/{HF_SLOW_THOUGHTS_FILE}? (y/N)"
+            f"Upload {' '.join(args.upload)} to HF as file {HF_REPO_ID}/{HF_SLOW_THOUGHTS_FILE}? (y/N)"
         )
         if a.lower() != "y":
             exit(1)
 
-        upload_slow_thoughts(df, verbose=True)
-else:
-    # Download and export the dataframe for use in other modules (takes a while)
-    SLOWDF = download_slow_thoughts()
-    info(f"Loaded {len(SLOWDF)} slow thoughts")
+        upload_slow_thoughts(args.upload, verbose=True)
+
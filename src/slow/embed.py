@@ -1,55 +1,77 @@
 """Embedding algebra"""
 
-import sys
+from itertools import islice
 
 import numpy as np
-import torch
 from numpy.linalg import norm
-from sentence_transformers import SentenceTransformer
 
 from src.config import CONFIG
 from src.log import info
+from src.slow.embedder import BATCH_SIZE, NUM_THREADS, Embedder
+from src.slow.service import service_client
 
 NAME = CONFIG("slow.embed.model.name")
-MODEL = SentenceTransformer(NAME)
-DIMENSION = MODEL.get_sentence_embedding_dimension()
 
-info(f"Loaded {NAME} embedding model with dimension {DIMENSION}")
+# Client mode: delegate embedding to the shared service (`python -m src.slow.service`) instead of loading the model
+CLIENT = service_client()
 
+if CLIENT is None:
+    MODEL = Embedder(NAME)
+    DIMENSION = MODEL.dimension
+    MAX_SEQ_LENGTH = MODEL.max_seq_length
+else:
+    MODEL = None
+    health = CLIENT.health()
+    if health["model"] != NAME:
+        raise ValueError(
+            f"Embedding service at {CLIENT.url} serves {health['model']}, not {NAME}"
+        )
+    DIMENSION = health["dimension"]
+    MAX_SEQ_LENGTH = health["max_seq_length"]
 
-def zero():
-    return np.zeros(DIMENSION)
-
-
-def tokenize_last(text, truncation_length):
-    """Tokenize and truncate to the LAST part of the text"""
-    # We use the `truncation=True` and `max_length=sys.maxsize` trick to avoid an harmless log warning
-    tokens = MODEL.tokenizer(
-        text, padding=True, truncation=True, max_length=sys.maxsize, return_tensors="pt"
-    )
+    info(f"Using {NAME} embedding model with dimension {DIMENSION} served at {CLIENT.url}")
 
-    truncated = {k: v[..., -truncation_length:] for k, v in tokens.items()}
 
-    return truncated
+def zero():
+    return np.zeros(DIMENSION)
 
 
-def embed(text, truncation_length=MODEL.max_seq_length):
+def embed(text, truncation_length=MAX_SEQ_LENGTH):
     """Embed a single text or list (batch) of texts
 
     Note: we don't use the SentenceTransformer.encode() interface for two reasons:
         * It doesn't support truncation to the last part of the text
         * It's so much slower on my CPU for some reason. Batching also makes much less sense for CPU
     """
-    is_batch = isinstance(text, list)
+    if CLIENT is not None:
+        is_batch = isinstance(text, list)
+        embedding = CLIENT.embed(text if is_batch else [text], truncation_length)
+        return embedding if is_batch else embedding[0]
+
+    return MODEL.embed(text, truncation_length)
 
-    tokens = tokenize_last(text, truncation_length)
 
-    with torch.no_grad():  # https://github.com/UKPLab/sentence-transformers/issues/742#issuecomment-772757207
-        model_output = MODEL(tokens)
+def embed_many(
+    texts,
+    truncation_length=MAX_SEQ_LENGTH,
+    batch_size=BATCH_SIZE,
+    num_threads=NUM_THREADS,
+    bucket_size=1024,
+):
+    """Embed an iterable of texts in padded batches and yield their embeddings in order
 
-    embedding = model_output["sentence_embedding"]
-    embedding = embedding if is_batch else embedding.squeeze(0)
-    return embedding.numpy()
+    Texts are read in buckets of `bucket_size` and sorted by token length within each bucket, so each batch
+    is padded to the length of similarly long texts only. Each text is truncated to its LAST part just as in embed().
+    """
+    if CLIENT is not None:
+        texts = iter(texts)
+        while bucket := list(islice(texts, bucket_size)):
+            yield from CLIENT.embed(bucket, truncation_length)
+        return
+
+    yield from MODEL.embed_many(
+        texts, truncation_length, batch_size, num_threads, bucket_size
+    )
 
 
 def compute_bias_matrix(overall_multiplier, directions):
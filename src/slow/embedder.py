@@ -0,0 +1,101 @@
+"""The embedding model, loaded in this process
+
+`src.slow.embed` uses it unless `slow.service.url` is set; the service (`src.slow.service`) always uses it.
+"""
+
+import os
+import sys
+from itertools import islice
+
+import numpy as np
+
+from src.config import CONFIG
+from src.log import info
+
+NAME = CONFIG("slow.embed.model.name")
+
+BATCH_SIZE = CONFIG("slow.embed.batch_size")
+NUM_THREADS = CONFIG("slow.embed.num_threads")
+
+
+class Embedder:
+    def __init__(self, name=NAME):
+        if CONFIG("slow.dataset.offline"):
+            os.environ.setdefault("HF_HUB_OFFLINE", "1")  # Only load the model from the HF cache
+
+        from sentence_transformers import SentenceTransformer
+
+        self.name = name
+        self.model = SentenceTransformer(name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.max_seq_length = self.model.max_seq_length
+
+        info(f"Loaded {name} embedding model with dimension {self.dimension}")
+
+    def tokenize_last(self, text, truncation_length):
+        """Tokenize and truncate to the LAST part of the text"""
+        # We use the `truncation=True` and `max_length=sys.maxsize` trick to avoid an harmless log warning
+        tokens = self.model.tokenizer(
+            text, padding=True, truncation=True, max_length=sys.maxsize, return_tensors="pt"
+        )
+
+        truncated = {k: v[..., -truncation_length:] for k, v in tokens.items()}
+
+        return truncated
+
+    def embed(self, text, truncation_length=None):
+        """Embed a single text or list (batch) of texts; see `src.slow.embed.embed()`"""
+        import torch
+
+        truncation_length = truncation_length or self.max_seq_length
+        is_batch = isinstance(text, list)
+
+        tokens = self.tokenize_last(text, truncation_length)
+
+        with torch.no_grad():  # https://github.com/UKPLab/sentence-transformers/issues/742#issuecomment-772757207
+            model_output = self.model(tokens)
+
+        embedding = model_output["sentence_embedding"]
+        embedding = embedding if is_batch else embedding.squeeze(0)
+        return embedding.numpy()
+
+    def embed_many(
+        self,
+        texts,
+        truncation_length=None,
+        batch_size=BATCH_SIZE,
+        num_threads=NUM_THREADS,
+        bucket_size=1024,
+    ):
+        """Embed an iterable of texts in padded batches and yield their embeddings in order; see `src.slow.embed.embed_many()`"""
+        import torch
+
+        truncation_length = truncation_length or self.max_seq_length
+        texts = iter(texts)
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        while bucket := list(islice(texts, bucket_size)):
+            # Same `max_length=sys.maxsize` trick as in tokenize_last()
+            tokens = self.model.tokenizer(bucket, truncation=True, max_length=sys.maxsize)
+            features = [
+                {k: v[i][-truncation_length:] for k, v in tokens.items()}
+                for i in range(len(bucket))
+            ]
+
+            order = sorted(range(len(bucket)), key=lambda i: len(features[i]["input_ids"]))
+            embeddings = np.empty((len(bucket), self.dimension), dtype="float32")
+
+            for start in range(0, len(order), batch_size):
+                batch = order[start : start + batch_size]
+                padded = self.model.tokenizer.pad(
+                    [features[i] for i in batch], padding=True, return_tensors="pt"
+                )
+
+                with torch.no_grad():
+                    model_output = self.model(padded)
+
+                embeddings[batch] = model_output["sentence_embedding"].numpy()
+
+            yield from embeddings
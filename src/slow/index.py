@@ -0,0 +1,99 @@
+"""Approximate nearest neighbor search over normalized embeddings"""
+
+import numpy as np
+
+
+def dot_blocks(X, Y, blocksize=65536):
+    """Yield (start, X[start:start+blocksize] @ Y.T) to bound memory use"""
+    for start in range(0, len(X), blocksize):
+        yield start, X[start : start + blocksize] @ Y.T
+
+
+class IVFIndex:
+    """Inverted file index: embeddings are bucketed by their nearest k-means centroid
+
+    A query is compared to the centroids first, and then only to the embeddings in the `nprobe` closest
+    buckets, which makes a search roughly O(sqrt(N)) rather than O(N) for `nlist` ~ sqrt(N).
+    Assumes normalized embeddings, so that nearest means largest dot product.
+    """
+
+    def __init__(self, centroids, lists, embeddings, nprobe=16):
+        self.centroids = centroids
+        self.lists = lists
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(
+        cls,
+        embeddings,
+        nlist=None,
+        nprobe=16,
+        iterations=10,
+        numtrain=65536,
+        seed=0,
+    ):
+        embeddings = np.asarray(embeddings, dtype="float32")
+        n = len(embeddings)
+        if n == 0:
+            dimension = embeddings.shape[1] if embeddings.ndim == 2 else 0
+            return cls(np.empty((0, dimension), dtype="float32"), [], embeddings, nprobe)
+
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+
+        # Spherical k-means on a subsample
+        train = embeddings[rng.choice(n, size=min(n, numtrain), replace=False)]
+        centroids = train[rng.choice(len(train), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, train)
+            norms = np.linalg.norm(sums, axis=1)
+            nonempty = norms > 0
+            centroids[nonempty] = sums[nonempty] / norms[nonempty, None]
+
+        assignment = np.empty(n, dtype="int64")
+        for start, scores in dot_blocks(embeddings, centroids):
+            assignment[start : start + len(scores)] = np.argmax(scores, axis=1)
+
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        lists = [order[bounds[c] : bounds[c + 1]] for c in range(nlist)]
+
+        return cls(centroids, lists, embeddings, nprobe)
+
+    def search(self, query, k):
+        """Return the positions and scores of (approximately) the `k` nearest embeddings to `query`, nearest first"""
+        query = np.asarray(query, dtype="float32")
+        if not self.lists:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+        nprobe = min(self.nprobe, len(self.lists))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        positions = np.concatenate([self.lists[c] for c in probe])
+        scores = self.embeddings[positions] @ query
+
+        k = min(k, len(positions))
+        if k == 0:
+            return positions, scores
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return positions[top], scores[top]
+
+    def save(self, path):
+        np.savez(
+            path,
+            centroids=self.centroids,
+            assignment_order=np.concatenate([np.empty(0, dtype="int64"), *self.lists]),
+            list_sizes=np.array([len(l) for l in self.lists]),
+            nprobe=self.nprobe,
+        )
+
+    @classmethod
+    def load(cls, path, embeddings):
+        data = np.load(path)
+        bounds = np.concatenate([[0], np.cumsum(data["list_sizes"])])
+        order = data["assignment_order"]
+        lists = [order[bounds[c] : bounds[c + 1]] for c in range(len(bounds) - 1)]
+        return cls(data["centroids"], lists, embeddings, int(data["nprobe"]))
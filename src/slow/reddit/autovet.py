@@ -0,0 +1,175 @@
+"""Concurrent, rate-limited autovetting engine"""
+
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+
+import pandas as pd
+
+from src.retry import backoff
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second on average with bursts of `capacity`"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class AutoVetter:
+    """Run `work(item)` over items with bounded concurrency, a requests-per-minute quota and retries
+
+    Each attempt takes one token from the rate limiter. Errors are retried with exponential backoff,
+    except for `fatal` errors, which are deterministic (such as unparseable predictions).
+    """
+
+    def __init__(
+        self,
+        rpm,
+        concurrency,
+        max_retries,
+        backoff_base=1.0,
+        backoff_max=60.0,
+        fatal=(ValueError,),
+    ):
+        self.limiter = TokenBucket(rpm / 60.0, capacity=concurrency)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.fatal = fatal
+
+    def attempt(self, work, item):
+        for i in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                return work(item)
+            except self.fatal:
+                raise
+            except Exception:
+                if i == self.max_retries:
+                    raise
+                sleep(backoff(i, self.backoff_base, self.backoff_max))
+
+    def map(self, items, work):
+        """Yield `(item, result)` pairs in order of completion, where `result` may be the raised exception
+
+        Items are drawn lazily from `items`, at most `concurrency` at a time, so the caller can keep
+        sampling fresh items while earlier ones are in flight.
+        """
+        items = iter(items)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+
+            def submit():
+                for item in items:
+                    futures[executor.submit(self.attempt, work, item)] = item
+                    if len(futures) >= self.concurrency:
+                        break
+
+            submit()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = futures.pop(future)
+                    try:
+                        yield item, future.result()
+                    except Exception as e:
+                        yield item, e
+                submit()
+
+
+class ResultBuffer:
+    """Collect `(name, score)` results and hand them to `flush(df)` as a DataFrame in batches of `size`"""
+
+    def __init__(self, size, flush):
+        self.size = size
+        self.on_flush = flush
+        self.names = []
+        self.scores = []
+
+    def add(self, name, score):
+        self.names.append(name)
+        self.scores.append(score)
+        if len(self.names) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.names:
+            return
+        df = pd.DataFrame({"score": self.scores}, index=pd.Index(self.names, name="id"))
+        self.names, self.scores = [], []
+        self.on_flush(df)
+
+
+if __name__ == "__main__":
+    from sys import exit
+    from time import time
+
+    from tqdm import tqdm
+
+    from src.config import CONFIG, ConfigArgumentParser
+    from src.gemini import Template, gemini, read_prompt_file
+
+    parser = ConfigArgumentParser(
+        description="Benchmark the autovetting engine on made-up posts, e.g. against the fake Gemini with `--config gemini.backend:fake`"
+    )
+    parser.add_argument("-n", type=int, default=1000, help="Number of posts")
+    parser.add_argument("--rpm", type=float, default=1000.0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-retries", type=int, default=5)
+
+    args = parser.parse_args()
+
+    prompt = Template(read_prompt_file(CONFIG("slow.reddit.vet_prompt_file")))
+    model = gemini(CONFIG("slow.reddit.model.name"))
+
+    def vet(post):
+        query = prompt.render(
+            POST=f"Post number {post}", OPTIONALLY_EXPLAIN=None, OPTIONAL_EXAMPLES=None
+        )
+        reply = model.generate_content(
+            query, generation_config={"max_output_tokens": 1}
+        ).text.strip()
+        if reply not in ("GOOD", "BAD"):
+            raise ValueError(f"Unknown prediction `{reply}`")
+        return 1 if reply == "GOOD" else -1
+
+    vetter = AutoVetter(args.rpm, args.concurrency, args.max_retries, backoff_base=0.1)
+    flushed = []
+    buffer = ResultBuffer(100, flushed.append)
+
+    t = time()
+    errors = 0
+    for post, result in tqdm(vetter.map(range(args.n), vet), total=args.n):
+        errors += isinstance(result, Exception)
+        buffer.add(post, 0 if isinstance(result, Exception) else result)
+    buffer.flush()
+    dt = time() - t
+
+    df = pd.concat(flushed)
+    print(f"Vetted {len(df)} posts in {dt:.1f}s ({60 * len(df) / dt:.0f} RPM), {errors} failed after retries")
+    print(df["score"].value_counts())
+
+    exit(0)
@@ -0,0 +1,230 @@
+"""Train a local GOOD/BAD classifier on post embeddings from vet files and report its calibration"""
+
+from sys import exit
+
+import numpy as np
+import pandas as pd
+
+from src.config import CONFIG, ConfigArgumentParser
+from src.slow.reddit.journal import read_vet
+from src.slow.reddit.store import read_posts
+
+EMBED_MODEL_NAME = CONFIG("slow.embed.model.name")
+
+REJECT_BELOW = CONFIG("slow.reddit.classifier.reject_below")
+ACCEPT_ABOVE = CONFIG("slow.reddit.classifier.accept_above")
+
+
+def sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+class Classifier:
+    """L2-regularized logistic regression p(GOOD|embedding)
+
+    Fitted with Newton's method, which is cheap for bge-sized embeddings (a few hundred dimensions).
+    The labeled embeddings are kept with the fit, so that training on a new vet file refits on all labels seen so far.
+    """
+
+    def __init__(self, dimension, l2=1.0):
+        self.w = np.zeros(dimension + 1)  # Last coefficient is the intercept
+        self.l2 = l2
+        self.X = np.empty((0, dimension))
+        self.y = np.empty(0)
+        self.ids = np.empty(0, dtype=str)
+
+    @property
+    def numtrained(self):
+        return len(self.y)
+
+    @staticmethod
+    def design(X):
+        return np.hstack([X, np.ones((len(X), 1))])
+
+    def predict_proba(self, X):
+        X = np.atleast_2d(X)
+        return sigmoid(self.design(X) @ self.w)
+
+    def add(self, X, y, ids):
+        """Add labeled embeddings; posts that were labeled before keep their first label"""
+        ids = np.asarray(ids, dtype=str)
+        new = ~np.isin(ids, self.ids)
+        self.X = np.concatenate([self.X, X[new]])
+        self.y = np.concatenate([self.y, y[new]])
+        self.ids = np.concatenate([self.ids, ids[new]])
+        return new.sum()
+
+    def forget(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=str))
+        self.X, self.y, self.ids = self.X[keep], self.y[keep], self.ids[keep]
+
+    def fit(self, iterations=20, tol=1e-6):
+        """Fit on all labels added so far, starting from the previous fit to save iterations"""
+        A, y = self.design(self.X), self.y
+        penalty = self.l2 * np.eye(A.shape[1])
+        penalty[-1, -1] = 0.0  # Don't regularize the intercept
+
+        for _ in range(iterations):
+            p = sigmoid(A @ self.w)
+            gradient = A.T @ (p - y) + penalty @ self.w
+            hessian = (A.T * (p * (1 - p))) @ A + penalty
+            step = np.linalg.solve(hessian, gradient)
+            self.w -= step
+            if np.abs(step).max() < tol:
+                break
+
+        return self
+
+    def decide(self, embedding, reject_below=REJECT_BELOW, accept_above=ACCEPT_ABOVE):
+        """Return a score of +1 or -1 if the classifier is confident enough, else None"""
+        p = self.predict_proba(embedding)[0]
+        if p >= accept_above:
+            return 1
+        if p <= reject_below:
+            return -1
+        return None
+
+    def save(self, path):
+        np.savez(
+            path,
+            w=self.w,
+            l2=self.l2,
+            X=self.X,
+            y=self.y,
+            ids=self.ids,
+            embed_model_name=EMBED_MODEL_NAME,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        if str(data["embed_model_name"]) != EMBED_MODEL_NAME:
+            raise ValueError(
+                f"Classifier {path} was trained on {data['embed_model_name']} embeddings, not {EMBED_MODEL_NAME}"
+            )
+        if "ids" not in data:
+            raise ValueError(
+                f"Classifier {path} does not keep the labels it was trained on: retrain it from all vet files"
+            )
+        classifier = cls(len(data["w"]) - 1, float(data["l2"]))
+        classifier.w = data["w"]
+        classifier.X, classifier.y, classifier.ids = data["X"], data["y"], data["ids"]
+        return classifier
+
+
+def read_labels(postfile, vetfiles):
+    """Return embeddings X and labels y (1 => GOOD, 0 => BAD) of vetted posts, ignoring undecided ones"""
+    vdf = pd.concat([read_vet(vetfile) for vetfile in vetfiles])
+    vdf = vdf[~vdf.index.duplicated(keep="first")]
+    vdf = vdf[vdf["score"] != 0]
+
+    pdf = read_posts(postfile, columns=["embedding"])
+    pdf = pdf[pdf.index.isin(vdf.index)]
+    vdf = vdf.loc[pdf.index]
+
+    X = np.stack(pdf["embedding"]).astype("float64")
+    y = (vdf["score"].to_numpy() == 1).astype("float64")
+    return X, y, pdf.index
+
+
+def report(classifier, X, y, numbins=10):
+    """Print calibration and the effect of the auto-accept/reject thresholds on held-out labels"""
+    p = classifier.predict_proba(X)
+    eps = 1e-12
+
+    print(f"Held-out posts: {len(y)} ({y.mean():.1%} GOOD)")
+    print(f"Accuracy at 0.5: {((p >= 0.5) == y).mean():.3f}")
+    print(f"Brier score: {np.mean((p - y) ** 2):.4f}")
+    print(
+        f"Log loss: {-np.mean(y * np.log(p + eps) + (1 - y) * np.log(1 - p + eps)):.4f}"
+    )
+
+    print("Reliability (predicted vs. observed p(GOOD)):")
+    bins = np.minimum((p * numbins).astype(int), numbins - 1)
+    ece = 0.0
+    for b in range(numbins):
+        inbin = bins == b
+        if not inbin.any():
+            continue
+        predicted, observed = p[inbin].mean(), y[inbin].mean()
+        ece += inbin.mean() * abs(predicted - observed)
+        print(
+            f"  [{b / numbins:.1f}, {(b + 1) / numbins:.1f}): n = {inbin.sum():5d}, predicted = {predicted:.3f}, observed = {observed:.3f}"
+        )
+    print(f"Expected calibration error: {ece:.4f}")
+
+    accept, reject = p >= ACCEPT_ABOVE, p <= REJECT_BELOW
+    print(
+        f"Auto-accepted (p >= {ACCEPT_ABOVE}): {accept.mean():.1%}, of which {y[accept].mean() if accept.any() else np.nan:.1%} GOOD"
+    )
+    print(
+        f"Auto-rejected (p <= {REJECT_BELOW}): {reject.mean():.1%}, of which {1 - y[reject].mean() if reject.any() else np.nan:.1%} BAD"
+    )
+    print(f"Sent to Gemini: {1 - accept.mean() - reject.mean():.1%}")
+
+
+def main(args):
+    try:
+        classifier = Classifier.load(args.model)
+        print(f"Loaded {args.model} (trained on {classifier.numtrained})")
+    except FileNotFoundError:
+        classifier = None
+
+    holdout = None
+    if args.holdout:
+        holdout = read_labels(args.postfile, [args.holdout])
+
+    if args.train:
+        X, y, ids = read_labels(args.postfile, args.train)
+        if classifier is None:
+            classifier = Classifier(X.shape[1], l2=args.l2)
+
+        if holdout is not None:
+            keep = ~ids.isin(holdout[2])
+            X, y, ids = X[keep], y[keep], ids[keep]
+            classifier.forget(holdout[2])
+
+        numnew = classifier.add(X, y, ids)
+        print(
+            f"Training on {classifier.numtrained} vetted posts ({numnew} new, {classifier.y.mean():.1%} GOOD)"
+        )
+        classifier.fit()
+        classifier.save(args.model)
+        print(f"Saved to {args.model}")
+
+    if classifier is None:
+        print(f"No classifier found at {args.model}: use --train")
+        return 1
+
+    if holdout is not None:
+        report(classifier, holdout[0], holdout[1])
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ConfigArgumentParser(description=__doc__)
+
+    parser.add_argument("postfile", help="Posts store directory (or .feather file)")
+    parser.add_argument("model", help="Classifier .npz file to train or evaluate")
+    parser.add_argument(
+        "--train",
+        nargs="+",
+        default=[],
+        help="Train on one or more vet .feather files together with the labels {model} was trained on, if it exists",
+    )
+    parser.add_argument(
+        "--holdout",
+        default=None,
+        help="Vet .feather file with human labels to report calibration on (excluded from training)",
+    )
+    parser.add_argument(
+        "--l2",
+        type=float,
+        default=1.0,
+        help="L2 regularization strength for a new classifier (default: %(default)s)",
+    )
+
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -0,0 +1,187 @@
+"""Find near-duplicate posts (reposts, cross-posts, copypasta) in normalized submissions"""
+
+import re
+import zlib
+from sys import exit
+
+import numpy as np
+import pandas as pd
+
+from src.config import CONFIG, ConfigArgumentParser
+
+JACCARD_THRESHOLD = CONFIG("slow.reddit.dedup.jaccard_threshold")
+COSINE_THRESHOLD = CONFIG("slow.reddit.dedup.cosine_threshold")
+
+NUM_PERM = 128
+BANDS = 16  # Of NUM_PERM // BANDS = 8 rows each: pairs with Jaccard similarity >~ (1/16)**(1/8) = 0.71 become candidates
+PRIME = 4294967311  # Smallest prime > 2**32
+
+
+def shingles(text, k=3, pattern=re.compile(r"\w+")):
+    """Set of word k-grams of the lowercased text, ignoring punctuation and whitespace"""
+    words = pattern.findall(text.lower())
+    if len(words) <= k:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + k]) for i in range(len(words) - k + 1)}
+
+
+def minhash(texts, num_perm=NUM_PERM, seed=0, chunksize=1000):
+    """MinHash signatures of the shingle sets of `texts` as a (len(texts), num_perm) array"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**31, size=num_perm, dtype="uint64")
+    b = rng.integers(0, 2**32, size=num_perm, dtype="uint64")
+
+    texts = list(texts)
+    signatures = np.empty((len(texts), num_perm), dtype="uint64")
+
+    for start in range(0, len(texts), chunksize):
+        hashes = [
+            np.fromiter(
+                (zlib.crc32(s.encode()) for s in shingles(text)), dtype="uint64"
+            )
+            for text in texts[start : start + chunksize]
+        ]
+        offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+        h = np.concatenate(hashes)
+
+        # Universal hashing (a*h + b) mod PRIME for all permutations at once; a*h + b < 2**64
+        permuted = (h[:, None] * a[None, :] + b[None, :]) % PRIME
+        signatures[start : start + len(hashes)] = np.minimum.reduceat(
+            permuted, offsets, axis=0
+        )
+
+    return signatures
+
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def union(parent, i, j):
+    i, j = find(parent, i), find(parent, j)
+    if i != j:
+        parent[max(i, j)] = min(i, j)  # Lowest index is the cluster's representative
+
+
+def clusters(n, pairs):
+    """Label each of `n` items with the lowest index of its connected component"""
+    parent = np.arange(n)
+    for i, j in pairs:
+        union(parent, i, j)
+    return np.fromiter((find(parent, i) for i in range(n)), dtype=np.intp, count=n)
+
+
+def minhash_pairs(signatures, threshold, bands=BANDS):
+    """Yield index pairs that collide in an LSH band and whose estimated Jaccard similarity >= threshold"""
+    rows = signatures.shape[1] // bands
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows : (band + 1) * rows])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+        # Compare every member of a bucket to the bucket's first member
+        for i in np.flatnonzero(first[inverse] != np.arange(len(keys))):
+            j = first[inverse[i]]
+            if np.mean(signatures[i] == signatures[j]) >= threshold:
+                yield j, i
+
+
+def cosine_pairs(embeddings, threshold, blocksize=1024):
+    """Yield index pairs of normalized embeddings with cosine similarity >= threshold
+
+    Each block of rows is only compared to the rows from its start on, so the lower triangle is never computed.
+    """
+    embeddings = np.asarray(embeddings, dtype="float32")
+    for start in range(0, len(embeddings), blocksize):
+        similarities = embeddings[start : start + blocksize] @ embeddings[start:].T
+        for i, j in zip(*np.nonzero(similarities >= threshold)):
+            if i < j:
+                yield start + i, start + j
+
+
+def near_duplicates(texts, threshold=JACCARD_THRESHOLD):
+    """Cluster labels of texts by MinHash LSH on word shingles"""
+    return clusters(len(texts), minhash_pairs(minhash(texts), threshold))
+
+
+def embedding_duplicates(embeddings, threshold=COSINE_THRESHOLD):
+    """Cluster labels of embeddings by cosine similarity through a blocked matrix product"""
+    return clusters(len(embeddings), cosine_pairs(embeddings, threshold))
+
+
+def duplicates(df, labels):
+    """Return a DataFrame of the rows of `df` that duplicate an earlier row, with a `duplicate_of` column"""
+    dropped = labels != np.arange(len(labels))
+    report = pd.DataFrame(
+        {"duplicate_of": df.index[labels[dropped]]}, index=df.index[dropped]
+    )
+    report.index.name = df.index.name
+    return report
+
+
+def print_report(report, texts, maxclusters=10, width=60):
+    numclusters = report["duplicate_of"].nunique()
+    print(f"Dropping {len(report)} near-duplicates in {numclusters} clusters")
+
+    sizes = report["duplicate_of"].value_counts()
+    for kept, size in sizes.head(maxclusters).items():
+        text = " ".join(texts[kept].split())[:width]
+        print(f"  {size + 1} x `{text}`")
+
+
+def main(args):
+    df = pd.concat([pd.read_feather(input) for input in args.inputfile])
+    df = df[~df.index.duplicated(keep="first")]
+
+    # Keep the earliest post of each cluster
+    df = df.sort_values(by="created_utc", kind="stable")
+    texts = df["title"].str.replace("\n", " ") + "\n" + df["selftext"]
+
+    verbose(f"Computing MinHash signatures of {len(df)} posts")
+    labels = near_duplicates(texts)
+
+    report = duplicates(df, labels)
+    print_report(report, texts)
+
+    report.to_feather(args.outputfile, compression="zstd")
+    verbose(f"Written to {args.outputfile}")
+
+    if args.report:
+        report["subreddit"] = df.loc[report.index, "subreddit"]
+        report["text"] = texts.loc[report.index]
+        report.to_csv(args.report)
+        verbose(f"Written report to {args.report}")
+
+    return 0
+
+
+verbose = print
+
+if __name__ == "__main__":
+    parser = ConfigArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "inputfile",
+        nargs="+",
+        help="Input .feather files containing normalized submissions",
+    )
+    parser.add_argument(
+        "--outputfile",
+        default="duplicates.feather",
+        help="Write ids of near-duplicate posts to drop to this .feather file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="Also write the dropped posts with the id of the post they duplicate to this .csv file",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Print verbose output")
+
+    args = parser.parse_args()
+    if not args.verbose:
+        verbose = lambda *_, **__: None
+
+    exit(main(args))
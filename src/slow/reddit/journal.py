@@ -0,0 +1,107 @@
+"""Crash-safe vet results: a base vet .feather file plus an append-only JSONL journal of new scores"""
+
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from src.slow.reddit.store import write_atomically
+
+
+class VetJournal:
+    """Scores are appended to `{vetfile}.journal` as they come in, and merged into `vetfile` by compact()
+
+    Reading replays the journal on top of the base file (later scores win), so a crashed or killed
+    session loses at most a partially written last line. Replaying is idempotent, so a crash during
+    compaction is harmless too.
+    """
+
+    def __init__(self, vetfile, compact_every=None):
+        self.vetfile = Path(vetfile)
+        self.path = Path(f"{vetfile}.journal")
+        self.compact_every = compact_every
+        self.numentries = sum(1 for _ in self.entries())
+        self.torn = self.ends_torn()
+
+    def ends_torn(self):
+        """Whether the journal ends in a partially written line"""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return False
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) != b"\n"
+        except FileNotFoundError:
+            return False
+
+    def entries(self):
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn write
+        except FileNotFoundError:
+            return
+
+    def read(self):
+        try:
+            vdf = pd.read_feather(self.vetfile)
+        except FileNotFoundError:
+            vdf = pd.DataFrame()
+
+        entries = list(self.entries())
+        if entries:
+            new = pd.DataFrame(
+                {"score": [e["score"] for e in entries]},
+                index=pd.Index([e["id"] for e in entries], name="id"),
+            )
+            vdf = pd.concat([vdf, new])
+            vdf = vdf[~vdf.index.duplicated(keep="last")]
+
+        vdf.index.name = "id"  # Also for vet files written before the index was named
+        return vdf
+
+    def append(self, df):
+        """Durably append the scores in `df` (indexed by post id)"""
+        lines = "".join(
+            json.dumps({"id": id, "score": int(score)}) + "\n"
+            for id, score in zip(df.index, df["score"])
+        )
+
+        if self.torn:
+            lines = "\n" + lines  # Terminate the torn line so it's skipped on replay
+            self.torn = False
+
+        with open(self.path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.numentries += len(df)
+        if self.compact_every and self.numentries >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Merge the journal into the base file"""
+        vdf = self.read()
+        if self.numentries == 0 and self.vetfile.exists():
+            return vdf
+
+        if "score" in vdf:
+            vdf["score"] = vdf["score"].astype("int")
+        write_atomically(vdf, self.vetfile)
+        self.path.unlink(missing_ok=True)
+        self.numentries = 0
+        self.torn = False
+
+        print(f"Written to {self.vetfile}")
+        return vdf
+
+
+def read_vet(vetfile):
+    """Read a vet file together with its journal, if any"""
+    return VetJournal(vetfile).read()
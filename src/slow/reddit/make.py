@@ -1,38 +1,85 @@
 """Make the seed posts for the SLOW stream from raw posts and vetting information and upload to Hugging Face"""
 
+from pathlib import Path
 from sys import exit
 
+import numpy as np
 import pandas as pd
 
 from src.config import ConfigArgumentParser
-from src.slow.df import upload_slow_thoughts
+from src.slow.dataset import (
+    slow_table,
+    slow_thoughts_file,
+    write_sidecars,
+    write_slow_thoughts,
+)
+from src.slow.reddit.dedup import duplicates, embedding_duplicates, print_report
+from src.slow.reddit.journal import read_vet
+from src.slow.reddit.store import read_posts_chunks
 
 
-def main(args):
-    pdf = pd.read_feather(args.postfile)
-    vdf = pd.concat([pd.read_feather(vetfile) for vetfile in args.vetfiles])
+def good_ids(vetfiles):
+    vdf = pd.concat([read_vet(vetfile) for vetfile in vetfiles])
 
-    duplicates = vdf.index.duplicated(keep="first")
+    revetted = vdf.index.duplicated(keep="first")
     print(
-        f"Found {duplicates.sum()} posts that have been vetted more than once (keeping first)"
+        f"Found {revetted.sum()} posts that have been vetted more than once (keeping first)"
     )
-    vdf = vdf[~duplicates]
+    vdf = vdf[~revetted]
 
     print(
         "Score distribution: (+1 => GOOD; -1 => BAD; 0 => undecided or error during autovetting)"
     )
     print(vdf.value_counts())
 
-    good = vdf[vdf["score"] == 1]
-    sdf = pdf.loc[good.index]
-    print(f"Kept {len(sdf)} GOOD posts")
+    return vdf.index[vdf["score"] == 1]
+
+
+def read_good(postfile, ids):
+    """Stream the posts and keep only the GOOD ones, so that at most one chunk of all posts is in memory"""
+    texts, embeddings, index = [], [], []
+    for chunk in read_posts_chunks(postfile, columns=["post", "embedding"]):
+        chunk = chunk[chunk.index.isin(ids)]
+        if len(chunk):
+            texts.extend(chunk["post"])
+            embeddings.append(np.stack(chunk["embedding"], dtype="float32"))
+            index.extend(chunk.index)
+
+    embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, 0))
+    return pd.Index(index, name="id"), texts, embeddings
+
+
+def main(args):
+    ids = good_ids(args.vetfiles)
+
+    index, texts, embeddings = read_good(args.postfile, ids)
+    print(f"Kept {len(texts)} GOOD posts")
+
+    if args.dedup:
+        labels = embedding_duplicates(embeddings)
+        report = duplicates(pd.DataFrame(index=index), labels)
+        print_report(report, pd.Series(texts, index=index))
+        keep = ~index.isin(report.index)
+        texts = [text for text, k in zip(texts, keep) if k]
+        embeddings = embeddings[keep]
+        print(f"Kept {len(texts)} GOOD posts after removing near-duplicates")
+
+    # Anonymize data by not writing post ids
+    table = slow_table(texts, embeddings, dtype=args.dtype)
 
-    print("Anonymizing data")
-    sdf.reset_index(drop=True, inplace=True)
-    sdf = sdf[["post", "embedding"]]
-    sdf.rename(columns={"post": "text"}, inplace=True)
+    outputdir = Path(args.local or Path(args.postfile).parent)
+    outputdir.mkdir(parents=True, exist_ok=True)
+    path = outputdir / slow_thoughts_file()
 
-    upload_slow_thoughts(sdf, verbose=True)
+    write_slow_thoughts(table, path)
+    files = [path, *write_sidecars(path, embeddings, args.index, args.knn)]
+    for file in files:
+        print(f"Written to {file}")
+
+    if not args.local:
+        from src.slow.df import upload_slow_thoughts
+
+        upload_slow_thoughts(files, verbose=True)
 
     return 0
 
@@ -40,8 +87,41 @@ def main(args):
 if __name__ == "__main__":
     parser = ConfigArgumentParser(description=__doc__)
 
-    parser.add_argument("postfile", help="Post .feather file containing posts")
-    parser.add_argument("vetfiles", nargs="+", help="One or more vet .feather files")
+    parser.add_argument(
+        "postfile", help="Posts store directory (or .feather file) containing posts"
+    )
+    parser.add_argument(
+        "vetfiles",
+        nargs="+",
+        help="One or more vet .feather files (including their uncompacted journals)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Drop GOOD posts whose embeddings are near-duplicates of an earlier one (see `slow.reddit.dedup.cosine_threshold`)",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16"],
+        default="float32",
+        help="Store embeddings as this type; float16 halves the download but is converted to float32 when loaded (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Also build an IVF index for nearest neighbor search",
+    )
+    parser.add_argument(
+        "--knn",
+        type=int,
+        default=0,
+        help="Also build a graph of each post's {knn} nearest neighbors",
+    )
+    parser.add_argument(
+        "--local",
+        default=None,
+        help="Publish to this local directory instead of uploading to Hugging Face (default: write next to {postfile} and upload)",
+    )
 
     args = parser.parse_args()
 
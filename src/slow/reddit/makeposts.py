@@ -1,7 +1,5 @@
 """Make labeled and embedded posts from normalized submissions"""
 
-import os
-import re
 import textwrap
 from sys import exit
 
@@ -9,8 +7,11 @@ import pandas as pd
 from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
 
 from src.config import ConfigArgumentParser
-from src.slow.embed import embed
+from src.slow.embed import embed_many
 from src.slow.reddit import patterns
+from src.slow.reddit.store import PostStore
+
+NOTHING_NEW = 3  # Exit code when --update finds no new posts
 
 
 def formatpost(post, symbol="🟦", width=60):
@@ -47,14 +48,14 @@ def read_dfs(inputs):
 
 def downsample(df, args):
     if args.update:
-        try:
-            # Sample only from rows in df that are not in old
-            old = pd.read_feather(args.outputfile)
-            new = df[~df.index.isin(old.index)]
+        store = PostStore(args.outputfile)
+        if store.exists():
+            # Sample only from rows in df that are not in the store yet
+            new = df[~df.index.isin(store.ids())]
             numsamples = min(args.downsample, len(new))
             return new.sample(n=numsamples)
-        except FileNotFoundError:
-            verbose("Update file not found: sampling from all rows")
+        else:
+            verbose("Update store not found: sampling from all rows")
     return df.sample(n=args.downsample)
 
 
@@ -68,12 +69,6 @@ def make_post(normalized_title, normalized_selftext):
     return post
 
 
-COMPILED_LABEL_PATTERNS = {
-    category: re.compile("|".join(patterns), flags=re.IGNORECASE)
-    for category, patterns in patterns.LABEL_PATTERNS.items()
-}
-
-
 def get_distilbert_ner():
     tokenizer = AutoTokenizer.from_pretrained("dslim/distilbert-NER")
     model = AutoModelForTokenClassification.from_pretrained("dslim/distilbert-NER")
@@ -109,11 +104,7 @@ def contains_entities(
 
 
 def label(text):
-    labels = [
-        category
-        for category, pattern in COMPILED_LABEL_PATTERNS.items()
-        if pattern.search(text)
-    ]
+    labels = patterns.LABELER.search(text)
 
     if contains_entities(text):
         labels += ["ENTITIES"]
@@ -135,21 +126,41 @@ def apply(df, f, show_progress=False):
     return result
 
 
+def embed_all(texts, show_progress=False):
+    embeddings = embed_many(texts)
+    if show_progress:
+        try:
+            from tqdm import tqdm
+
+            embeddings = tqdm(embeddings, total=len(texts))
+        except ImportError:
+            pass
+    return pd.Series(list(embeddings), index=texts.index)
+
+
 def write(df, args):
     df.reset_index(inplace=True)
     df.drop_duplicates(subset="id", inplace=True, keep="last")
     df.set_index("id", inplace=True, verify_integrity=True)
 
-    # If file exists and we're not updating, abort
-    if (not args.update) and os.path.exists(args.outputfile):
-        raise ValueError(f"Output file {args.outputfile} already exists")
+    # If store exists and we're not updating, abort
+    store = PostStore(args.outputfile)
+    if (not args.update) and store.exists():
+        raise ValueError(f"Output store {args.outputfile} already exists")
 
-    df.to_feather(args.outputfile, compression="zstd")
+    # Only writes a new fragment; rows already in the store are overridden
+    store.append(df)
 
 
 def main(args):
     df = read_dfs(args.inputfile)
 
+    if args.duplicates:
+        duplicates = pd.read_feather(args.duplicates)
+        n = len(df)
+        df = df[~df.index.isin(duplicates.index)]
+        verbose(f"Dropped {n - len(df)} near-duplicate rows listed in {args.duplicates}")
+
     if not args.downsample:
         args.downsample = len(df)
 
@@ -165,25 +176,21 @@ def main(args):
     df["labels"] = apply(df["post"], label, show_progress=args.verbose)
 
     verbose("Embedding posts")
-    df["embedding"] = apply(df["post"], embed, show_progress=args.verbose)
+    df["embedding"] = embed_all(df["post"], show_progress=args.verbose)
 
-    newrows = len(df)
     newrows = len(df)
     if args.update:
-        try:
-            old = pd.read_feather(args.outputfile)
-            df = pd.concat([old, df])
-            df = df[~df.index.duplicated(keep="last")]
-            newrows = len(df) - len(old)
-            newrows = len(df) - len(old)
+        store = PostStore(args.outputfile)
+        if store.exists():
+            newrows = (~df.index.isin(store.ids())).sum()
             verbose("Updating")
-        except FileNotFoundError:
-            verbose("Update file not found: writing to new file")
+        else:
+            verbose("Update store not found: writing to new store")
 
     verbose(f"Writing {newrows} new rows to {args.outputfile}")
     write(df, args)
 
-    return 0 if newrows > 0 else 1
+    return 0 if newrows > 0 else NOTHING_NEW
 
 
 verbose = print
@@ -198,13 +205,18 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--outputfile",
-        default="posts.feather",
-        help="Output .feather file to result to (default: posts.feather)",
+        default="posts",
+        help="Output posts store directory to write results to (default: %(default)s)",
     )
     parser.add_argument(
         "--update",
         action="store_true",
-        help="Update output file rather than overwriting",
+        help="Append new posts to the output store rather than creating it",
+    )
+    parser.add_argument(
+        "--duplicates",
+        default=None,
+        help="Skip posts listed in this .feather file written by `python -m src.slow.reddit.dedup`",
     )
     parser.add_argument("--verbose", action="store_true", help="Print verbose output")
     parser.add_argument(
@@ -35,20 +35,8 @@ def remove_markdown_urls(text, pattern=re.compile(r"\[(.+?)\]\(.+?\)")):
     return pattern.sub(r"\1", text)
 
 
-def replace_urls(text, pattern=re.compile(patterns.URL)):
-    return pattern.sub("...", text)
-
-
-def replace_redacted(text, pattern=re.compile(patterns.REDACTED, re.IGNORECASE)):
-    """Remove stuff like [redacted], [removed by mod], [deleted], etc. from the text"""
-    return pattern.sub("...", text)
-
-
-def replace_redditlike(
-    text,
-    pattern=re.compile(patterns.REDDITLIKE, re.IGNORECASE),
-):
-    """Replace Reddit-related identifiers: r/subreddit, u/username, reddit, etc."""
+def collapse(text, pattern=re.compile(patterns.COLLAPSE)):
+    """Replace URLs, [redacted]-like and Reddit-like identifiers (r/subreddit, u/username, reddit, etc.) in a single pass"""
     return pattern.sub("...", text)
 
 
@@ -57,7 +45,7 @@ def trycollapse(
     pattern=re.compile(r"[a-zA-Z]"),  # = at least one ordinary letter
 ):
     """Try to collapse the text into "" if it only contains links or digits or [deleted] or special symbols"""
-    result = COLLAPSE(text)
+    result = collapse(text)
     return "" if not pattern.search(result) else text
 
 
@@ -95,13 +83,6 @@ NORMALIZE = preprocessing.make_pipeline(
 )
 
 
-COLLAPSE = preprocessing.make_pipeline(
-    replace_urls,
-    replace_redacted,
-    replace_redditlike,
-)
-
-
 def read(inputcsv):
     """Read CSV file without treating empty strings as NaN and with custom converters"""
 
@@ -212,3 +212,178 @@ LABEL_PATTERNS = {
         )
     ],
 }
+
+# Replace URLs, [redacted]-like and Reddit-like identifiers in a single pass (see `normalize.collapse()`)
+COLLAPSE = rf"{URL}|(?i:{REDACTED})|(?i:{REDDITLIKE})"
+
+
+def literal_prefix(pattern, plain=re.compile(r"[a-zA-Z0-9 ](?![?*+{])")):
+    """Split `pattern` into its (lowercased) prefix of plain, unquantified characters and the rest"""
+    i = 0
+    while match := plain.match(pattern, i):
+        i = match.end()
+    return pattern[:i].lower(), pattern[i:]
+
+
+def trie(alternatives):
+    """Join case-insensitive alternatives into a regex that shares their common literal prefixes
+
+    Python's `re` tries alternatives one by one, so `m(?:om|um)` is much faster than `mom|mum` on a miss.
+    This is what an Aho-Corasick automaton would buy us, but for alternatives that may contain regex syntax.
+    """
+    root = {}
+    for alternative in alternatives:
+        prefix, rest = literal_prefix(alternative)
+        node = root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node.setdefault("", []).append(rest)
+
+    def emit(node):
+        parts = [c + emit(child) for c, child in node.items() if c]
+        parts += node.get("", [])
+        if parts == [""]:
+            return ""
+        if len(parts) == 1 and "" not in node:
+            return parts[0]
+        return "(?:" + "|".join(parts) + ")"
+
+    return emit(root)
+
+
+class MultiPattern:
+    """Scan a text once and report every category in `patterns` that matches somewhere in the text
+
+    All categories are compiled into a single alternation of named groups. When a category matches at
+    position p, we know that none of the remaining categories match before p, so we resume searching at p
+    with an alternation of the remaining categories only. Each text is therefore scanned (at most) once,
+    instead of once per category. The alternations for subsets of categories are compiled lazily.
+
+    Note: the word lists in `LABEL_PATTERNS` contain regex syntax (optional suffixes etc.), so rather than
+    an Aho-Corasick automaton we join them into a trie of literal prefixes; see `trie()`.
+    """
+
+    def __init__(self, patterns, flags=0):
+        self.categories = list(patterns)
+        self.groups = {category: f"_{i}" for i, category in enumerate(patterns)}
+        self.names = {group: category for category, group in self.groups.items()}
+        self.patterns = {
+            category: self.factor(alternatives)
+            for category, alternatives in patterns.items()
+        }
+        self.flags = flags
+        self.compiled = {}
+
+    @staticmethod
+    def factor(alternatives):
+        """Join alternatives, pulling the word boundaries of `word_boundaries()` alternatives out of the alternation
+
+        This matches at the same positions, but rejects positions inside words with a single test rather than one per alternative
+        """
+
+        def bounded(a):
+            return a.startswith(r"\b") and a.endswith(r"\b") and "|" not in a
+
+        inner = [a[2:-2] for a in alternatives if bounded(a)]
+        others = [a for a in alternatives if not bounded(a)]
+        if inner:
+            others.insert(0, r"\b" + trie(inner) + r"\b")
+        return "|".join(others)
+
+    def compile(self, categories):
+        key = frozenset(categories)
+        if key not in self.compiled:
+            self.compiled[key] = re.compile(
+                "|".join(
+                    f"(?P<{self.groups[c]}>{self.patterns[c]})"
+                    for c in self.categories
+                    if c in key
+                ),
+                flags=self.flags,
+            )
+        return self.compiled[key]
+
+    def search(self, text):
+        """Return the matching categories in the order in which they were defined"""
+        pending = set(self.categories)
+        pos = 0
+        while pending:
+            match = self.compile(pending).search(text, pos)
+            if not match:
+                break
+            pending.remove(self.names[match.lastgroup])
+            pos = match.start()
+        return [c for c in self.categories if c not in pending]
+
+
+LABELER = MultiPattern(LABEL_PATTERNS, flags=re.IGNORECASE)
+
+
+if __name__ == "__main__":
+    import argparse
+    from sys import exit
+    from time import perf_counter
+
+    from src.slow.reddit.store import read_posts
+
+    parser = argparse.ArgumentParser(
+        description="Check that LABELER and COLLAPSE agree with the per-category regexes on posts"
+    )
+    parser.add_argument(
+        "inputfile", help="Posts store directory (or normalized .feather file)"
+    )
+    parser.add_argument("-n", type=int, default=None, help="Only check the first {n} rows")
+    args = parser.parse_args()
+
+    df = read_posts(args.inputfile)
+    if "post" in df:
+        texts = df["post"]
+    else:
+        texts = df["title"].str.replace("\n", " ") + "\n" + df["selftext"]
+    texts = list(texts[: args.n])
+
+    reference = {
+        category: re.compile("|".join(alternatives), flags=re.IGNORECASE)
+        for category, alternatives in LABEL_PATTERNS.items()
+    }
+
+    t = perf_counter()
+    expected = [[c for c, p in reference.items() if p.search(s)] for s in texts]
+    dt_reference = perf_counter() - t
+
+    t = perf_counter()
+    labels = [LABELER.search(s) for s in texts]
+    dt_labeler = perf_counter() - t
+
+    label_mismatches = [
+        (s, e, l) for s, e, l in zip(texts, expected, labels) if e != l
+    ]
+    for s, e, l in label_mismatches[:10]:
+        print(f"Label mismatch: expected {e}, got {l} for {s!r}")
+
+    print(f"Labeled {len(texts)} texts: {len(label_mismatches)} mismatches")
+    print(f"Per-category regexes: {dt_reference:.2f}s; LABELER: {dt_labeler:.2f}s")
+
+    chained = [
+        re.compile(URL),
+        re.compile(REDACTED, re.IGNORECASE),
+        re.compile(REDDITLIKE, re.IGNORECASE),
+    ]
+    collapse = re.compile(COLLAPSE)
+    letter = re.compile(r"[a-zA-Z]")
+
+    def collapses_chained(s):
+        for p in chained:
+            s = p.sub("...", s)
+        return not letter.search(s)
+
+    def collapses(s):
+        return not letter.search(collapse.sub("...", s))
+
+    collapse_mismatches = [s for s in texts if collapses_chained(s) != collapses(s)]
+    for s in collapse_mismatches[:10]:
+        print(f"Collapse mismatch for {s!r}")
+
+    print(f"Collapsed {len(texts)} texts: {len(collapse_mismatches)} mismatches")
+
+    exit(1 if label_mismatches or collapse_mismatches else 0)
@@ -0,0 +1,370 @@
+"""Refresh the posts store: scrape, normalize, dedup and make posts as a DAG of cached, parallel tasks"""
+
+import hashlib
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from sys import exit
+
+from src.config import CONFIG, ConfigArgumentParser, config_argv
+from src.slow.reddit.makeposts import NOTHING_NEW
+
+DATA_DIR = CONFIG("slow.reddit.pipeline.data_dir")
+WORKERS = CONFIG("slow.reddit.pipeline.workers")
+SCRAPE_WORKERS = CONFIG("slow.reddit.pipeline.scrape_workers")
+SCRAPE_STRIDE = CONFIG("slow.reddit.pipeline.scrape_stride")
+SCRAPE_MAXFSIZE = CONFIG("slow.reddit.pipeline.scrape_maxfsize")
+POSTS_BATCH = CONFIG("slow.reddit.pipeline.posts_batch")
+
+SRC_DIR = Path(__file__).parent.parent.parent
+
+
+def module(name):
+    return SRC_DIR / (name.replace(".", "/") + ".py")
+
+
+def python(name, *args):
+    return [sys.executable, "-m", f"src.{name}", *map(str, args)]
+
+
+class Task:
+    """A command that turns `inputs` into `outputs`, run after the tasks it `deps` on
+
+    The task is up to date, and skipped, if its stamp holds the same fingerprint of its command, inputs
+    (by size and mtime: hashing GBs of CSVs would cost more than most tasks), `code` files and `config`
+    keys as now. Tasks that pull from outside (scraping) are `always` run, and if they are `optional`,
+    their failure doesn't block the tasks depending on them. A `repeat` task is rerun until it exits
+    with NOTHING_NEW.
+    """
+
+    def __init__(
+        self,
+        stage,
+        name,
+        command,
+        inputs=(),
+        outputs=(),
+        code=(),
+        config=(),
+        deps=(),
+        always=False,
+        optional=False,
+        repeat=False,
+    ):
+        self.stage = stage
+        self.name = name
+        self.command = command
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.code = [Path(p) for p in code]
+        self.config = list(config)
+        self.deps = list(deps)
+        self.always = always
+        self.optional = optional
+        self.repeat = repeat
+
+        self.status = None  # One of None, "running", "done", "skipped", "failed", "blocked"
+        self.elapsed = 0.0
+        self.numbytes = 0
+
+    def fingerprint(self):
+        h = hashlib.sha256()
+        h.update(json.dumps(self.command[1:]).encode())  # Don't depend on the interpreter path
+        for path in self.inputs:
+            try:
+                stat = path.stat()
+                h.update(f"{path} {stat.st_size} {stat.st_mtime_ns}".encode())
+            except FileNotFoundError:
+                h.update(f"{path} missing".encode())
+        for path in self.code:
+            h.update(path.read_bytes())
+        for key in self.config:
+            h.update(json.dumps(CONFIG(key), sort_keys=True).encode())
+        return h.hexdigest()
+
+    def stamp_path(self, stampdir):
+        return Path(stampdir) / f"{self.name}.stamp"
+
+    def uptodate(self, stampdir):
+        if self.always or not all(path.exists() for path in self.outputs):
+            return False
+        try:
+            stamp = json.loads(self.stamp_path(stampdir).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return stamp["fingerprint"] == self.fingerprint()
+
+    def execute(self, stampdir):
+        """Run the command, logging to {stampdir}/{name}.log; return True on success"""
+        self.numbytes = sum(p.stat().st_size for p in self.inputs if p.exists())
+
+        start = time.perf_counter()
+        with open(Path(stampdir) / f"{self.name}.log", "w") as log:
+            while True:
+                returncode = subprocess.run(
+                    self.command, stdout=log, stderr=subprocess.STDOUT
+                ).returncode
+                if not (self.repeat and returncode == 0):
+                    break
+        self.elapsed = time.perf_counter() - start
+
+        success = returncode == (NOTHING_NEW if self.repeat else 0)
+        if success:
+            # Fingerprint after running, so tasks that touch their own inputs (compaction) are up to date next time
+            stamp = {"fingerprint": self.fingerprint(), "elapsed": self.elapsed}
+            self.stamp_path(stampdir).write_text(json.dumps(stamp))
+        return success
+
+
+def run(tasks, stampdir, workers=WORKERS, limits=None, force=False):
+    """Run `tasks` (in topological order) with at most `workers` at once and `limits[stage]` per stage"""
+    limits = limits or {}
+    Path(stampdir).mkdir(parents=True, exist_ok=True)
+
+    def finished(task):
+        return task.status in ("done", "skipped") or (
+            task.status == "failed" and task.optional
+        )
+
+    def ready(task):
+        if task.status is not None:
+            return False
+        if any(d.status in ("failed", "blocked") and not finished(d) for d in task.deps):
+            task.status = "blocked"
+            return False
+        if not all(finished(d) for d in task.deps):
+            return False
+        numrunning = sum(t.status == "running" and t.stage == task.stage for t in tasks)
+        return numrunning < limits.get(task.stage, workers)
+
+    with ThreadPoolExecutor(workers) as pool:
+        running = {}
+        while True:
+            for task in tasks:
+                if not ready(task):
+                    continue
+                if not force and task.uptodate(stampdir):
+                    task.status = "skipped"
+                    continue
+                task.status = "running"
+                running[pool.submit(task.execute, stampdir)] = task
+                verbose(f"Started {task.name}")
+
+            if not running:
+                break  # Tasks are in topological order, so a pass that starts nothing leaves none pending
+
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                task = running.pop(future)
+                task.status = "done" if future.result() else "failed"
+                print(f"{task.status.capitalize()} {task.name} in {task.elapsed:.1f}s")
+
+    return all(finished(task) for task in tasks)
+
+
+def report(tasks):
+    """Print per-stage counts, timings and throughput"""
+    stages = {}
+    for task in tasks:
+        stages.setdefault(task.stage, []).append(task)
+
+    for stage, stagetasks in stages.items():
+        counts = {}
+        for task in stagetasks:
+            counts[task.status] = counts.get(task.status, 0) + 1
+        ran = [t for t in stagetasks if t.status in ("done", "failed")]
+        elapsed = sum(t.elapsed for t in ran)
+        numbytes = sum(t.numbytes for t in ran)
+        throughput = f", {numbytes / elapsed / 1e6:.1f} MB/s" if elapsed and numbytes else ""
+        summary = ", ".join(f"{n} {status}" for status, n in counts.items())
+        print(f"{stage:>10}: {summary} ({elapsed:.1f}s task time{throughput})")
+
+
+def read_subreddits(path):
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def build(args):
+    data = Path(args.data_dir)
+    subreddit_dir = data / "subreddit"
+    posts_dir = data / "posts"
+    duplicates = data / "duplicates.feather"
+
+    subreddits = read_subreddits(data / "subreddit.list")
+    csvs = {subreddit_dir / f"{s}.csv" for s in subreddits}
+    csvs |= set(subreddit_dir.glob("*.csv"))
+
+    tasks, normalized = [], []
+    for csv in sorted(csvs):
+        deps = []
+        if args.scrape and csv.stem in subreddits:
+            scrape = Task(
+                "scrape",
+                f"scrape-{csv.stem}",
+                python(
+                    "slow.reddit.scrape",
+                    csv.stem,
+                    csv,
+                    "--update",
+                    "--stride",
+                    SCRAPE_STRIDE,
+                    "--maxfsize",
+                    SCRAPE_MAXFSIZE,
+                    "--verbose",
+                ),
+                outputs=[csv],
+                always=True,
+                optional=True,  # Still process what was scraped before
+            )
+            tasks.append(scrape)
+            deps = [scrape]
+
+        feather = csv.with_suffix(".feather")
+        normalize = Task(
+            "normalize",
+            f"normalize-{csv.stem}",
+            python("slow.reddit.normalize", csv, feather, "--verbose"),
+            inputs=[csv],
+            outputs=[feather],
+            code=[module("slow.reddit.normalize"), module("slow.reddit.patterns")],
+            deps=deps,
+        )
+        tasks.append(normalize)
+        normalized.append(normalize)
+
+    feathers = [task.outputs[0] for task in normalized]
+
+    dedup = Task(
+        "dedup",
+        "dedup",
+        python(
+            "slow.reddit.dedup",
+            *feathers,
+            "--outputfile",
+            duplicates,
+            "--report",
+            duplicates.with_suffix(".csv"),
+            "--verbose",
+            *config_argv(),
+        ),
+        inputs=feathers,
+        outputs=[duplicates],
+        code=[module("slow.reddit.dedup")],
+        config=["slow.reddit.dedup"],
+        deps=normalized,
+    )
+
+    makeposts = Task(
+        "makeposts",
+        "makeposts",
+        python(
+            "slow.reddit.makeposts",
+            *feathers,
+            "--update",
+            "--outputfile",
+            posts_dir,
+            "--duplicates",
+            duplicates,
+            "--downsample",
+            args.posts_batch,
+            "--verbose",
+            *config_argv(),
+        ),
+        inputs=[*feathers, duplicates],
+        outputs=[posts_dir / "index.feather"],
+        code=[
+            module("slow.reddit.makeposts"),
+            module("slow.reddit.patterns"),
+            module("slow.embed"),
+        ],
+        config=["slow.embed"],
+        deps=[dedup],
+        repeat=True,
+    )
+
+    compact = Task(
+        "compact",
+        "compact",
+        python("slow.reddit.store", posts_dir, "--compact"),
+        inputs=[posts_dir / "index.feather"],
+        outputs=[posts_dir / "index.feather"],
+        deps=[makeposts],
+    )
+
+    return tasks + [dedup, makeposts, compact]
+
+
+def main(args):
+    tasks = build(args)
+    verbose(f"Pipeline has {len(tasks)} tasks")
+
+    start = time.perf_counter()
+    success = run(
+        tasks,
+        Path(args.data_dir) / ".pipeline",
+        workers=args.workers,
+        limits={"scrape": args.scrape_workers, "makeposts": 1},
+        force=args.force,
+    )
+
+    report(tasks)
+    print(f"Finished in {time.perf_counter() - start:.1f}s at {time.ctime()}")
+
+    for task in tasks:
+        if task.status == "failed":
+            print(f"See {Path(args.data_dir) / '.pipeline' / task.name}.log")
+
+    return 0 if success else 1
+
+
+verbose = print
+
+if __name__ == "__main__":
+    parser = ConfigArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--data-dir",
+        default=DATA_DIR,
+        help="Directory with subreddit.list, subreddit/ and posts/ (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Max number of tasks to run in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--scrape-workers",
+        type=int,
+        default=SCRAPE_WORKERS,
+        help="Max number of subreddits to scrape in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--posts-batch",
+        type=int,
+        default=POSTS_BATCH,
+        help="Make posts in batches of this many new rows (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-scrape",
+        dest="scrape",
+        action="store_false",
+        help="Don't scrape; only process what has been scraped already",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun all tasks, even if they are up to date",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Print verbose output")
+
+    args = parser.parse_args()
+    if not args.verbose:
+        verbose = lambda *_, **__: None
+
+    exit(main(args))
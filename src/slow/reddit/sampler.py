@@ -0,0 +1,135 @@
+"""Draw fresh (not yet vetted) posts for vetting without scanning all posts per draw"""
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.slow.dataset import IVF_SUFFIX, sidecar
+from src.slow.index import IVFIndex
+from src.slow.reddit.store import INDEX_FILE
+
+
+def fingerprint(postfile):
+    """Fingerprint of the posts by size and mtime, of the store's index for a store (rewritten on every append)"""
+    path = Path(postfile)
+    if path.is_dir():
+        path = path / INDEX_FILE
+    stat = path.stat()
+    return hashlib.sha256(f"{stat.st_size} {stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+
+def index_path(postfile):
+    """Where the IVF index over the posts lives: next to them, keyed by their fingerprint"""
+    return sidecar(postfile, f".{fingerprint(postfile)}{IVF_SUFFIX}")
+
+
+def load_index(path, embeddings):
+    """Load the IVF index over `embeddings` from `path`, or build it and save it there
+
+    Indexes of earlier versions of the posts are removed when a new one is saved.
+    """
+    path = Path(path)
+    try:
+        index = IVFIndex.load(path, embeddings)
+        if sum(len(l) for l in index.lists) == len(embeddings):
+            return index
+    except FileNotFoundError:
+        pass
+
+    print(f"Building the IVF index over {len(embeddings)} posts")
+    index = IVFIndex.build(embeddings)
+    prefix = path.name[: -len(IVF_SUFFIX)].rsplit(".", 1)[0]
+    for stale in path.parent.glob(f"{prefix}.*{IVF_SUFFIX}"):
+        stale.unlink()
+    index.save(path)
+    return index
+
+
+class Pool:
+    """Positions in a fixed order, consumed front to back while skipping vetted ones"""
+
+    def __init__(self, positions):
+        self.positions = positions
+        self.head = 0
+
+    def peek(self, vetted, n=1):
+        """Return up to `n` fresh positions from the front of the pool without consuming them"""
+        while self.head < len(self.positions) and vetted[self.positions[self.head]]:
+            self.head += 1  # Amortized O(1): vetted positions stay vetted
+
+        fresh = []
+        i = self.head
+        while i < len(self.positions) and len(fresh) < n:
+            if not vetted[self.positions[i]]:
+                fresh.append(self.positions[i])
+            i += 1
+        return fresh
+
+
+class Sampler:
+    """Index over the posts `pdf` for drawing fresh posts
+
+    Keeps a bitset of vetted (or drawn) posts, a shuffled pool of posts per subreddit, a pool of all posts
+    in file order (or by descending similarity to `bias_embedding`) and an ANN index over the embeddings,
+    loaded from `index` (see index_path()) if given.
+    """
+
+    def __init__(self, pdf, vetted_ids, bias_embedding=None, seed=None, index=None):
+        rng = np.random.default_rng(seed)
+
+        self.embeddings = np.stack(pdf["embedding"], dtype="float32")
+        self.vetted = pdf.index.isin(vetted_ids)
+
+        if bias_embedding is None:
+            self.bias_scores = None
+            self.all = Pool(np.arange(len(pdf)))
+        else:
+            bias_embedding = np.asarray(bias_embedding, dtype="float32")
+            norms = np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(
+                bias_embedding
+            )
+            self.bias_scores = (self.embeddings @ bias_embedding) / norms
+            self.all = Pool(np.argsort(-self.bias_scores, kind="stable"))
+
+        codes, subreddits = pd.factorize(pdf["subreddit"])
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(subreddits) + 1))
+        self.subreddits = {
+            subreddit: Pool(rng.permutation(order[bounds[c] : bounds[c + 1]]))
+            for c, subreddit in enumerate(subreddits)
+        }
+
+        if index is None:
+            self.index = IVFIndex.build(self.embeddings)
+        else:
+            self.index = load_index(index, self.embeddings)
+
+    def numfresh(self):
+        return int((~self.vetted).sum())
+
+    def mark(self, position):
+        self.vetted[position] = True
+
+    def best(self, positions):
+        if not positions:
+            return None
+        if self.bias_scores is None:
+            return positions[0]
+        return positions[int(np.argmax(self.bias_scores[positions]))]
+
+    def next(self):
+        """Next fresh post in file order (or most similar to the bias)"""
+        return self.best(self.all.peek(self.vetted))
+
+    def from_subreddit(self, subreddit, numcandidates):
+        """A random fresh post from `subreddit` (the most biased among `numcandidates` if biased)"""
+        n = 1 if self.bias_scores is None else numcandidates
+        return self.best(self.subreddits[subreddit].peek(self.vetted, n))
+
+    def near(self, embedding, numcandidates):
+        """The fresh post most similar to `embedding` among its `numcandidates` approximate nearest neighbors"""
+        positions, _ = self.index.search(embedding, numcandidates)
+        fresh = [p for p in positions if not self.vetted[p]]
+        return self.best(fresh)
@@ -0,0 +1,163 @@
+"""Append-only posts store: a directory of .feather fragments plus an index of post ids"""
+
+import argparse
+import os
+from pathlib import Path
+from sys import exit
+
+import pandas as pd
+import pyarrow as pa
+
+INDEX_FILE = "index.feather"
+FRAGMENT_FILE = "part-{:06d}.feather"
+
+
+def write_atomically(df, path):
+    tmp = path.with_suffix(".tmp")
+    df.to_feather(tmp, compression="zstd")
+    os.replace(tmp, path)
+
+
+class PostStore:
+    """A logical table of posts indexed by `id`, stored as immutable fragments
+
+    Appending only writes a new fragment and rewrites the (small) index, which maps each id to its fragment.
+    The index is the source of truth: fragments that are not in the index (e.g. after a crash) are ignored.
+    Call compact() to merge all fragments into one.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def exists(self):
+        return (self.path / INDEX_FILE).exists()
+
+    def index(self):
+        try:
+            return pd.read_feather(self.path / INDEX_FILE)
+        except FileNotFoundError:
+            return pd.DataFrame(
+                {
+                    "id": pd.Series(dtype="string"),
+                    "fragment": pd.Series(dtype="int32"),
+                }
+            )
+
+    def ids(self):
+        """Return the ids of all posts in the store without reading any fragments"""
+        return pd.Index(self.index()["id"], name="id")
+
+    def fragment_path(self, fragment):
+        return self.path / FRAGMENT_FILE.format(fragment)
+
+    def append(self, df):
+        """Write `df` (indexed by `id`) as a new fragment; rows override earlier rows with the same id"""
+        if df.index.name != "id":
+            raise ValueError("Bad indices")
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        index = self.index()
+        fragment = int(index["fragment"].max()) + 1 if len(index) else 0
+
+        write_atomically(df, self.fragment_path(fragment))
+
+        new = pd.DataFrame({"id": df.index.astype("string"), "fragment": fragment})
+        index = pd.concat([index[~index["id"].isin(new["id"])], new])
+        index["fragment"] = index["fragment"].astype("int32")
+        write_atomically(index.reset_index(drop=True), self.path / INDEX_FILE)
+
+    def chunks(self, columns=None, ids=None):
+        """Yield the store fragment by fragment, optionally only some `columns` and/or the rows with the given `ids`"""
+        index = self.index()
+        if ids is not None:
+            index = index[index["id"].isin(ids)]
+
+        for fragment, rows in index.groupby("fragment"):
+            df = pd.read_feather(
+                self.fragment_path(fragment),
+                columns=None if columns is None else ["id", *columns],
+            )
+            if "id" in df:
+                df = df.set_index("id")
+            yield df[df.index.isin(rows["id"])]
+
+    def read(self, columns=None, ids=None):
+        """Read the store as one table, optionally only some `columns` and/or the rows with the given `ids`"""
+        dfs = list(self.chunks(columns, ids))
+        if not dfs:
+            raise FileNotFoundError(f"No posts found in {self.path}")
+
+        return pd.concat(dfs)
+
+    def compact(self):
+        """Merge all fragments into a single fragment and remove stale ones"""
+        df = self.read()
+
+        stale = set(self.path.glob(FRAGMENT_FILE.replace("{:06d}", "*")))
+        self.append(df)
+
+        index = self.index()
+        live = {self.fragment_path(f) for f in index["fragment"].unique()}
+        for path in stale - live:
+            path.unlink()
+
+        return len(df), len(live)
+
+
+def read_posts(path, columns=None):
+    """Read posts from either a PostStore directory or a single .feather file"""
+    if Path(path).is_dir():
+        return PostStore(path).read(columns)
+
+    df = pd.read_feather(path, columns=None if columns is None else ["id", *columns])
+    return df.set_index("id") if "id" in df else df
+
+
+def read_posts_chunks(path, columns=None):
+    """Yield posts in chunks: per fragment of a PostStore directory, or per record batch of a single .feather file"""
+    if Path(path).is_dir():
+        yield from PostStore(path).chunks(columns)
+        return
+
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+    names = None if columns is None else ["id", *columns]
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        if names is not None:
+            batch = batch.select([name for name in names if name in batch.schema.names])
+        df = batch.to_pandas()
+        yield df.set_index("id") if "id" in df else df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("store", help="Posts store directory")
+    parser.add_argument(
+        "--append",
+        nargs="+",
+        default=[],
+        help="Append one or more posts .feather files (e.g. an old posts.feather) to the store",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Merge all fragments of the store into one",
+    )
+
+    args = parser.parse_args()
+    store = PostStore(args.store)
+
+    for file in args.append:
+        df = pd.read_feather(file)
+        store.append(df)
+        print(f"Appended {len(df)} rows from {file}")
+
+    if args.compact:
+        n, fragments = store.compact()
+        print(f"Compacted {n} rows into {fragments} fragment(s)")
+
+    print(f"{args.store} contains {len(store.ids())} posts")
+
+    exit(0)
@@ -1,5 +1,6 @@
 """Vet posts manually or automatically"""
 
+import json
 from sys import exit
 from time import time
 
@@ -7,13 +8,17 @@ import numpy as np
 import pandas as pd
 from sentence_transformers import util
 from tqdm import tqdm
-from vertexai.generative_models import GenerationConfig
 
 from src.config import CONFIG, ConfigArgumentParser
-from src.gemini import gemini, read_prompt_file, replace_variables
+from src.gemini import Template, gemini, read_prompt_file
 from src.slow.embed import embed
 from src.slow.reddit import tui
+from src.slow.reddit.autovet import AutoVetter, ResultBuffer
+from src.slow.reddit.classify import Classifier
+from src.slow.reddit.journal import VetJournal, read_vet
 from src.slow.reddit.makeposts import formatpost
+from src.slow.reddit.sampler import Sampler, index_path
+from src.slow.reddit.store import read_posts
 
 INSTRUCTIONS = "Vetting: press '+' to score +1, '-' for -1, ENTER for 0, 'q' to quit"
 PLUS, MINUS, ENTER = ord("+"), ord("-"), ord("\n")
@@ -28,7 +33,8 @@ SCORE = {
 # BIAS = "I am feeling good, happy, fine, neutral."
 BIAS = "I see people."
 
-PROMPT = read_prompt_file(CONFIG("slow.reddit.vet_prompt_file"))
+PROMPT = Template(read_prompt_file(CONFIG("slow.reddit.vet_prompt_file")))
+BATCH_PROMPT = Template(read_prompt_file(CONFIG("slow.reddit.vet_batch_prompt_file")))
 MODEL = gemini(CONFIG("slow.reddit.model.name"))
 
 
@@ -45,43 +51,21 @@ def weigh_subreddits(pdf, vdf):
     return weights
 
 
-def writeout(vdf, path):
-    if "score" in vdf:
-        vdf["score"] = vdf["score"].astype("int")
-    vdf.to_feather(path, compression="zstd")
-    print(f"Written to {path}")
-
-
-def get_candidates(pdf, vdf):
-    """GOOD candidate posts have not been labeled or vetted yet"""
-    candidates = pdf[pdf["labels"].apply(len) == 0]
-    candidates = pdf[~pdf.index.isin(vdf.index)]
-    return candidates
-
-
 def ask_gemini(post, explain=False, examples=None):
-    query = PROMPT.replace("{{POST}}", post)
-
     if explain:
         # Let the LLM finish with the one-sentence justification
         generation_config = None
-        query = replace_variables(
-            query, OPTIONALLY_EXPLAIN=" followed by a one-sentence justification"
-        )
+        optionally_explain = " followed by a one-sentence justification"
     else:
         # Cut the LLM short after GOOD or BAD (single tokens)
-        generation_config = GenerationConfig(max_output_tokens=1)
-        query = replace_variables(query, OPTIONALLY_EXPLAIN=None)
+        generation_config = {"max_output_tokens": 1}
+        optionally_explain = None
 
-    if examples:
-        text = "\nHere are some examples of GOOD and BAD posts:\n"
-
-        for label, sample in examples:
-            text += f"```\n{sample['post']}\n``` => {label}\n"
-
-        query = replace_variables(query, OPTIONAL_EXAMPLES=text)
-    else:
-        query = replace_variables(query, OPTIONAL_EXAMPLES=None)
+    query = PROMPT.render(
+        POST=post,
+        OPTIONALLY_EXPLAIN=optionally_explain,
+        OPTIONAL_EXAMPLES=format_examples(examples),
+    )
 
     response = MODEL.generate_content(
         query,
@@ -92,60 +76,100 @@ def ask_gemini(post, explain=False, examples=None):
     return reply
 
 
+def format_examples(examples):
+    if not examples:
+        return None
+
+    text = "\nHere are some examples of GOOD and BAD posts:\n"
+
+    for label, sample in examples:
+        text += f"```\n{sample['post']}\n``` => {label}\n"
+
+    return text
+
+
+def parse_verdicts(reply, n):
+    """Parse a JSON array of exactly `n` GOOD/BAD verdicts or raise ValueError"""
+    verdicts = json.loads(reply)  # JSONDecodeError is a ValueError
+
+    if not isinstance(verdicts, list) or len(verdicts) != n:
+        raise ValueError(f"Expected a JSON array of {n} verdicts, got `{reply}`")
+
+    verdicts = [str(v).strip().upper() for v in verdicts]
+    if not all(v in ("GOOD", "BAD") for v in verdicts):
+        raise ValueError(f"Unknown verdicts in `{reply}`")
+
+    return verdicts
+
+
+def ask_gemini_batch(posts, examples=None):
+    """Ask for GOOD/BAD verdicts for several posts in one request, sharing the prompt and few-shot examples"""
+    text = "".join(
+        f"Post {i}:\n```\n{post}\n```\n" for i, post in enumerate(posts, start=1)
+    )
+
+    query = BATCH_PROMPT.render(
+        NUM_POSTS=str(len(posts)),
+        POSTS=text,
+        OPTIONAL_EXAMPLES=format_examples(examples),
+    )
+
+    response = MODEL.generate_content(
+        query,
+        generation_config={"response_mime_type": "application/json"},
+    )
+
+    return parse_verdicts(response.text, len(posts))
+
+
 def main(args):
-    pdf = pd.read_feather(args.postfile)
-    try:
-        vdf = pd.read_feather(args.vetfile)
-    except FileNotFoundError:
-        vdf = pd.DataFrame()
+    pdf = read_posts(args.postfile)
+    # Replays scores of earlier sessions that were not compacted into the vetfile (e.g. after a crash)
+    journal = VetJournal(args.vetfile, CONFIG("slow.reddit.journal.compact_every"))
+    vdf = journal.read()
 
     if args.reference:
-        rdf = pd.read_feather(args.reference)
+        # Vet files only hold scores, so look up the posts and their embeddings
+        rdf = read_vet(args.reference)[["score"]].join(
+            pdf[["post", "embedding"]], how="inner"
+        )
         reference_embeddings = np.stack(rdf["embedding"])
 
+    if args.agreement:
+        return agreement(args, rdf)
+
     if args.bias:
         bias_embedding = embed(args.bias)
 
+    sampler = Sampler(
+        pdf,
+        vdf.index,
+        bias_embedding if args.bias else None,
+        index=index_path(args.postfile),
+    )
+
     if args.n is None:
-        args.n = len(get_candidates(pdf, vdf))
+        args.n = sampler.numfresh()
 
     probs = weigh_subreddits(pdf, vdf)
-    embeddings = np.stack(pdf["embedding"])
 
     def sample_post(previous_sample=None, numcandidates=200, maxtries=20, tried=0):
+        """Draw a post that has not been vetted (or drawn for vetting) yet"""
         if previous_sample is not None:
             # Sample semantically similar posts, regardless of subreddit
-            query = previous_sample.embedding
-            results = util.semantic_search(query, embeddings, top_k=numcandidates)[0]
-
-            candidates = pdf.iloc[[result["corpus_id"] for result in results]]
+            position = sampler.near(previous_sample.embedding, numcandidates)
+        elif args.autovet:
+            # Next post in file order (or most similar to the bias)
+            position = sampler.next()
         else:
-            if args.autovet:
-                # Uniform sampling
-                candidates = pdf
-            else:
-                # Stratified sampling based on subreddit
-                subreddit = probs.sample(weights=probs).index[0]
-
-                # Choose candidate posts from that subreddit
-                candidates = pdf[pdf["subreddit"] == subreddit].sample(
-                    numcandidates, replace=True
-                )
-
-        # Choose a post that has not been labeled or vetted yet
-        candidates = get_candidates(candidates, vdf)
+            # Stratified sampling based on subreddit
+            subreddit = probs.sample(weights=probs).index[0]
+            position = sampler.from_subreddit(subreddit, numcandidates)
 
         # If no valid candidate, retry
-        if len(candidates) > 0:
-            if not args.bias:
-                return candidates.iloc[0]
-            else:
-                candidate_embeddings = np.stack(
-                    candidates["embedding"], dtype="float32"
-                )
-                scores = util.cos_sim(bias_embedding, candidate_embeddings)
-                best = scores.argmax().item()
-                return candidates.iloc[best]
+        if position is not None:
+            sampler.mark(position)
+            return pdf.iloc[position]
         else:
             if tried >= maxtries:
                 raise ValueError(
@@ -153,73 +177,225 @@ def main(args):
                 )
             return sample_post(None, numcandidates, maxtries, tried=tried + 1)
 
-    def predict(
-        sample,
-        explain=False,
+    def find_examples(
+        query,
+        exclude=(),
         num_good_examples=1,
         num_bad_examples=1,
         numcandidates=200,
     ):
-        if args.reference:
-            # Find semantically similar examples in the reference set for few-shot prompting
-            nonlocal rdf, reference_embeddings
+        """Find semantically similar examples in the reference set for few-shot prompting"""
+        if not args.reference:
+            return None  # Zero-shot prompting
 
-            query = sample.embedding
-            results = util.semantic_search(
-                query, reference_embeddings, top_k=numcandidates
-            )[0]
+        results = util.semantic_search(
+            query, reference_embeddings, top_k=numcandidates
+        )[0]
 
-            examples = []
+        examples = []
 
-            for result in results:
-                candidate = rdf.iloc[result["corpus_id"]]
+        for result in results:
+            candidate = rdf.iloc[result["corpus_id"]]
+            if candidate.name in exclude:
+                continue
 
-                if num_good_examples > 0 and candidate["score"] == 1:
-                    examples.append(("GOOD", candidate))
-                    num_good_examples -= 1
+            if num_good_examples > 0 and candidate["score"] == 1:
+                examples.append(("GOOD", candidate))
+                num_good_examples -= 1
 
-                if num_bad_examples > 0 and candidate["score"] == -1:
-                    examples.append(("BAD", candidate))
-                    num_bad_examples -= 1
+            if num_bad_examples > 0 and candidate["score"] == -1:
+                examples.append(("BAD", candidate))
+                num_bad_examples -= 1
 
-                if num_good_examples == 0 and num_bad_examples == 0:
-                    break
-        else:
-            # Zero-shot prompting
-            examples = None
+            if num_good_examples == 0 and num_bad_examples == 0:
+                break
 
+        return examples
+
+    def predict(sample, explain=False):
+        examples = find_examples(sample.embedding, exclude={sample.name})
         return ask_gemini(sample["post"], explain=explain, examples=examples)
 
+    def predict_batch(samples):
+        # The examples are shared by all posts in the batch, so look them up from their mean embedding
+        query = np.mean(np.stack([s.embedding for s in samples]), axis=0)
+        examples = find_examples(query, exclude={s.name for s in samples})
+        return ask_gemini_batch([s["post"] for s in samples], examples=examples)
+
+    classifier = Classifier.load(args.classifier) if args.classifier else None
+
     try:
         if args.autovet:
-            autovet(args, vdf, sample_post, predict)
+            autovet(
+                args, journal.append, sample_post, predict, predict_batch, classifier
+            )
         else:
-            vet(args, vdf, sample_post, predict)
+            vet(args, journal, sample_post, predict)
     finally:
-        writeout(vdf, args.vetfile)
+        journal.compact()
 
     return 0
 
 
-def autovet(args, vdf, sample_post, predict):
-    for _ in tqdm(range(args.n)):
-        sample = sample_post()
+def score(prediction):
+    if prediction == "GOOD":
+        return 1
+    elif prediction == "BAD":
+        return -1
+    else:
+        raise ValueError(f"Unknown prediction `{prediction}`")
+
+
+def autovet(args, flush, sample_post, predict, predict_batch, classifier=None):
+    vetter = AutoVetter(
+        CONFIG("slow.reddit.autovet.rpm"),
+        CONFIG("slow.reddit.autovet.concurrency"),
+        CONFIG("slow.reddit.autovet.max_retries"),
+    )
+    buffer = ResultBuffer(CONFIG("slow.reddit.autovet.flush_size"), flush)
+    batch_size = CONFIG("slow.reddit.autovet.batch_size")
+
+    def score_single(sample):
         try:
-            prediction = predict(sample, explain=False)
-            if prediction == "GOOD":
-                score = 1
-            elif prediction == "BAD":
-                score = -1
-            else:
-                raise ValueError(f"Unknown prediction `{prediction}`")
-        except Exception as e:
+            return score(predict(sample, explain=False))
+        except ValueError as e:
             print(f"Error processing `{sample.name}`: {e}")
-            score = 0
+            return 0
+
+    def score_batch(samples):
+        if len(samples) == 1:
+            return [score(predict(samples[0], explain=False))]
+
+        try:
+            return [score(p) for p in predict_batch(samples)]
+        except ValueError as e:
+            print(f"Falling back to single-post requests: {e}")
+
+        scores = []
+        for sample in samples:
+            vetter.limiter.acquire()
+            scores.append(score_single(sample))
+        return scores
+
+    numdecided = 0
+
+    def batches():
+        # Samples are drawn lazily in this thread while earlier batches are being predicted
+        nonlocal numdecided
+        batch = []
+        for _ in range(args.n):
+            sample = sample_post()
+
+            if classifier and (s := classifier.decide(sample.embedding)) is not None:
+                # Confident enough to skip Gemini
+                buffer.add(sample.name, s)
+                progress.update(1)
+                numdecided += 1
+                continue
+
+            batch.append(sample)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    progress = tqdm(total=args.n)
+
+    try:
+        for samples, result in vetter.map(batches(), score_batch):
+            if isinstance(result, Exception):
+                print(f"Error processing {[s.name for s in samples]}: {result}")
+                result = [0] * len(samples)
+
+            for sample, sample_score in zip(samples, result):
+                buffer.add(sample.name, sample_score)
+            progress.update(len(samples))
+    finally:
+        buffer.flush()
+        progress.close()
+
+    if classifier:
+        print(f"Scored {numdecided} posts locally with the classifier")
+
+
+def agreement(args, rdf):
+    """Compare batched to single-post zero-shot verdicts on the reference set, batch by batch"""
+    vetter = AutoVetter(
+        CONFIG("slow.reddit.autovet.rpm"),
+        CONFIG("slow.reddit.autovet.concurrency"),
+        CONFIG("slow.reddit.autovet.max_retries"),
+    )
+    batch_size = CONFIG("slow.reddit.autovet.batch_size")
+
+    rdf = rdf[rdf["score"] != 0]
+    if args.n is not None:
+        rdf = rdf.sample(n=min(args.n, len(rdf)))
+
+    batches = [rdf.iloc[i : i + batch_size] for i in range(0, len(rdf), batch_size)]
 
-        vdf.loc[sample.name, "score"] = score
+    def compare(batch):
+        posts = list(batch["post"])
 
+        # Failed verdicts are NaN, so they never count as agreeing
+        try:
+            batched = [score(v) for v in ask_gemini_batch(posts)]
+        except ValueError:
+            batched = [np.nan] * len(posts)  # Would have fallen back to single-post requests
+
+        single = []
+        for post in posts:
+            vetter.limiter.acquire()
+            try:
+                single.append(score(ask_gemini(post)))
+            except ValueError:
+                single.append(np.nan)
+
+        return np.array(batched, dtype=float), np.array(single, dtype=float)
+
+    records = []
+    for batch, result in tqdm(vetter.map(batches, compare), total=len(batches)):
+        if isinstance(result, Exception):
+            print(f"Error processing batch {list(batch.index)}: {result}")
+            continue
+
+        batched, single = result
+        truth = batch["score"].to_numpy()
+        both = ~np.isnan(batched) & ~np.isnan(single)
+        records.append(
+            {
+                "size": len(batch),
+                "parsed": not np.isnan(batched).any(),
+                "batched_failed": int(np.isnan(batched).sum()),
+                "single_failed": int(np.isnan(single).sum()),
+                "compared": int(both.sum()),
+                "agreed": int((batched == single)[both].sum()),
+                "batched_correct": int((batched == truth).sum()),
+                "single_correct": int((single == truth).sum()),
+            }
+        )
+        agreement = records[-1]["agreed"] / both.sum() if both.any() else np.nan
+        print(
+            f"Batch of {len(batch)}: agreement {agreement:.2f} on {both.sum()} posts"
+            + ("" if records[-1]["parsed"] else " (unparseable batch reply)")
+        )
+
+    summary = pd.DataFrame(records).sum()
+    print(f"Batch size: {batch_size}; batches: {len(records)}")
+    print(f"Parsed batch replies: {np.mean([r['parsed'] for r in records]):.2%}")
+    print(
+        f"Failed verdicts: {summary['batched_failed']} batched, {summary['single_failed']} single of {summary['size']} posts"
+    )
+    print(
+        f"agreement: {summary['agreed'] / summary['compared']:.2%} (on {summary['compared']} posts with both verdicts)"
+    )
+    print(f"batched_accuracy: {summary['batched_correct'] / summary['size']:.2%}")
+    print(f"single_accuracy: {summary['single_correct'] / summary['size']:.2%}")
+
+    return 0
 
-def vet(args, vdf, sample_post, predict):
+
+def vet(args, journal, sample_post, predict):
     numdone = 0
 
     def display(sample):
@@ -239,7 +415,11 @@ def vet(args, vdf, sample_post, predict):
         if c in [PLUS, ENTER, MINUS]:
             # Add the sample to the vetting df
             nonlocal sample, numdone
-            vdf.loc[sample.name, "score"] = int(SCORE[c])
+            journal.append(
+                pd.DataFrame(
+                    {"score": [SCORE[c]]}, index=pd.Index([sample.name], name="id")
+                )
+            )
             numdone += 1
 
             # Set stage for the next sample to be vetted
@@ -263,8 +443,14 @@ def vet(args, vdf, sample_post, predict):
 if __name__ == "__main__":
     parser = ConfigArgumentParser(description=__doc__, epilog=INSTRUCTIONS)
 
-    parser.add_argument("postfile", help="Post .feather file containing posts to vet")
-    parser.add_argument("vetfile", help="Output vet .feather file to append to")
+    parser.add_argument(
+        "postfile",
+        help="Posts store directory (or .feather file) containing posts to vet",
+    )
+    parser.add_argument(
+        "vetfile",
+        help="Output vet .feather file to append to (new scores are journaled to {vetfile}.journal first)",
+    )
     parser.add_argument(
         "-n", type=int, default=None, help="Stop vetting after {n} posts"
     )
@@ -288,7 +474,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--reference",
         default=None,
-        help="Reference .feather file containing ground-truth posts and labels for use with --predict or --autovet",
+        help="Reference .feather file containing ground-truth posts and labels for use with --predict, --autovet or --agreement",
+    )
+    parser.add_argument(
+        "--classifier",
+        default=None,
+        help="Classifier .npz file from `src.slow.reddit.classify` used to score confident posts locally during --autovet",
+    )
+    parser.add_argument(
+        "--agreement",
+        action="store_true",
+        help="Report per-batch agreement of batched (slow.reddit.autovet.batch_size) with single-post autovetting on (at most {n} posts of) the --reference set",
     )
 
     # Parse the command line arguments
@@ -298,7 +494,11 @@ if __name__ == "__main__":
         assert not args.predict, "Cannot --predict and --autovet at the same time"
     if args.reference:
         assert (
-            args.predict or args.autovet
-        ), "Cannot --reference without --predict or --autovet"
+            args.predict or args.autovet or args.agreement
+        ), "Cannot --reference without --predict, --autovet or --agreement"
+    if args.agreement:
+        assert args.reference, "Cannot --agreement without --reference"
+    if args.classifier:
+        assert args.autovet, "Cannot --classifier without --autovet"
 
     exit(main(args))
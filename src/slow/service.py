@@ -0,0 +1,284 @@
+"""Serve embedding and nearest neighbor search of SLOW thoughts to other processes on localhost
+
+Loads the embedding model and SLOW embedding matrix once, so that several stream processes (or vet/makeposts runs)
+on the same machine can share them by setting `slow.service.url`. Requests that arrive within `max_wait_ms` of each
+other are run as one batch. Needs no network access beyond localhost, so runs offline if the model and dataset are cached.
+"""
+
+import base64
+import json
+import queue
+import threading
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sys import exit
+from time import time
+
+import numpy as np
+
+from src.config import CONFIG, ConfigArgumentParser
+from src.log import info
+
+URL = CONFIG("slow.service.url")
+PORT = CONFIG("slow.service.port")
+MAX_BATCH = CONFIG("slow.service.max_batch")
+MAX_WAIT = CONFIG("slow.service.max_wait_ms") / 1000
+
+
+def encode_array(a):
+    a = np.ascontiguousarray(a, dtype="float32")
+    return {"shape": a.shape, "data": base64.b64encode(a.tobytes()).decode()}
+
+
+def decode_array(d):
+    return np.frombuffer(base64.b64decode(d["data"]), dtype="float32").reshape(
+        d["shape"]
+    )
+
+
+class Client:
+    def __init__(self, url=URL, timeout=60.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode()
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def health(self):
+        return self.request("/health")
+
+    def embed(self, texts, truncation_length=None):
+        """Embed a list of texts, each truncated to its LAST `truncation_length` tokens"""
+        reply = self.request(
+            "/embed", {"texts": texts, "truncation_length": truncation_length}
+        )
+        return decode_array(reply["embeddings"])
+
+    def nearest(self, queries, k=1):
+        """Return the positions and cosine similarities of the `k` nearest SLOW thoughts to each query"""
+        reply = self.request("/nearest", {"queries": encode_array(queries), "k": k})
+        return np.array(reply["positions"]), np.array(reply["scores"])
+
+
+def service_client():
+    """Return a Client if `slow.service.url` is set, else None"""
+    url = CONFIG("slow.service.url")
+    return Client(url) if url else None
+
+
+class Batcher:
+    """Run `function` on the concatenated inputs of requests that arrive close together
+
+    A batch is closed when it holds `max_batch` inputs or `max_wait` seconds after its first request arrived.
+    """
+
+    def __init__(self, function, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.function = function
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.numbatches = 0
+        self.numinputs = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, inputs):
+        future = Future()
+        self.queue.put((list(inputs), future))
+        return future
+
+    def collect(self):
+        batch = [self.queue.get()]
+        n = len(batch[0][0])
+        deadline = time() + self.max_wait
+        while n < self.max_batch:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            n += len(batch[-1][0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            inputs = [x for request, _ in batch for x in request]
+            try:
+                outputs = self.function(inputs)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.numbatches += 1
+            self.numinputs += len(inputs)
+
+            start = 0
+            for request, future in batch:
+                future.set_result(outputs[start : start + len(request)])
+                start += len(request)
+
+
+class Service:
+    def __init__(self, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        # Load everything locally, even if `slow.service.url` points to ourselves
+        from src.slow.embedder import Embedder
+        from src.slow.thought import SlowSpace
+
+        self.slow = SlowSpace(local=True)
+        self.slow.wait("matrix")
+        self.model = Embedder()
+        self.name = self.model.name
+        self.dimension = self.model.dimension
+        self.max_seq_length = self.model.max_seq_length
+
+        self.embedders = {}  # Requests are batched per truncation length
+        self.lock = threading.Lock()
+        self.searcher = Batcher(self.search, max_batch, max_wait)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+    def embed(self, texts, truncation_length=None):
+        truncation_length = truncation_length or self.max_seq_length
+        with self.lock:
+            if truncation_length not in self.embedders:
+                self.embedders[truncation_length] = Batcher(
+                    lambda texts: np.stack(
+                        list(self.model.embed_many(texts, truncation_length))
+                    ),
+                    self.max_batch,
+                    self.max_wait,
+                )
+        return self.embedders[truncation_length].submit(texts).result()
+
+    def search(self, queries):
+        """Return the positions and scores of the SLOW thoughts nearest to each (query, k)"""
+        slow = self.slow
+        results = []
+        if slow.index is not None:
+            for query, k in queries:
+                positions, scores = slow.index.search(query, k)
+                results.append((positions.tolist(), scores.tolist()))
+            return results
+
+        Q = np.stack([query for query, _ in queries])
+        scores = (Q @ slow.embeddings.T) / slow.norms
+        for row, (_, k) in zip(scores, queries):
+            k = min(k, len(row))
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append((top.tolist(), row[top].tolist()))
+        return results
+
+    def nearest(self, queries, k):
+        results = self.searcher.submit([(q, k) for q in queries]).result()
+        return [p for p, _ in results], [s for _, s in results]
+
+    def health(self):
+        return {
+            "model": self.name,
+            "dimension": self.dimension,
+            "max_seq_length": self.max_seq_length,
+            "numthoughts": len(self.slow.df),
+            "numbatches": sum(b.numbatches for b in self.embedders.values())
+            + self.searcher.numbatches,
+            "numinputs": sum(b.numinputs for b in self.embedders.values())
+            + self.searcher.numinputs,
+        }
+
+
+def handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.reply(service.health())
+            else:
+                self.reply({"error": f"Unknown path {self.path}"}, 404)
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+
+                if self.path == "/embed":
+                    embeddings = service.embed(
+                        payload["texts"], payload.get("truncation_length")
+                    )
+                    self.reply({"embeddings": encode_array(embeddings)})
+                elif self.path == "/nearest":
+                    positions, scores = service.nearest(
+                        decode_array(payload["queries"]), payload.get("k", 1)
+                    )
+                    self.reply({"positions": positions, "scores": scores})
+                else:
+                    self.reply({"error": f"Unknown path {self.path}"}, 404)
+            except Exception as e:
+                self.reply({"error": str(e)}, 500)
+
+        def log_message(self, format, *args):
+            pass  # Requests are too frequent to log
+
+    return Handler
+
+
+def main(args):
+    t = time()
+    service = Service(args.max_batch, args.max_wait_ms / 1000)
+    health = service.health()
+    info(
+        f"Loaded {health['model']} and {health['numthoughts']} SLOW thoughts in {time() - t:.1f}s"
+    )
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler(service))
+    server.daemon_threads = True
+    print(f"Serving on http://127.0.0.1:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ConfigArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help="Listen on this port on localhost (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=MAX_BATCH,
+        help="Max number of texts or queries per batch (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=CONFIG("slow.service.max_wait_ms"),
+        help="Max time to wait for more requests to batch with (default: %(default)s)",
+    )
+
+    args = parser.parse_args()
+
+    exit(main(args))
@@ -1,68 +1,198 @@
+"""Walk the SLOW thought space, which loads in stages in the background"""
+
+import threading
+from time import time
+
 import numpy as np
+import pandas as pd
 
 from src.config import CONFIG
-from src.log import debug
-from src.slow.df import SLOWDF  # Takes a while
-from src.slow.embed import (  # Takes a while
-    bias_step,
-    compute_bias_matrix,
-    embed,
-)
-
-EMBEDDINGS = np.stack(SLOWDF["embedding"], dtype="float32")
-
-BIAS_MATRIX = compute_bias_matrix(
-    CONFIG("slow.bias.overall_multiplier"),
-    CONFIG("slow.bias.directions"),
-)
-BIAS_PROJECTOR = np.linalg.pinv(BIAS_MATRIX)
+from src.log import debug, error, info
+from src.log.events import event
+from src.metrics import observe
+
 INTENSITY = CONFIG("slow.bias.intensity")
 MAX_STEPS = CONFIG("slow.walk.max_steps")
 
+STAGES = ("dataset", "matrix", "model", "bias")
+STEP_BUCKETS = tuple(range(MAX_STEPS + 1))
+
+
+class SlowSpace:
+    """The SLOW thoughts and what is needed to walk between them, loaded stage by stage:
+
+    - dataset: the texts of the thoughts (enough for sample_random_thought())
+    - matrix: their embedding matrix, norms and IVF index (enough for nearest_neighbor())
+    - model: the embedding model
+    - bias: the bias matrix, which needs the model (enough for sample_nearby_thought())
+
+    Call start() to load in a background thread, or let each method load what it needs on first use.
+    Unless `local`, nearest neighbors are searched by the shared service if `slow.service.url` is set.
+    """
+
+    def __init__(self, local=False):
+        self.local = local
+        self.ready = {stage: threading.Event() for stage in STAGES}
+        self.lock = threading.Lock()
+        self.exception = None
+        self.failed = len(STAGES)  # Index of the stage that failed to load
+
+    def start(self):
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def load(self, until=STAGES[-1]):
+        with self.lock:
+            self.load_stages(until)
+
+    def load_stages(self, until):
+        for i, stage in enumerate(STAGES[: STAGES.index(until) + 1]):
+            if self.ready[stage].is_set():
+                continue
+            t = time()
+            try:
+                getattr(self, f"load_{stage}")()
+            except Exception as e:
+                error(f"Loading SLOW {stage} failed: {e}", exc_info=True)
+                self.exception = e
+                self.failed = i
+                for ready in self.ready.values():
+                    ready.set()  # Wake up waiters, who will raise if they need this stage
+                return
+            self.ready[stage].set()
+            info(f"SLOW {stage} ready in {time() - t:.1f}s ({i + 1}/{len(STAGES)} stages)")
+
+    def wait(self, stage):
+        """Block until `stage` is loaded, loading it in this thread if no one else is loading"""
+        if not self.ready[stage].is_set() and self.lock.acquire(blocking=False):
+            try:
+                self.load_stages(until=stage)
+            finally:
+                self.lock.release()
+        self.ready[stage].wait()
+        if not self.isready(stage):
+            raise RuntimeError(f"SLOW {stage} failed to load") from self.exception
+
+    def isready(self, stage):
+        return self.ready[stage].is_set() and STAGES.index(stage) < self.failed
+
+    def load_dataset(self):
+        from src.slow.df import HF_SLOW_THOUGHTS_FILE, SHA256, slow_thoughts_source
+        from src.slow.dataset import open_slow_thoughts
+
+        self.source = slow_thoughts_source()
+        self.table = open_slow_thoughts(
+            self.source.fetch(HF_SLOW_THOUGHTS_FILE, SHA256)
+        )
+        self.df = pd.DataFrame({"text": self.table["text"].to_pandas()})
+        info(f"Loaded {len(self.df)} slow thoughts")
+
+    def load_matrix(self):
+        from src.slow.df import fetch_index
+        from src.slow.dataset import slow_matrix
+        from src.slow.service import service_client
+
+        # Memory-mapped, so shared with other processes through the page cache
+        self.embeddings, self.norms = slow_matrix(self.table)
+
+        # Client mode: search with the shared service's index rather than building or loading our own
+        self.client = None if self.local else service_client()
+        if self.client is not None:
+            numthoughts = self.client.health()["numthoughts"]
+            if numthoughts != len(self.df):
+                raise ValueError(
+                    f"Service at {self.client.url} serves {numthoughts} SLOW thoughts, not {len(self.df)}"
+                )
+            self.index = None
+        else:
+            self.index = fetch_index(self.source, self.embeddings)
+
+    def load_model(self):
+        import src.slow.embed  # noqa: F401
+
+    def load_bias(self):
+        from src.slow.embed import compute_bias_matrix
+
+        self.bias_matrix = compute_bias_matrix(
+            CONFIG("slow.bias.overall_multiplier"),
+            CONFIG("slow.bias.directions"),
+        )
+        self.bias_projector = np.linalg.pinv(self.bias_matrix)
+
+    def sample_random_thought(self, history=None):
+        self.wait("dataset")
+        if history is None:
+            return self.df.sample()
+        else:
+            # Return unique sample not in `history`
+            return self.df.loc[~self.df.index.isin(history.index)].sample()
+
+    def nearest_neighbor(self, query):
+        """Find the nearest neighbor to `query` in cosine similarity
+
+        Uses the prebuilt IVF index if the dataset came with one, which assumes normalized embeddings"""
+        self.wait("matrix")
+        if self.client is not None:
+            positions, _ = self.client.nearest(np.asarray(query)[None, :], 1)
+            return self.df.iloc[[positions[0][0]]]
+
+        if self.index is not None:
+            positions, _ = self.index.search(query, 1)
+            if len(positions):
+                return self.df.iloc[[positions[0]]]
+
+        dp = np.dot(self.embeddings, query) / self.norms
+        return self.df.iloc[[np.argmax(dp)]]
+
+    def sample_nearby_thought(self, walk, start, end):
+        self.wait("bias")
+        from src.slow.embed import bias_step, embed
+
+        current = self.embeddings[walk.index[-1]]
+
+        step = embed(end) - embed(start)
+
+        if np.isclose(np.linalg.norm(step), 0.0):
+            # Take a shortcut
+            event("slow_walk", steps=0, found=False, reason="no step")
+            return self.sample_random_thought(walk)
+
+        biased_step = bias_step(
+            step,
+            self.bias_matrix,
+            self.bias_projector,
+            INTENSITY,
+        )
 
-def sample_random_thought(history=None):
-    if history is None:
-        return SLOWDF.sample()
-    else:
-        # Return unique sample not in `history`
-        return SLOWDF.loc[~SLOWDF.index.isin(history.index)].sample()
-
-
-def nearest_neighbor(query, embeddings=EMBEDDINGS):
-    """Find the nearest neighbor in `SLOWDF` to `query`
-
-    Note: assuming all embeddings are normalized, we can minimize distance by maximizing dot product"""
-    dp = np.dot(embeddings, query)
-    return SLOWDF.iloc[[np.argmax(dp)]]
-
+        for i in range(MAX_STEPS):
+            debug(
+                f"Taking step {i+1}/{MAX_STEPS}: |biased_step| = {np.linalg.norm(biased_step)}"
+            )
 
-def sample_nearby_thought(walk, start, end):
-    current = walk.iloc[-1].embedding
+            current = current + biased_step
 
-    step = embed(end) - embed(start)
+            candidate = self.nearest_neighbor(current)
+            if not candidate.index.isin(walk.index):
+                event("slow_walk", steps=i + 1, found=True)
+                observe("slow_walk_steps", i + 1, STEP_BUCKETS, found="true")
+                return candidate
 
-    if np.isclose(np.linalg.norm(step), 0.0):
-        # Take a shortcut
-        return sample_random_thought(walk)
+            biased_step *= 2.0
 
-    biased_step = bias_step(
-        step,
-        BIAS_MATRIX,
-        BIAS_PROJECTOR,
-        INTENSITY,
-    )
+        event("slow_walk", steps=MAX_STEPS, found=False, reason="max steps")
+        observe("slow_walk_steps", MAX_STEPS, STEP_BUCKETS, found="false")
+        return self.sample_random_thought(walk)
 
-    for i in range(MAX_STEPS):
-        debug(
-            f"Taking step {i+1}/{MAX_STEPS}: |biased_step| = {np.linalg.norm(biased_step)}"
-        )
 
-        current = current + biased_step
+SLOW = SlowSpace()
 
-        candidate = nearest_neighbor(current)
-        if not candidate.index.isin(walk.index):
-            return candidate
+sample_random_thought = SLOW.sample_random_thought
+nearest_neighbor = SLOW.nearest_neighbor
+sample_nearby_thought = SLOW.sample_nearby_thought
 
-        biased_step *= 2.0
 
-    return sample_random_thought(walk)
+if __name__ == "__main__":
+    # Cold start: fetch the dataset and embedding model into their caches
+    SLOW.load()
+    print(SLOW.sample_random_thought().iloc[0].text)
@@ -0,0 +1,108 @@
+"""Check retries, backoff and result flushing of the autovetting engine against the fake Gemini"""
+
+import json
+
+import pytest
+
+from src.gemini.fake import FakeError, FakeModel
+from src.retry import backoff
+from src.slow.reddit.autovet import AutoVetter, ResultBuffer
+from src.slow.reddit.journal import VetJournal, read_vet
+
+PROMPT = "Evaluate the Reddit post as GOOD or BAD.\n```\n{}\n```"
+
+
+def fake(failure_rate=0.0):
+    model = FakeModel("fake", generation_config={"max_output_tokens": 1})
+    model.ttft, model.ttft_per_kchar, model.jitter = 0.0, 0.0, 0.0
+    model.chars_per_second = float("inf")
+    model.failure_rate = failure_rate
+    return model
+
+
+def vetter(max_retries):
+    return AutoVetter(60000, 8, max_retries, backoff_base=0.001, backoff_max=0.01)
+
+
+def scorer(model):
+    def score(post):
+        reply = model.generate_content(PROMPT.format(post)).text
+        if reply not in ("GOOD", "BAD"):
+            raise ValueError(f"Unknown prediction `{reply}`")
+        return 1 if reply == "GOOD" else -1
+
+    return score
+
+
+def test_transient_failures_are_retried():
+    model = fake(failure_rate=0.5)
+    results = dict(vetter(max_retries=20).map(range(100), scorer(model)))
+
+    assert sorted(results) == list(range(100))
+    assert set(results.values()) <= {1, -1}
+    assert model.numrequests > 100  # Some requests were retried
+
+
+def test_gives_up_after_max_retries():
+    model = fake(failure_rate=1.0)
+    results = dict(vetter(max_retries=3).map(range(10), scorer(model)))
+
+    assert all(isinstance(result, FakeError) for result in results.values())
+    assert model.numrequests == 10 * (3 + 1)
+
+
+def test_fatal_errors_are_not_retried():
+    calls = []
+
+    def work(post):
+        calls.append(post)
+        raise ValueError("Unparseable")
+
+    results = dict(vetter(max_retries=5).map(range(10), work))
+
+    assert all(isinstance(result, ValueError) for result in results.values())
+    assert len(calls) == 10
+
+
+def test_backoff_is_bounded():
+    for attempt in range(20):
+        for _ in range(100):
+            assert 0.0 <= backoff(attempt, 0.5, 30.0) <= min(30.0, 0.5 * 2**attempt)
+
+
+def test_batched_verdicts():
+    model = FakeModel("fake", generation_config={"response_mime_type": "application/json"})
+    model.ttft, model.jitter, model.chars_per_second = 0.0, 0.0, float("inf")
+    posts = "".join(f"Post {i}:\n```\npost\n```\n" for i in range(1, 8))
+    verdicts = json.loads(model.generate_content(f"GOOD or BAD\n{posts}").text)
+
+    assert len(verdicts) == 7
+    assert set(verdicts) <= {"GOOD", "BAD"}
+
+
+@pytest.mark.parametrize("n, size", [(25, 10), (10, 10), (3, 100)])
+def test_result_buffer_flushes_into_vet_journal(tmp_path, n, size):
+    vetfile = tmp_path / "vet.feather"
+    journal = VetJournal(vetfile)
+    flushed = []
+
+    def flush(df):
+        flushed.append(len(df))
+        journal.append(df)
+
+    buffer = ResultBuffer(size, flush)
+    model = fake(failure_rate=0.3)
+    for post, result in vetter(max_retries=20).map(range(n), scorer(model)):
+        buffer.add(f"id{post}", result)
+    buffer.flush()
+    buffer.flush()  # Nothing left: no empty flush
+
+    assert flushed == [size] * (n // size) + ([n % size] if n % size else [])
+
+    vdf = read_vet(vetfile)
+    assert vdf.index.name == "id"
+    assert sorted(vdf.index) == sorted(f"id{i}" for i in range(n))
+    assert set(vdf["score"]) <= {1, -1}
+
+    compacted = journal.compact()
+    assert compacted.index.name == "id" and len(compacted) == n
@@ -0,0 +1,40 @@
+"""Check the clustering of near-duplicate posts by embedding, including edge cases"""
+
+import numpy as np
+import pandas as pd
+
+from src.slow.reddit.dedup import cosine_pairs, duplicates, embedding_duplicates
+
+
+def embeddings(n, d=16, seed=0):
+    X = np.random.default_rng(seed).normal(size=(n, d)).astype("float32")
+    X[n // 2 :] = X[: n - n // 2] + 0.05 * X[n // 2 :]  # Near-duplicates of the first half
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def test_no_posts():
+    labels = embedding_duplicates(np.empty((0, 0)))
+    assert labels.dtype.kind == "i" and len(labels) == 0
+    report = duplicates(pd.DataFrame(index=pd.Index([], name="id")), labels)
+    assert len(report) == 0 and report.index.name == "id"
+
+
+def test_cosine_pairs_match_brute_force():
+    X = embeddings(250)
+    similarities = X @ X.T
+    expected = {
+        (i, j)
+        for i, j in zip(*np.nonzero(similarities >= 0.95))
+        if i < j
+    }
+    for blocksize in (1, 7, 64, 1024):
+        assert set(cosine_pairs(X, 0.95, blocksize)) == expected
+    assert expected
+
+
+def test_duplicates_point_to_the_earliest_post():
+    X = embeddings(10)
+    index = pd.Index([f"p{i}" for i in range(10)], name="id")
+    report = duplicates(pd.DataFrame(index=index), embedding_duplicates(X, 0.95))
+    assert list(report.index) == [f"p{i}" for i in range(5, 10)]
+    assert list(report["duplicate_of"]) == [f"p{i}" for i in range(5)]
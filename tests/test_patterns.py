@@ -0,0 +1,169 @@
+"""Check that the single-pass LABELER and COLLAPSE agree with the per-category and chained regexes they replace"""
+
+import random
+import re
+
+import pytest
+
+from src.slow.reddit.patterns import (
+    COLLAPSE,
+    LABEL_PATTERNS,
+    LABELER,
+    REDACTED,
+    REDDITLIKE,
+    TWITTER,
+    URL,
+)
+
+CONTEXTS = [
+    "{}",
+    "I said {} today.",
+    "{}s and more",  # Word boundary after the match fails
+    "x{} here",  # Word boundary before the match fails
+    "({})",
+    "first line?\n{}",
+    "{}?",
+    "{}\nsecond line",
+    "foo_{}_bar",
+    "{}: done",
+]
+
+# Texts for the alternatives that are not plain words (see `words()`), including near misses
+EXAMPLES = {
+    REDACTED: ["[removed]", "[removed by mod]", "[Deleted]", "[ label ]", "[edit]", "[see edited]", "[nothing]"],
+    URL: ["http://example.com", "https://www.foo.org/bar?x=1", "example.co.uk", "foo.c", "a.b.c/d", "x.toolongtld1"],
+    REDDITLIKE: ["reddit", "subreddits", "askreddit", "r/python", "u/someone", "r/", "u/_"],
+    TWITTER: ["@someone", "#hashtag", "@abc", "#abc", "@four", "a@someone"],
+    r"\bedit:\B": ["edit:", "Edit: fixed", "edit:s", "reedit:"],
+    r"\b\d\d\s*\(?[fFmM]\)?\b": ["28m", "28 f", "28 (m)", "28(F)", "28mm", "281m"],
+    r"\b\d\dyo\b": ["28yo", "28yos", "2yo"],
+    r"\bi(\')?( a)?m (only )?(a )?\d\d\b": ["I'm 28", "im a 30", "I am only 28", "Im only a 19", "I'm 2", "I'm 28%"],
+    r"\b\d\d year old (fe)?male\b": ["28 year old male", "30 year old female", "3 year old male"],
+    r"^.*\?\n": ["Why?\nbody", "Why? \n", "?\n"],
+    r"\?$": ["really?", "really? no", "?"],
+}
+
+OPTIONAL = re.compile(r"\(([^()]*)\)\?")
+
+
+def words(alternative):
+    """All spellings of a `word_boundaries()` alternative like `my (ex-)?husband`, or None for other alternatives"""
+    if not (alternative.startswith(r"\b") and alternative.endswith(r"\b")):
+        return None
+    word = alternative[2:-2]
+    if "|" in word or "[" in word or re.search(r"\\[^.?]", word):
+        return None
+
+    match = OPTIONAL.search(word)
+    if match is None:
+        return [re.sub(r"\\(.)", r"\1", word)]
+    before, after = word[: match.start()], word[match.end() :]
+    return [
+        spelling
+        for middle in ("", match.group(1))
+        for spelling in words(rf"\b{before}{middle}{after}\b")
+    ]
+
+
+def samples(alternative):
+    samples = words(alternative) or EXAMPLES.get(alternative)
+    assert samples, f"No examples for {alternative!r}: add some to EXAMPLES"
+    return samples
+
+
+def texts(alternatives):
+    for alternative in alternatives:
+        for s in samples(alternative):
+            for variant in {s, s.upper(), s.capitalize()}:
+                for context in CONTEXTS:
+                    yield context.format(variant)
+
+
+ALL_ALTERNATIVES = [a for alternatives in LABEL_PATTERNS.values() for a in alternatives]
+
+REFERENCE = {
+    category: re.compile("|".join(alternatives), flags=re.IGNORECASE)
+    for category, alternatives in LABEL_PATTERNS.items()
+}
+
+
+def reference_labels(text):
+    return [c for c, pattern in REFERENCE.items() if pattern.search(text)]
+
+
+@pytest.mark.parametrize("category", list(LABEL_PATTERNS))
+def test_labeler_matches_per_category_regexes(category):
+    for text in texts(LABEL_PATTERNS[category]):
+        assert LABELER.search(text) == reference_labels(text), text
+
+
+def test_labeler_on_mixed_texts():
+    """Several categories in one text exercise resuming the search after a category matched"""
+    rng = random.Random(1)
+    pool = list(texts(ALL_ALTERNATIVES))
+    for _ in range(2000):
+        text = " ".join(rng.sample(pool, rng.randint(2, 5)))
+        assert LABELER.search(text) == reference_labels(text), text
+
+
+def test_labeler_on_plain_text():
+    for text in ["", "nothing to see", "momentarily", "submarine postcard", "reddit"]:
+        assert LABELER.search(text) == reference_labels(text), text
+
+
+CHAINED = [
+    re.compile(URL),
+    re.compile(REDACTED, re.IGNORECASE),
+    re.compile(REDDITLIKE, re.IGNORECASE),
+]
+
+
+def chained_collapse(text):
+    for pattern in CHAINED:
+        text = pattern.sub("...", text)
+    return text
+
+
+def single_collapse(text, pattern=re.compile(COLLAPSE)):
+    return pattern.sub("...", text)
+
+
+def collapse_texts():
+    alternatives = [URL, REDACTED, REDDITLIKE]
+    yield from texts(alternatives)
+    rng = random.Random(3)
+    pool = list(texts(alternatives))
+    for _ in range(2000):
+        yield " ".join(rng.sample(pool, rng.randint(2, 4)))
+
+
+def letters(text, pattern=re.compile(r"[a-zA-Z]")):
+    return bool(pattern.search(text))
+
+
+def test_collapse_matches_chained_substitutions():
+    for text in collapse_texts():
+        if re.search(r"\[[^\[\]]*" + URL, text):
+            continue  # A URL inside brackets: see test_collapse_url_in_brackets
+        assert single_collapse(text) == chained_collapse(text), text
+
+
+def test_collapse_url_in_brackets():
+    """The one documented difference: a redaction keyword only inside a bracketed URL
+
+    Chained, the URL is replaced first and the brackets no longer contain the keyword; in one pass the brackets
+    match first, so the whole text collapses.
+    """
+    text = "[see http://example.com/removed]"
+    assert chained_collapse(text) == "[see ...]"
+    assert single_collapse(text) == "..."
+    assert letters(chained_collapse(text)) and not letters(single_collapse(text))
+
+    text = "[removed] http://example.com"  # Keyword outside of the URL: no difference
+    assert single_collapse(text) == chained_collapse(text)
+
+
+def test_normalize_collapse():
+    normalize = pytest.importorskip("src.slow.reddit.normalize", exc_type=ImportError)
+    for text in collapse_texts():
+        assert normalize.collapse(text) == single_collapse(text), text
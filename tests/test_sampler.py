@@ -0,0 +1,73 @@
+"""Check that the IVF index of the vetting sampler is built once per version of the posts and reused after"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.slow.index import IVFIndex
+from src.slow.reddit.sampler import Sampler, index_path, load_index
+from src.slow.reddit.store import PostStore
+
+
+def embeddings(n, d=8, seed=0):
+    X = np.random.default_rng(seed).normal(size=(n, d)).astype("float32")
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def posts(n, seed=0):
+    return pd.DataFrame(
+        {
+            "subreddit": [f"r{i % 3}" for i in range(n)],
+            "embedding": list(embeddings(n, seed=seed)),
+        },
+        index=pd.Index([f"p{seed}-{i}" for i in range(n)], name="id"),
+    )
+
+
+def test_empty_index():
+    index = IVFIndex.build(np.empty((0, 8), dtype="float32"))
+    positions, scores = index.search(embeddings(1)[0], 10)
+    assert len(positions) == len(scores) == 0
+
+
+def test_empty_index_roundtrip(tmp_path):
+    X = np.empty((0, 8), dtype="float32")
+    IVFIndex.build(X).save(tmp_path / "empty.ivf.npz")
+    index = IVFIndex.load(tmp_path / "empty.ivf.npz", X)
+    assert len(index.search(embeddings(1)[0], 10)[0]) == 0
+
+
+def test_index_is_reused(tmp_path, capsys):
+    store = PostStore(tmp_path / "posts")
+    store.append(posts(100))
+    pdf = store.read()
+
+    path = index_path(store.path)
+    assert path.parent == tmp_path
+    built = Sampler(pdf, [], index=path).index
+    assert path.exists()
+    assert "Building" in capsys.readouterr().out
+
+    loaded = Sampler(pdf, [], index=index_path(store.path)).index
+    assert "Building" not in capsys.readouterr().out
+    query = pdf["embedding"].iloc[0]
+    for a, b in zip(built.search(query, 10), loaded.search(query, 10)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_index_is_rebuilt_for_new_posts(tmp_path):
+    store = PostStore(tmp_path / "posts")
+    store.append(posts(100))
+    old = index_path(store.path)
+    load_index(old, np.stack(store.read()["embedding"]))
+
+    store.append(posts(50, seed=1))
+    stat = (store.path / "index.feather").stat()
+    os.utime(store.path / "index.feather", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    new = index_path(store.path)
+    assert new != old
+
+    index = load_index(new, np.stack(store.read()["embedding"]))
+    assert sum(len(l) for l in index.lists) == 150
+    assert new.exists() and not old.exists()